@@ -0,0 +1,219 @@
+##########################################################################
+#
+# Filename: benchmark_zdepth.py
+#
+# Author: Julien Martin
+# Created: 2024-03
+#
+###########################################################################
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import statistics
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+# Flame modules are only stubbed when they are not installed
+sys.path.append(str(Path(__file__).resolve().parent / "flame_stubs"))
+# No host scheduler or event relay daemon outlives the run or adds its hop
+# to the timings, unless asked for in the environment
+os.environ.setdefault("COMFYUI_ZDEPTH_SCHEDULER", "0")
+os.environ.setdefault("COMFYUI_ZDEPTH_EVENTS", "0")
+
+from fake_comfyui_server import DEFAULT_PORT
+from fake_comfyui_server import start_server
+from fake_comfyui_server import write_exr
+
+
+HANDLERS = {
+    "depth_anything": ("comfyui_zdepth_depth_anything", "ComfyuiZDDA"),
+    "marigold": ("comfyui_zdepth_marigold", "ComfyuiZDMG"),
+    }
+
+STAGES = ["write input", "dispatch", "setup", "submit", "queue prompt", "results", "wait", "read output"]
+
+BENCH_DIR = Path(tempfile.gettempdir()) / "comfyui_zdepth_bench"
+
+DEFAULT_FRAMES = 50
+DEFAULT_TIMEOUT = 60
+POLL_INTERVAL = 0.005
+
+
+class Timings(object):
+
+    def __init__(self):
+        self.stages = {stage: [] for stage in STAGES}
+
+
+    def add(self, stage, seconds):
+        self.stages.setdefault(stage, []).append(seconds)
+
+
+    def timed(self, stage, function):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return wrapper
+
+
+    def report(self):
+        lines = [f'{"stage":<14}{"count":>7}{"mean ms":>10}{"p50 ms":>10}{"p95 ms":>10}']
+        for stage, values in self.stages.items():
+            if not values:
+                continue
+            values = sorted(values)
+            p95 = values[min(len(values) - 1, int(0.95 * len(values)))]
+            lines.append(
+                f'{stage:<14}{len(values):>7}{1000 * statistics.mean(values):>10.2f}'
+                f'{1000 * statistics.median(values):>10.2f}{1000 * p95:>10.2f}'
+                )
+        return "\n".join(lines)
+
+
+def benchmark_handler(handler_cls, timings):
+    # Drive the handler like Flame does: a new instance per pybox
+    # exchange, with the frame number and request flag set by the bench
+    class BenchmarkHandler(handler_cls):
+        bench_frame = 0
+        bench_requested = False
+
+        def get_frame(self):
+            return BenchmarkHandler.bench_frame
+
+        def out_frame_requested(self):
+            requested = BenchmarkHandler.bench_requested
+            BenchmarkHandler.bench_requested = False
+            return requested
+
+    # Every frame goes through submit_frame_workflow, which either hands
+    # the workflow to the base class or queues it on the pool/scheduler
+    BenchmarkHandler.workflow_setup = timings.timed("setup", handler_cls.workflow_setup)
+    BenchmarkHandler.submit_frame_workflow = timings.timed("submit", handler_cls.submit_frame_workflow)
+    BenchmarkHandler.frame_results_ready = timings.timed("results", handler_cls.frame_results_ready)
+    return BenchmarkHandler
+
+
+def time_queue_prompt(timings):
+    from zdepth_server import ServerPool
+    ServerPool.queue_prompt = timings.timed("queue prompt", ServerPool.queue_prompt)
+
+
+def using_stubs():
+    import pybox_v1
+    return Path(pybox_v1.__file__).resolve().parent.name == "flame_stubs"
+
+
+def stub_exchange(args):
+    # Exchange file of the stubbed pybox, and a Depth Anything model so
+    # the handler has one to pick
+    from comfyui_client import COMFYUI_WORKING_DIR
+    models_dir = Path(COMFYUI_WORKING_DIR) / "models" / "depthanything"
+    models_dir.mkdir(parents=True, exist_ok=True)
+    (models_dir / "depth_anything_v2_vitl_fp32.safetensors").touch()
+
+    pybox_json = BENCH_DIR / f"{args.handler}_pybox.json"
+    with open(pybox_json, "w") as f:
+        json.dump({
+            "host": f"127.0.0.1:{args.port}",
+            "in_dir": str(BENCH_DIR / "in"),
+            "out_dir": str(BENCH_DIR / "out"),
+            }, f)
+    return str(pybox_json)
+
+
+def peak_rss_mb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return usage / (1 << 20) if sys.platform == "darwin" else usage / 1024
+
+
+def run(args):
+    module_name, class_name = HANDLERS[args.handler]
+    module = __import__(module_name)
+    timings = Timings()
+    handler_cls = benchmark_handler(getattr(module, class_name), timings)
+    time_queue_prompt(timings)
+
+    if args.pybox_json is None:
+        if not using_stubs():
+            raise SystemExit("A pybox JSON captured from Flame is needed with the Flame modules installed")
+        args.pybox_json = stub_exchange(args)
+        # The node is created: its UI is built once, as in Flame
+        p = handler_cls(args.pybox_json)
+        p.dispatch()
+        p.write_to_disk(args.pybox_json)
+
+    start = time.perf_counter()
+    for frame in range(args.start, args.start + args.frames):
+        handler_cls.bench_frame = frame
+        handler_cls.bench_requested = True
+
+        p = handler_cls(args.pybox_json)
+        t = time.perf_counter()
+        if not getattr(p, "workflow", None):
+            p.load_workflow()
+        p.set_workflow_load_exr_filepath()
+        p.set_workflow_save_exr_filename_prefix(layers=p.operator_layers)
+        # Distinct Fronts, or the depth cache serves every frame after the first
+        write_exr(p.front_filepath(), args.width, args.height, value=0.5 + frame / (args.start + args.frames))
+        timings.add("write input", time.perf_counter() - t)
+        result = p.result_filepath(frame)
+
+        t = time.perf_counter()
+        deadline = t + args.timeout
+        while True:
+            p = handler_cls(args.pybox_json)
+            tick = time.perf_counter()
+            p.dispatch()
+            p.write_to_disk(args.pybox_json)
+            timings.add("dispatch", time.perf_counter() - tick)
+            if result.is_file():
+                break
+            if time.perf_counter() > deadline:
+                raise RuntimeError(f'Frame {frame} timed out waiting for {result}')
+            time.sleep(POLL_INTERVAL)
+        timings.add("wait", time.perf_counter() - t)
+
+        t = time.perf_counter()
+        with open(result, "rb") as f:
+            f.read()
+        timings.add("read output", time.perf_counter() - t)
+
+    elapsed = time.perf_counter() - start
+    print(f'{args.handler}: {args.frames} frames in {elapsed:.2f}s '
+          f'({args.frames / elapsed:.2f} frames/sec), peak RSS {peak_rss_mb():.1f} MB')
+    print(timings.report())
+
+
+def _main(argv):
+    parser = argparse.ArgumentParser(description="Throughput benchmark for the ZDepth pybox handlers")
+    parser.add_argument("handler", choices=sorted(HANDLERS))
+    parser.add_argument("pybox_json", nargs="?",
+                        help="Pybox JSON captured from Flame, its host set to the fake server. "
+                             "Generated when the Flame modules are stubbed")
+    parser.add_argument("--frames", type=int, default=DEFAULT_FRAMES)
+    parser.add_argument("--start", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.05, help="Simulated server seconds per frame")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--width", type=int, default=256)
+    parser.add_argument("--height", type=int, default=144)
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT)
+    parser.add_argument("--no-server", action="store_true", help="Use an already running server")
+    args = parser.parse_args(argv)
+
+    if not args.no_server:
+        start_server(args.port, os.getcwd(), args.latency, args.width, args.height)
+    run(args)
+
+if __name__ == "__main__":
+    _main(sys.argv[1:])
@@ -0,0 +1,424 @@
+##########################################################################
+#
+# Filename: fake_comfyui_server.py
+#
+# Author: Julien Martin
+# Created: 2024-03
+#
+###########################################################################
+from __future__ import print_function
+
+import sys
+import json
+import time
+import uuid
+import base64
+import struct
+import hashlib
+import argparse
+import threading
+from array import array
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from zdepth_workflow import result_path
+
+
+DEFAULT_PORT = 8188
+DEFAULT_LATENCY = 0.1
+DEFAULT_WIDTH = 256
+DEFAULT_HEIGHT = 144
+PROGRESS_STEPS = 4
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+SUPPORTED_CLASS_TYPES = {
+    "LoadEXR",
+    "SaveEXR",
+    "SaveDepthEXR",
+    "LoadSharedFrame",
+    "SaveSharedFrame",
+    "DepthAnything_V2",
+    "DownloadAndLoadDepthAnythingV2Model",
+    "MarigoldDepthEstimation",
+    "MarigoldDepthEstimationVideo",
+    }
+
+LOAD_CLASS_TYPES = ("LoadEXR", "LoadSharedFrame")
+SAVE_CLASS_TYPES = ("SaveEXR", "SaveDepthEXR", "SaveSharedFrame")
+
+
+###########################################################################
+# Synthetic EXR
+
+def exr_attribute(name, type_name, value):
+    return name.encode() + b"\0" + type_name.encode() + b"\0" + struct.pack("<i", len(value)) + value
+
+
+def write_exr(path, width, height, value=0.5):
+    # Uncompressed scanline RGB float EXR holding a vertical gradient
+    channels = b"".join(
+        name + b"\0" + struct.pack("<iB3xii", 2, 0, 1, 1)
+        for name in (b"B", b"G", b"R")
+        ) + b"\0"
+    window = struct.pack("<iiii", 0, 0, width - 1, height - 1)
+    header = b"".join((
+        struct.pack("<ii", 20000630, 2),
+        exr_attribute("channels", "chlist", channels),
+        exr_attribute("compression", "compression", b"\0"),
+        exr_attribute("dataWindow", "box2i", window),
+        exr_attribute("displayWindow", "box2i", window),
+        exr_attribute("lineOrder", "lineOrder", b"\0"),
+        exr_attribute("pixelAspectRatio", "float", struct.pack("<f", 1.0)),
+        exr_attribute("screenWindowCenter", "v2f", struct.pack("<ff", 0.0, 0.0)),
+        exr_attribute("screenWindowWidth", "float", struct.pack("<f", 1.0)),
+        b"\0",
+        ))
+
+    line_size = 3 * 4 * width
+    chunk_size = 8 + line_size
+    first_chunk = len(header) + 8 * height
+    offsets = struct.pack(f"<{height}Q", *(first_chunk + y * chunk_size for y in range(height)))
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(offsets)
+        for y in range(height):
+            line = array("f", [value * y / max(1, height - 1)] * width).tobytes()
+            f.write(struct.pack("<ii", y, line_size))
+            f.write(line * 3)
+    tmp_path.replace(path)
+
+
+###########################################################################
+# Prompt execution
+
+class FakeComfyUI(object):
+
+    def __init__(self, output_dir, latency=DEFAULT_LATENCY, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT):
+        self.output_dir = Path(output_dir)
+        self.latency = latency
+        self.width = width
+        self.height = height
+        self.lock = threading.Condition()
+        self.pending = []
+        self.running = None
+        self.history = {}
+        self.interrupted = False
+        self.number = 0
+        # Websocket clients by client id
+        self.clients = {}
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+
+    def validate(self, workflow):
+        for id, details in workflow.items():
+            class_type = details.get("class_type")
+            if class_type not in SUPPORTED_CLASS_TYPES:
+                return f'Node {id}: unsupported class type {class_type}'
+            for value in details.get("inputs", {}).values():
+                if isinstance(value, list) and len(value) == 2 and str(value[0]) not in workflow:
+                    return f'Node {id}: missing linked node {value[0]}'
+        return None
+
+
+    def queue_prompt(self, workflow, client_id=None):
+        with self.lock:
+            prompt_id = str(uuid.uuid4())
+            self.number += 1
+            self.pending.append((self.number, prompt_id, workflow, client_id))
+            self.lock.notify()
+        self.send_status()
+        return prompt_id, self.number
+
+
+    def send_event(self, event, data, client_id=None):
+        # Execution events go to the client which queued the prompt,
+        # status updates to everyone
+        message = json.dumps({"type": event, "data": data}).encode()
+        with self.lock:
+            clients = [self.clients.get(client_id)] if client_id is not None else list(self.clients.values())
+        for send in clients:
+            if send is not None:
+                try:
+                    send(message)
+                except OSError:
+                    pass
+
+
+    def send_status(self):
+        with self.lock:
+            remaining = len(self.pending) + (1 if self.running else 0)
+        self.send_event("status", {"status": {"exec_info": {"queue_remaining": remaining}}})
+
+
+    def queue(self):
+        with self.lock:
+            entry = lambda item: [item[0], item[1], item[2], {"client_id": item[3]}, []]
+            return {
+                "queue_running": [entry(self.running)] if self.running else [],
+                "queue_pending": [entry(item) for item in self.pending],
+                }
+
+
+    def delete(self, prompt_ids):
+        with self.lock:
+            self.pending = [item for item in self.pending if item[1] not in prompt_ids]
+
+
+    def interrupt(self):
+        with self.lock:
+            self.interrupted = True
+            self.lock.notify()
+
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.lock.wait()
+                self.running = self.pending.pop(0)
+                self.interrupted = False
+            number, prompt_id, workflow, client_id = self.running
+
+            emit = lambda event, data: self.send_event(event, dict(data, prompt_id=prompt_id), client_id)
+            emit("execution_start", {})
+            started = int(1000 * time.time())
+            status, outputs = self.execute(workflow, emit)
+            messages = [
+                ["execution_start", {"prompt_id": prompt_id, "timestamp": started}],
+                [f"execution_{status}", {"prompt_id": prompt_id, "timestamp": int(1000 * time.time())}],
+                ]
+            with self.lock:
+                self.history[prompt_id] = {
+                    "prompt": [number, prompt_id, workflow, {"client_id": client_id}, []],
+                    "outputs": outputs,
+                    "status": {"status_str": status, "completed": status == "success", "messages": messages},
+                    }
+                self.running = None
+            if status == "success":
+                emit("execution_success", {})
+            elif status == "interrupted":
+                emit("execution_interrupted", {})
+            else:
+                emit("execution_error", {"node_id": None, "node_type": "LoadEXR", "exception_message": "Missing input"})
+            emit("executing", {"node": None})
+            self.send_status()
+
+
+    def execute(self, workflow, emit):
+        load = next((d for d in workflow.values() if d["class_type"] in LOAD_CLASS_TYPES), None)
+        if load is None:
+            return "error", {}
+        frames = 1
+        if load["class_type"] == "LoadSharedFrame":
+            # Shared memory needs numpy, as in the handlers using it
+            from zdepth_shm import SharedFrame
+            front = SharedFrame.attach(load["inputs"]["name"])
+            if front is None:
+                return "error", {}
+            front.close()
+        else:
+            filepath = Path(load["inputs"]["filepath"])
+            if filepath.is_dir():
+                frames = load["inputs"].get("image_load_cap") or len(list(filepath.glob("*.exr")))
+            elif not filepath.is_file():
+                return "error", {}
+
+        model_id = next((
+            id for id, d in workflow.items()
+            if d["class_type"] not in LOAD_CLASS_TYPES + SAVE_CLASS_TYPES
+            ), None)
+        emit("executing", {"node": model_id})
+        for step in range(1, PROGRESS_STEPS + 1):
+            deadline = time.time() + self.latency * frames / PROGRESS_STEPS
+            with self.lock:
+                while not self.interrupted and time.time() < deadline:
+                    self.lock.wait(deadline - time.time())
+                if self.interrupted:
+                    return "interrupted", {}
+            emit("progress", {"node": model_id, "value": step, "max": PROGRESS_STEPS})
+
+        outputs = {}
+        for id, details in workflow.items():
+            if details["class_type"] not in SAVE_CLASS_TYPES:
+                continue
+            inputs = details["inputs"]
+            if details["class_type"] == "SaveSharedFrame":
+                self.write_shared_frame(inputs["name"])
+                outputs[id] = {"shared_frames": [inputs["name"]]}
+                emit("executed", {"node": id, "output": outputs[id]})
+                continue
+            prefix = Path(inputs["filename_prefix"])
+            if not prefix.is_absolute():
+                prefix = self.output_dir / prefix
+            if details["class_type"] == "SaveDepthEXR" and inputs.get("version", 0) >= 0:
+                # Named like the ZDepth node does
+                prefix = prefix.with_name(f'{prefix.name}_v{inputs["version"]:03d}')
+            images = []
+            for i in range(frames):
+                path = result_path(prefix, inputs["start_frame"] + i, inputs["frame_pad"])
+                write_exr(path, self.width, self.height)
+                images.append({"filename": path.name, "subfolder": str(path.parent), "type": "output"})
+            outputs[id] = {"images": images}
+            emit("executed", {"node": id, "output": outputs[id]})
+        return "success", outputs
+
+
+    def write_shared_frame(self, name):
+        import numpy as np
+        from zdepth_shm import SharedFrame
+        gradient = np.linspace(0.0, 0.5, self.height, dtype=np.float32)
+        pixels = np.repeat(gradient[:, np.newaxis, np.newaxis], self.width, axis=1).repeat(3, axis=2)
+        SharedFrame.from_pixels(name, pixels).close()
+
+
+###########################################################################
+# HTTP endpoints
+
+class FakeComfyUIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def send_json(self, payload, status=200):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length)) if length else {}
+
+
+    def websocket(self, client_id):
+        # Server side of the websocket: unmasked text frames pushed by the
+        # worker, incoming frames are drained until the client leaves
+        accept = base64.b64encode(hashlib.sha1((self.headers["Sec-WebSocket-Key"] + WS_GUID).encode()).digest())
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept.decode())
+        self.end_headers()
+        self.wfile.flush()
+
+        write_lock = threading.Lock()
+        def send(message):
+            if len(message) < 126:
+                header = struct.pack(">BB", 0x81, len(message))
+            elif len(message) < 1 << 16:
+                header = struct.pack(">BBH", 0x81, 126, len(message))
+            else:
+                header = struct.pack(">BBQ", 0x81, 127, len(message))
+            with write_lock:
+                self.wfile.write(header + message)
+                self.wfile.flush()
+
+        comfyui = self.server.comfyui
+        with comfyui.lock:
+            comfyui.clients[client_id] = send
+        comfyui.send_status()
+        try:
+            while True:
+                first, second = self.rfile.read(2)
+                length = second & 0x7F
+                if length == 126:
+                    length, = struct.unpack(">H", self.rfile.read(2))
+                elif length == 127:
+                    length, = struct.unpack(">Q", self.rfile.read(8))
+                self.rfile.read(4 + length)
+                if first & 0x0F == 0x8:
+                    break
+        except (OSError, ValueError):
+            pass
+        finally:
+            with comfyui.lock:
+                if comfyui.clients.get(client_id) is send:
+                    del comfyui.clients[client_id]
+        self.close_connection = True
+
+
+    def do_GET(self):
+        comfyui = self.server.comfyui
+        if self.path.startswith("/ws"):
+            _, _, query = self.path.partition("?clientId=")
+            self.websocket(query or str(uuid.uuid4()))
+        elif self.path == "/queue":
+            self.send_json(comfyui.queue())
+        elif self.path.startswith("/history/"):
+            prompt_id = self.path[len("/history/"):]
+            with comfyui.lock:
+                history = comfyui.history.get(prompt_id)
+            self.send_json({prompt_id: history} if history else {})
+        elif self.path == "/history":
+            with comfyui.lock:
+                self.send_json(dict(comfyui.history))
+        elif self.path == "/system_stats":
+            self.send_json({"system": {"python_version": sys.version}, "devices": []})
+        else:
+            self.send_json({"error": "not found"}, status=404)
+
+
+    def do_POST(self):
+        comfyui = self.server.comfyui
+        payload = self.read_json()
+        if self.path == "/prompt":
+            workflow = payload.get("prompt", {})
+            error = comfyui.validate(workflow)
+            if error:
+                self.send_json({"error": error, "node_errors": {}}, status=400)
+                return
+            prompt_id, number = comfyui.queue_prompt(workflow, payload.get("client_id"))
+            self.send_json({"prompt_id": prompt_id, "number": number, "node_errors": {}})
+        elif self.path == "/queue":
+            comfyui.delete(set(payload.get("delete", [])))
+            self.send_json({})
+        elif self.path == "/interrupt":
+            comfyui.interrupt()
+            self.send_json({})
+        else:
+            self.send_json({"error": "not found"}, status=404)
+
+
+def start_server(port=DEFAULT_PORT, output_dir=".", latency=DEFAULT_LATENCY,
+                 width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT):
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeComfyUIHandler)
+    server.daemon_threads = True
+    server.comfyui = FakeComfyUI(output_dir, latency, width, height)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def _main(argv):
+    parser = argparse.ArgumentParser(description="Stand-in ComfyUI server for the ZDepth handlers")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--output-dir", default=".", help="Directory for relative SaveEXR prefixes")
+    parser.add_argument("--latency", type=float, default=DEFAULT_LATENCY, help="Simulated seconds per frame")
+    parser.add_argument("--width", type=int, default=DEFAULT_WIDTH)
+    parser.add_argument("--height", type=int, default=DEFAULT_HEIGHT)
+    args = parser.parse_args(argv)
+
+    server = start_server(args.port, args.output_dir, args.latency, args.width, args.height)
+    print(f'Fake ComfyUI server listening on 127.0.0.1:{args.port}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    _main(sys.argv[1:])
@@ -0,0 +1,22 @@
+##########################################################################
+#
+# Filename: comfyui_client.py
+#
+# Author: Julien Martin
+# Created: 2024-03
+#
+###########################################################################
+from __future__ import print_function
+
+# Stand-in for the ComfyUI client module of the Flame ComfyUI setup, used
+# by the benchmark when it is not installed
+
+import os
+import tempfile
+from pathlib import Path
+
+
+COMFYUI_WORKING_DIR = os.environ.get(
+    "COMFYUI_WORKING_DIR",
+    str(Path(tempfile.gettempdir()) / "comfyui_zdepth_bench" / "ComfyUI"),
+    )
@@ -0,0 +1,184 @@
+##########################################################################
+#
+# Filename: pybox_comfyui.py
+#
+# Author: Julien Martin
+# Created: 2024-03
+#
+###########################################################################
+from __future__ import print_function
+
+# Stand-in for the Flame ComfyUI pybox base class, used by the benchmark
+# when it is not installed. Fronts are read from <in_dir>/<operator>,
+# Results written to <out_dir>/<operator>, and the base class submission
+# goes to the host of the UI like the real one.
+
+import tempfile
+from pathlib import Path
+
+import pybox_v1 as pybox
+
+from zdepth_server import ComfyUIServerError
+from zdepth_server import DEFAULT_COMFYUI_ADDRESS
+from zdepth_server import get_server
+from zdepth_server import server_address
+
+
+HANDLERS_DIR = Path(__file__).resolve().parents[2]
+
+BENCH_DIR = Path(tempfile.gettempdir()) / "comfyui_zdepth_bench"
+
+UI_HOST_INFO = "ComfyUI Host"
+UI_WORKFLOW_PATH = "Workflow Path"
+UI_VERSION = "Version"
+UI_INCREMENT_VERSION = "Increment Version"
+UI_INTERRUPT = "Interrupt"
+
+
+class Color(object):
+    GRAY = "gray"
+    GREEN = "green"
+    RED = "red"
+
+
+class LayerIn(object):
+    FRONT = "Front"
+
+
+class LayerOut(object):
+    RESULT = "Result"
+
+
+class ComfyUIBaseClass(pybox.BaseClass):
+    operator_name = None
+    operator_layers = []
+
+    version = 1
+
+    workflow = None
+    workflow_id_to_class_type = {}
+    workflow_load_exr_front_idx = -1
+    workflow_save_exr_result_idx = -1
+    out_frame_pad = 4
+
+    ui_processing = False
+    ui_version_row = 0
+    ui_version_col = 0
+    ui_processing_color_row = 0
+    ui_processing_color_col = 0
+
+
+    def __init__(self, json_path):
+        super().__init__(json_path)
+        self.workflow_dir = str(HANDLERS_DIR)
+        self.workflow_path = str(HANDLERS_DIR / f"comfyui_{self.operator_name}_workflow_api.json")
+        self.in_dir = Path(self.exchange.get("in_dir", BENCH_DIR / "in")) / self.operator_name
+        self.out_dir = Path(self.exchange.get("out_dir", BENCH_DIR / "out")) / self.operator_name
+        self.version = self.exchange.get("version", self.version)
+
+
+    ###########################################################################
+    # States
+
+    def initialize(self):
+        self.set_models()
+
+
+    def setup_ui(self):
+        self.init_ui()
+
+
+    def execute(self):
+        # Every exchange is a new instance: the models listed at
+        # initialize are listed again, from the persisted model index
+        self.set_models()
+        if not self.workflow:
+            self.load_workflow()
+
+
+    def teardown(self):
+        pass
+
+
+    def set_models(self):
+        pass
+
+
+    ###########################################################################
+    # UI
+
+    def set_ui_host_info(self, col):
+        host = pybox.create_text_field(
+            UI_HOST_INFO, value=self.exchange.get("host", DEFAULT_COMFYUI_ADDRESS), row=0, col=col,
+            )
+        self.add_global_elements(host)
+
+
+    def set_ui_workflow_path(self, col, workflow_dir, workflow_path):
+        self.add_global_elements(pybox.create_text_field(UI_WORKFLOW_PATH, value=str(workflow_path), row=1, col=col))
+
+
+    def set_ui_versions(self):
+        self.add_global_elements(pybox.create_float_numeric(UI_VERSION, value=self.version, default=1))
+
+
+    def set_ui_increment_version(self, row, col):
+        self.add_global_elements(pybox.create_toggle_button(UI_INCREMENT_VERSION, False, row=row, col=col))
+
+
+    def set_ui_interrupt(self, row, col):
+        self.add_global_elements(pybox.create_toggle_button(UI_INTERRUPT, False, row=row, col=col))
+
+
+    def set_ui_processing_color(self, color, processing):
+        self.exchange["processing"] = bool(processing)
+
+
+    ###########################################################################
+    # Workflow
+
+    def set_workflow_load_exr_filepath(self):
+        front_path = self.in_dir / f"front.{self.get_frame():0{self.out_frame_pad}d}.exr"
+        self.workflow.get(self.workflow_load_exr_front_idx)["inputs"]["filepath"] = str(front_path)
+
+
+    def set_workflow_save_exr_filename_prefix(self, layers):
+        prefix = self.out_dir / f"result_v{int(self.version):03d}"
+        inputs = self.workflow.get(self.workflow_save_exr_result_idx)["inputs"]
+        inputs["filename_prefix"] = str(prefix)
+        inputs["start_frame"] = self.get_frame()
+
+
+    def server(self):
+        return get_server(server_address(self.get_global_element_value(UI_HOST_INFO)))
+
+
+    def submit_workflow(self):
+        try:
+            self.exchange["prompt_id"] = self.server().queue_prompt(self.workflow)
+            self.ui_processing = True
+        except ComfyUIServerError as e:
+            print(f'Unable to submit workflow: {e}')
+
+
+    def interrupt_workflow(self):
+        try:
+            self.server().interrupt()
+        except ComfyUIServerError as e:
+            print(f'Unable to interrupt workflow: {e}')
+
+
+    def update_workflow_execution(self):
+        prompt_id = self.exchange.get("prompt_id")
+        if prompt_id is None:
+            return
+        try:
+            if self.server().is_done(prompt_id):
+                self.exchange["prompt_id"] = None
+                self.ui_processing = False
+        except ComfyUIServerError as e:
+            print(f'Unable to get workflow status: {e}')
+
+
+    def update_outputs(self, layers):
+        pass
@@ -0,0 +1,87 @@
+##########################################################################
+#
+# Filename: pybox_v1.py
+#
+# Author: Julien Martin
+# Created: 2024-03
+#
+###########################################################################
+from __future__ import print_function
+
+# Stand-in for the Flame pybox module, used by the benchmark when Flame is
+# not installed. UI elements are plain dicts and the exchange file is a
+# JSON of the element values, the frame and the request flag.
+
+import json
+
+
+def create_page(name, *columns):
+    return {"name": name, "columns": list(columns)}
+
+
+def create_element(kind, name, value, default, **kwargs):
+    return dict(kwargs, type=kind, name=name, value=value, default=default)
+
+
+def create_float_numeric(name, value=0, default=0, **kwargs):
+    return create_element("float_numeric", name, value, default, **kwargs)
+
+
+def create_toggle_button(name, value, default=False, **kwargs):
+    return create_element("toggle_button", name, value, default, **kwargs)
+
+
+def create_popup(name, items, value=0, default=0, **kwargs):
+    return create_element("popup", name, value, default, items=list(items), **kwargs)
+
+
+def create_text_field(name, value="", default="", **kwargs):
+    return create_element("text_field", name, value, default, **kwargs)
+
+
+class BaseClass(object):
+
+    def __init__(self, json_path):
+        with open(json_path) as f:
+            self.exchange = json.load(f)
+        self.exchange.setdefault("state_id", "initialize")
+        self.exchange.setdefault("elements", {})
+        self.exchange.setdefault("frame", 1)
+        self.exchange.setdefault("frame_requested", False)
+
+
+    def dispatch(self):
+        getattr(self, self.exchange["state_id"])()
+
+
+    def write_to_disk(self, json_path):
+        with open(json_path, "w") as f:
+            json.dump(self.exchange, f, indent=2)
+
+
+    def set_state_id(self, state_id):
+        self.exchange["state_id"] = state_id
+
+
+    def set_ui_pages_array(self, pages):
+        self.exchange["pages"] = pages
+
+
+    def add_global_elements(self, element):
+        self.exchange["elements"].setdefault(element["name"], element["value"])
+
+
+    def get_global_element_value(self, name):
+        return self.exchange["elements"][name]
+
+
+    def set_global_element_value(self, name, value):
+        self.exchange["elements"][name] = value
+
+
+    def get_frame(self):
+        return self.exchange["frame"]
+
+
+    def out_frame_requested(self):
+        return self.exchange["frame_requested"]
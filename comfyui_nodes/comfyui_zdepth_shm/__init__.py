@@ -0,0 +1,130 @@
+##########################################################################
+#
+# Filename: __init__.py
+#
+# Author: Julien Martin
+# Created: 2024-03
+#
+###########################################################################
+import sys
+from pathlib import Path
+
+import torch
+
+import folder_paths
+
+# The package is symlinked into ComfyUI custom_nodes from the handlers
+# checkout, which holds the shared frame format
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from zdepth_image import srgb_to_linear
+from zdepth_image import write_exr
+from zdepth_shm import SharedFrame
+from zdepth_workflow import result_path
+
+
+class LoadSharedFrame:
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {"name": ("STRING", {"default": ""})}}
+
+    RETURN_TYPES = ("IMAGE",)
+    FUNCTION = "load"
+    CATEGORY = "ZDepth"
+
+    @classmethod
+    def IS_CHANGED(cls, name):
+        return float("nan")
+
+    def load(self, name):
+        frame = SharedFrame.attach(name)
+        if frame is None:
+            raise FileNotFoundError(f'Shared frame {name} not found')
+        pixels = frame.array
+        channels = pixels.shape[2]
+        if channels >= 3:
+            image = torch.from_numpy(pixels[..., :3].copy())
+        else:
+            image = torch.from_numpy(pixels[..., :1].copy()).repeat(1, 1, 3)
+        del pixels
+        frame.close()
+        return (image.unsqueeze(0),)
+
+
+class SaveSharedFrame:
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {
+            "images": ("IMAGE",),
+            "name": ("STRING", {"default": ""}),
+            }}
+
+    RETURN_TYPES = ()
+    FUNCTION = "save"
+    OUTPUT_NODE = True
+    CATEGORY = "ZDepth"
+
+    def save(self, images, name):
+        pixels = images[0].detach().cpu().float().numpy()
+        frame = SharedFrame.from_pixels(name, pixels)
+        frame.close()
+        return {"ui": {"shared_frames": [name]}}
+
+
+class SaveDepthEXR:
+    # SaveEXR inputs and naming, plus the depth storage options. As with
+    # SaveEXR, a version of 0 or more is appended to the prefix as _vNNN.
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required": {
+            "images": ("IMAGE",),
+            "filename_prefix": ("STRING", {"default": "Result"}),
+            "sRGB_to_linear": ("BOOLEAN", {"default": True}),
+            "version": ("INT", {"default": 0, "min": -1, "max": 999}),
+            "start_frame": ("INT", {"default": 1, "min": 0, "max": 99999999}),
+            "frame_pad": ("INT", {"default": 4, "min": 1, "max": 8}),
+            "single_channel": ("BOOLEAN", {"default": True}),
+            "half_float": ("BOOLEAN", {"default": True}),
+            "compression": (["zip", "piz", "dwaa", "none"],),
+            }}
+
+    RETURN_TYPES = ()
+    FUNCTION = "save"
+    OUTPUT_NODE = True
+    CATEGORY = "ZDepth"
+
+    def save(self, images, filename_prefix, sRGB_to_linear, version, start_frame, frame_pad,
+             single_channel, half_float, compression):
+        prefix = Path(filename_prefix)
+        if not prefix.is_absolute():
+            prefix = Path(folder_paths.get_output_directory()) / prefix
+        if version >= 0:
+            prefix = prefix.with_name(f"{prefix.name}_v{version:03d}")
+        prefix.parent.mkdir(parents=True, exist_ok=True)
+        paths = []
+        for i, image in enumerate(images):
+            pixels = image.detach().cpu().float().numpy()
+            if sRGB_to_linear:
+                pixels = srgb_to_linear(pixels)
+            if single_channel:
+                pixels = pixels[..., :1]
+            path = result_path(str(prefix), start_frame + i, frame_pad)
+            write_exr(path, pixels, half=half_float, compression=compression)
+            paths.append(str(path))
+        return {"ui": {"exr_files": paths}}
+
+
+NODE_CLASS_MAPPINGS = {
+    "LoadSharedFrame": LoadSharedFrame,
+    "SaveSharedFrame": SaveSharedFrame,
+    "SaveDepthEXR": SaveDepthEXR,
+    }
+
+NODE_DISPLAY_NAME_MAPPINGS = {
+    "LoadSharedFrame": "Load Shared Frame",
+    "SaveSharedFrame": "Save Shared Frame",
+    "SaveDepthEXR": "Save Depth EXR",
+    }
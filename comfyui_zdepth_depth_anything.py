@@ -9,21 +9,35 @@
 from __future__ import print_function
 
 import sys
-import json
+
+import zdepth_helper
+
+if __name__ == "__main__":
+    # Forward the exchange to the warm helper of the session, the imports
+    # below only run in process
+    exit_code = zdepth_helper.forward(__file__, sys.argv[1:])
+    if exit_code is not None:
+        sys.exit(exit_code)
+
+import shutil
 import webbrowser
 from pathlib import Path
 
 import pybox_v1 as pybox
-import pybox_comfyui
+import pybox_comfyui_zdepth
 
 from comfyui_client import COMFYUI_WORKING_DIR
-from comfyui_client import find_models
 
 from pybox_comfyui import UI_INTERRUPT
 from pybox_comfyui import Color
 from pybox_comfyui import LayerIn
 from pybox_comfyui import LayerOut
 
+from zdepth_models import ModelIndex
+from zdepth_server import ComfyUIServerError
+from zdepth_trace import traced
+from zdepth_workflow import load_workflow_template
+
 
 COMFYUI_WORKFLOW_NAME = "ComfyUI ZDepth Depth Anything"
 COMFYUI_OPERATOR_NAME = "zdepth_depth_anything"
@@ -35,17 +49,34 @@ COMFYUI_MODELS_DA_DIR_PATHS = [
 DEFAULT_DA_MODEL = "depth_anything_v2_vitl_fp32.safetensors"
 
 UI_MODELS_DA_LIST = "DA Model"
+UI_WARM_UP = "Warm Up"
+UI_VRAM_BUDGET = "VRAM Budget (GB)"
+UI_PIN_FP16 = "Pin FP16"
+
+DEFAULT_WARM_UP = True
+DEFAULT_VRAM_BUDGET = 0
+DEFAULT_PIN_FP16 = False
 
+WARM_UP_DIRNAME = "zdepth_warm_up"
+WARM_UP_FRONT_PATH = Path(__file__).resolve().parent / "zdepth_warm_up.exr"
 
-class ComfyuiZDDA(pybox_comfyui.ComfyUIBaseClass):
+
+class ComfyuiZDDA(pybox_comfyui_zdepth.ComfyUIZDepthBaseClass):
     operator_name = COMFYUI_OPERATOR_NAME
     operator_layers = [LayerIn.FRONT, LayerOut.RESULT]
     
     version = 1
     
+    tile_size = 518
+    
     models = []
     model = ""
+    model_index = None
+    warm_up = DEFAULT_WARM_UP
+    vram_budget = DEFAULT_VRAM_BUDGET
+    pin_fp16 = DEFAULT_PIN_FP16
     
+    workflow_template = None
     workflow_model_idx = -1
     
 
@@ -53,6 +84,7 @@ class ComfyuiZDDA(pybox_comfyui.ComfyUIBaseClass):
     # Overrided functions from pybox_comfyui.ComfyUIBaseClass
     
     
+    @traced("initialize")
     def initialize(self):
         super().initialize()
         
@@ -66,17 +98,22 @@ class ComfyuiZDDA(pybox_comfyui.ComfyUIBaseClass):
         self.set_state_id("execute")
     
     
+    @traced("execute")
     def execute(self):
         super().execute()
         
+        self.warm_up_model()
+        
         if self.out_frame_requested():
-                self.submit_workflow()
+            self.request_frame(self.get_frame())
         
         if self.get_global_element_value(UI_INTERRUPT):
             self.interrupt_workflow()
+            self.clear_pending_frames()
 
         self.update_workflow_execution()
         self.update_outputs(layers=self.operator_layers)
+        self.frame_results_ready()
     
     
     def teardown(self):
@@ -98,6 +135,9 @@ class ComfyuiZDDA(pybox_comfyui.ComfyUIBaseClass):
             "Server & Workflow", "Model", "Action"
             )
         pages.append(page)
+        pages.append(self.create_performance_page("Held Frames"))
+        pages.append(self.create_post_page())
+        pages.append(self.create_io_page())
         self.set_ui_pages_array(pages)
         
         col = 0
@@ -106,6 +146,7 @@ class ComfyuiZDDA(pybox_comfyui.ComfyUIBaseClass):
         self.set_ui_workflow_path(col, self.workflow_dir, self.workflow_path)
         
         col = 1
+        self.update_models()
         models_list = pybox.create_popup(
             UI_MODELS_DA_LIST, 
             self.models, 
@@ -115,6 +156,31 @@ class ComfyuiZDDA(pybox_comfyui.ComfyUIBaseClass):
             )
         self.add_global_elements(models_list)
         
+        warm_up = pybox.create_toggle_button(
+            UI_WARM_UP, 
+            self.warm_up, 
+            default=DEFAULT_WARM_UP,
+            row=1, col=col, tooltip="Load the selected model on the server as soon as it is picked"
+            )
+        self.add_global_elements(warm_up)
+        
+        vram_budget = pybox.create_float_numeric(
+            UI_VRAM_BUDGET, 
+            value=self.vram_budget, 
+            default=DEFAULT_VRAM_BUDGET, 
+            min=0, max=192, inc=1,
+            row=2, col=col, tooltip="Size of the models kept resident per server, 0 is unbounded",
+            )
+        self.add_global_elements(vram_budget)
+        
+        pin_fp16 = pybox.create_toggle_button(
+            UI_PIN_FP16, 
+            self.pin_fp16, 
+            default=DEFAULT_PIN_FP16,
+            row=3, col=col, tooltip="Never evict fp16 models from the resident models"
+            )
+        self.add_global_elements(pin_fp16)
+        
         col = 2
         # ComfyUI workflow actions
         self.ui_version_row = 0
@@ -128,30 +194,164 @@ class ComfyuiZDDA(pybox_comfyui.ComfyUIBaseClass):
         self.ui_processing_color_row = 3
         self.ui_processing_color_col = col
         self.set_ui_processing_color(Color.GRAY, self.ui_processing)
+        
+        # Performance page
+        col = 0
+        self.set_ui_batch_frames(row=0, col=col)
+        self.set_ui_shared_memory(row=1, col=col)
+        self.set_ui_tiled(row=2, col=col)
+        
+        col = 1
+        self.set_ui_cache_size(row=0, col=col)
+        self.set_ui_output_format(row=1, col=col)
+        
+        col = 2
+        self.set_ui_in_flight(row=0, col=col)
+        self.set_ui_preview(row=2, col=col)
+        
+        col = 3
+        self.set_ui_hold_tolerance(row=0, col=col)
+        
+        # Post page
+        self.set_ui_post_process()
+        
+        # I/O page
+        self.set_ui_stream(row=0, col=0)
+        self.set_ui_prefetch(row=0, col=1)
     
     
     def set_models(self):
-        self.models = find_models(COMFYUI_MODELS_DA_DIR_PATHS)
+        # The models directory sits on the network mount: read the
+        # persisted index and refresh it while the handler runs
+        self.model_index = ModelIndex()
+        if self.model_index.indexed(COMFYUI_MODELS_DA_DIR_PATHS):
+            self.models = self.model_index.models(COMFYUI_MODELS_DA_DIR_PATHS)
+            self.model_index.refresh_in_background(COMFYUI_MODELS_DA_DIR_PATHS)
+        else:
+            self.model_index.refresh(COMFYUI_MODELS_DA_DIR_PATHS)
+            self.models = self.model_index.models(COMFYUI_MODELS_DA_DIR_PATHS)
         self.model = DEFAULT_DA_MODEL
     
     
+    def update_models(self):
+        if self.model_index is None or not self.model_index.refreshed():
+            return
+        models = self.model_index.models(COMFYUI_MODELS_DA_DIR_PATHS)
+        if models != self.models:
+            print(f'DA models updated: {", ".join(sorted(set(models) - set(self.models)))}')
+            self.models = models
+    
+    
+    def model_size(self, model):
+        for dir_path in COMFYUI_MODELS_DA_DIR_PATHS:
+            entry = self.model_index.entry(dir_path, model) if self.model_index else None
+            if entry is not None:
+                return entry["size"]
+        return 0
+    
+    
+    ###################################
+    # Model residency
+    
+    def get_server_pool(self):
+        pool = super().get_server_pool()
+        self.vram_budget = self.get_global_element_value(UI_VRAM_BUDGET)
+        self.pin_fp16 = self.get_global_element_value(UI_PIN_FP16)
+        pool.vram_budget = int(self.vram_budget * (1 << 30))
+        if not pool.model_sizes:
+            pool.model_sizes = {model: self.model_size(model) for model in self.models}
+        pool.pinned = {model for model in self.models if "fp16" in model} if self.pin_fp16 else set()
+        return pool
+    
+    
+    def warm_up_model(self):
+        # Load the model picked in the UI on the server the next frame
+        # would go to, unless it already holds it, with a prompt on the
+        # bundled warm up frame
+        self.warm_up = self.get_global_element_value(UI_WARM_UP)
+        if not self.warm_up or not self.workflow_template or not self.models:
+            return
+        model = self.models[int(self.get_global_element_value(UI_MODELS_DA_LIST))]
+        pool = self.get_server_pool()
+        address = pool.select(model)
+        if address is None or pool.is_resident(address, model):
+            return
+        
+        # The warm up frame is copied to a directory of its own next to
+        # the Result, which the server reads and writes, removed once the
+        # prompt is done
+        key = self.node_key()
+        warm_up_dir = self.result_filepath(0).parent / WARM_UP_DIRNAME / key
+        try:
+            warm_up_dir.mkdir(parents=True, exist_ok=True)
+            front_path = shutil.copyfile(WARM_UP_FRONT_PATH, warm_up_dir / WARM_UP_FRONT_PATH.name)
+        except OSError as e:
+            print(f'Unable to warm up {model}: {e}')
+            return
+        # Only the model, the input and the output of the template change,
+        # the current frame settings stay out of the warm up prompt
+        workflow = self.workflow_template.instantiate()
+        workflow.get(self.workflow_model_idx)["inputs"]["model"] = model
+        load_exr_inputs = workflow.get(self.workflow_load_exr_front_idx)["inputs"]
+        load_exr_inputs["filepath"] = str(front_path)
+        load_exr_inputs["image_load_cap"] = 0
+        load_exr_inputs["skip_first_images"] = 0
+        save_exr_inputs = workflow.get(self.workflow_save_exr_result_idx)["inputs"]
+        save_exr_inputs["filename_prefix"] = str(warm_up_dir / "warm_up")
+        
+        try:
+            prompt_id = pool.servers[address].queue_prompt(workflow)
+        except ComfyUIServerError as e:
+            print(f'Unable to warm up {model}: {e}')
+            pool.mark_dead(address)
+            shutil.rmtree(warm_up_dir, ignore_errors=True)
+            return
+        pool.mark_resident(address, model)
+        self.load_state().setdefault("warm_ups", {})[prompt_id] = [address, str(warm_up_dir)]
+        self.save_state()
+        print(f'Workflow warm up {model} on {address}: {prompt_id}')
+    
+    
+    def update_warm_ups(self):
+        warm_ups = self.load_state().get("warm_ups")
+        if not warm_ups:
+            return
+        
+        pool = self.get_server_pool()
+        for prompt_id, (address, warm_up_dir) in list(warm_ups.items()):
+            server = pool.server(address)
+            try:
+                if server is not None and not server.is_done(prompt_id):
+                    continue
+            except ComfyUIServerError as e:
+                print(f'Unable to get warm up status: {e}')
+            shutil.rmtree(warm_up_dir, ignore_errors=True)
+            del warm_ups[prompt_id]
+        self.save_state()
+    
+    
+    def frame_results_ready(self):
+        super().frame_results_ready()
+        self.update_warm_ups()
+    
+    
     ###################################
     # Workflow
     
+    @traced("load_workflow")
     def load_workflow(self):
-        with open(self.workflow_path) as f:
-            print("Loading Workflow")
-            self.workflow = json.load(f)
-            self.workflow_id_to_class_type = {id: details['class_type'] for id, details in self.workflow.items()}
-            # model 
-            self.workflow_model_idx = self.get_workflow_index('DownloadAndLoadDepthAnythingV2Model')
-            # load & save 
-            self.workflow_load_exr_front_idx = self.get_workflow_index('LoadEXR')
-            wf_ids_to_classes = self.workflow_id_to_class_type.items()
-            save_exr_nodes = [(key, self.workflow.get(key)["inputs"]) for key, value in wf_ids_to_classes if value == 'SaveEXR']
-            self.workflow_save_exr_result_idx = [key for (key, attr) in save_exr_nodes if attr["filename_prefix"] == "Result"][0]
-            # paramaters
-            self.out_frame_pad = self.workflow.get(self.workflow_save_exr_result_idx)["inputs"]["frame_pad"]
+        print("Loading Workflow")
+        template = load_workflow_template(self.workflow_path)
+        self.workflow_template = template
+        self.workflow = template.instantiate()
+        self.workflow_id_to_class_type = template.id_to_class_type
+        # model 
+        self.workflow_model_idx = template.index('DownloadAndLoadDepthAnythingV2Model')
+        # load & save 
+        self.workflow_load_exr_front_idx = template.index('LoadEXR')
+        self.workflow_save_exr_result_idx = template.save_exr_index("Result")
+        # paramaters
+        self.out_frame_pad = self.workflow.get(self.workflow_save_exr_result_idx)["inputs"]["frame_pad"]
     
     
     def set_workflow_model(self):
@@ -161,10 +361,24 @@ class ComfyuiZDDA(pybox_comfyui.ComfyUIBaseClass):
         self.workflow.get(self.workflow_model_idx)["inputs"]["model"] = self.model
             
     
+    def preview_parameters(self, workflow):
+        # Smallest model available, fp16 first
+        small_models = sorted((m for m in self.models if "vits" in m), key=lambda m: "fp16" not in m)
+        if small_models:
+            workflow.get(self.workflow_model_idx)["inputs"]["model"] = small_models[0]
+    
+    
+    def server_affinity(self):
+        return self.model
+    
+    
+    @traced("workflow_setup")
     def workflow_setup(self):
         self.set_workflow_model()
         self.set_workflow_load_exr_filepath()
         self.set_workflow_save_exr_filename_prefix(layers=self.operator_layers)
+        self.set_workflow_batch_window()
+        self.set_workflow_stream_window()
     
     
 def _main(argv):
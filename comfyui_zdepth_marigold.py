@@ -9,17 +9,45 @@
 from __future__ import print_function
 
 import sys
+
+import zdepth_helper
+
+if __name__ == "__main__":
+    # Forward the exchange to the warm helper of the session, the imports
+    # below only run in process
+    exit_code = zdepth_helper.forward(__file__, sys.argv[1:])
+    if exit_code is not None:
+        sys.exit(exit_code)
+
 import json
+import time
 import webbrowser
+from pathlib import Path
 
 import pybox_v1 as pybox
-import pybox_comfyui
+import pybox_comfyui_zdepth
 
 from pybox_comfyui import UI_INTERRUPT
 from pybox_comfyui import Color
 from pybox_comfyui import LayerIn
 from pybox_comfyui import LayerOut
 
+from zdepth_budget import TimeBudget
+from zdepth_ensemble import ENSEMBLE_INPUTS
+from zdepth_ensemble import MemberStore
+from zdepth_ensemble import ensemble_depths
+from zdepth_ensemble import member_key
+from zdepth_ensemble import member_seeds
+from zdepth_image import oiio
+from zdepth_image import read_exr
+from zdepth_image import signature_distance
+from zdepth_scheduler import PRIORITY_INTERACTIVE
+from zdepth_server import ComfyUIServerError
+from zdepth_trace import traced
+from zdepth_workflow import copy_workflow
+from zdepth_workflow import load_workflow_template
+from zdepth_workflow import result_path
+
 
 COMFYUI_WORKFLOW_NAME = "ComfyUI ZDepth Marigold"
 COMFYUI_OPERATOR_NAME = "zdepth_marigold"
@@ -36,6 +64,17 @@ UI_NREPEAT_BATCH_SIZE = "N Repeat Batch Size"
 UI_USE_FP16 = "Use FP16"
 UI_SCHEDULER = "Scheduler"
 UI_NORMALIZE = "Normalize"
+UI_SEQUENCE_MODE = "Sequence Mode"
+UI_SEQUENCE_DENOISE_STEPS = "Sequence Denoise Steps"
+UI_CUT_THRESHOLD = "Cut Threshold"
+UI_TARGET_SECONDS = "Target Seconds"
+UI_MIN_DENOISE_STEPS = "Min Denoise Steps"
+UI_MIN_NREPEAT = "Min N Repeat"
+UI_SEED = "Seed"
+UI_MEMBER_STORE = "Member Store"
+
+MARIGOLD_CLASS_TYPE = "MarigoldDepthEstimation"
+MARIGOLD_VIDEO_CLASS_TYPE = "MarigoldDepthEstimationVideo"
 
 DEFAULT_DENOISE_STEPS = 10
 DEFAULT_N_REPEAT = 10
@@ -49,14 +88,30 @@ DEFAULT_NREPEAT_BATCH_SIZE = 2
 DEFAULT_USE_FP16 = True
 DEFAULT_SCHEDULER = "DDIMScheduler"
 DEFAULT_NORMALIZE = True
+DEFAULT_SEQUENCE_MODE = False
+DEFAULT_SEQUENCE_DENOISE_STEPS = 4
+DEFAULT_FLOW_DEPTH_MIX = 0.3
+DEFAULT_NOISE_RATIO = 0.1
+DEFAULT_TARGET_SECONDS = 0
+DEFAULT_SEED = 259249863114226
+DEFAULT_MEMBER_STORE = False
+MAX_SEED = 2 ** 50
+DEFAULT_MIN_DENOISE_STEPS = 2
+DEFAULT_MIN_NREPEAT = 1
+
+PREVIEW_DENOISE_STEPS = 4
 
+BUDGET_LOG_FILENAME = "zdepth_budget.jsonl"
 
-class ComfyuiZDMG(pybox_comfyui.ComfyUIBaseClass):
+
+class ComfyuiZDMG(pybox_comfyui_zdepth.ComfyUIZDepthBaseClass):
     operator_name = COMFYUI_OPERATOR_NAME
     operator_layers = [LayerIn.FRONT, LayerOut.RESULT]
     
     version = 1
     
+    tile_size = 768
+    
     workflow_marigold_depth_estimation_idx = -1
     workflow_denoise_steps_idx = -1
     workflow_nrepeat_idx = -1
@@ -83,6 +138,16 @@ class ComfyuiZDMG(pybox_comfyui.ComfyUIBaseClass):
     use_fp16 = DEFAULT_USE_FP16
     scheduler = DEFAULT_SCHEDULER
     normalize = DEFAULT_NORMALIZE
+    sequence_mode = DEFAULT_SEQUENCE_MODE
+    sequence_denoise_steps = DEFAULT_SEQUENCE_DENOISE_STEPS
+    target_seconds = DEFAULT_TARGET_SECONDS
+    budget_active = False
+    min_denoise_steps = DEFAULT_MIN_DENOISE_STEPS
+    min_n_repeat = DEFAULT_MIN_NREPEAT
+    seed = DEFAULT_SEED
+    member_store = DEFAULT_MEMBER_STORE
+    
+    workflow_marigold_node = None
 
     schedulers = ["DDIMScheduler", 
                 "DDPMScheduler",
@@ -96,6 +161,7 @@ class ComfyuiZDMG(pybox_comfyui.ComfyUIBaseClass):
     # Overrided functions from pybox_comfyui.ComfyUIBaseClass
     
     
+    @traced("initialize")
     def initialize(self):
         super().initialize()
         
@@ -109,17 +175,20 @@ class ComfyuiZDMG(pybox_comfyui.ComfyUIBaseClass):
         self.set_state_id("execute")
     
     
+    @traced("execute")
     def execute(self):
         super().execute()
         
         if self.out_frame_requested():
-                self.submit_workflow()
+            self.request_frame(self.get_frame())
         
         if self.get_global_element_value(UI_INTERRUPT):
             self.interrupt_workflow()
+            self.clear_pending_frames()
 
         self.update_workflow_execution()
         self.update_outputs(layers=self.operator_layers)
+        self.frame_results_ready()
     
     
     def teardown(self):
@@ -141,6 +210,9 @@ class ComfyuiZDMG(pybox_comfyui.ComfyUIBaseClass):
             "Server & Workflow", "", "Parameters", "", "Action"
             )
         pages.append(page)
+        pages.append(self.create_performance_page("Sequence", "Time Budget"))
+        pages.append(self.create_post_page())
+        pages.append(self.create_io_page())
         self.set_ui_pages_array(pages)
         
         col = 0
@@ -176,6 +248,15 @@ class ComfyuiZDMG(pybox_comfyui.ComfyUIBaseClass):
             )
         self.add_global_elements(max_iter)
         
+        seed = pybox.create_float_numeric(
+            UI_SEED, 
+            value=self.seed, 
+            default=DEFAULT_SEED, 
+            min=0, max=MAX_SEED, inc=1,
+            row=3, col=col, tooltip="Seed of the first ensemble member, the next ones follow",
+            )
+        self.add_global_elements(seed)
+        
         col = 2
         regularizer_strength = pybox.create_float_numeric(
             UI_REGULARIZER_STRENGTH, 
@@ -259,6 +340,99 @@ class ComfyuiZDMG(pybox_comfyui.ComfyUIBaseClass):
         self.ui_processing_color_row = 3
         self.ui_processing_color_col = col
         self.set_ui_processing_color(Color.GRAY, self.ui_processing)
+        
+        # Performance page
+        col = 0
+        self.set_ui_batch_frames(row=0, col=col)
+        self.set_ui_shared_memory(row=1, col=col)
+        self.set_ui_tiled(row=2, col=col)
+        
+        col = 1
+        self.set_ui_cache_size(row=0, col=col)
+        self.set_ui_output_format(row=1, col=col)
+        
+        col = 2
+        self.set_ui_in_flight(row=0, col=col)
+        self.set_ui_preview(row=2, col=col)
+        
+        col = 3
+        sequence_mode = pybox.create_toggle_button(
+            UI_SEQUENCE_MODE, 
+            self.sequence_mode, 
+            default=DEFAULT_SEQUENCE_MODE,
+            row=0, col=col, page=pybox_comfyui_zdepth.UI_PERFORMANCE_PAGE,
+            tooltip="Warm start each frame of a batch window from the previous one"
+            )
+        self.add_global_elements(sequence_mode)
+        
+        sequence_denoise_steps = pybox.create_float_numeric(
+            UI_SEQUENCE_DENOISE_STEPS, 
+            value=self.sequence_denoise_steps, 
+            default=DEFAULT_SEQUENCE_DENOISE_STEPS, 
+            min=1, max=100, inc=1,
+            row=1, col=col, page=pybox_comfyui_zdepth.UI_PERFORMANCE_PAGE,
+            tooltip="Denoise steps of the warm started frames",
+            )
+        self.add_global_elements(sequence_denoise_steps)
+        
+        cut_threshold = pybox.create_float_numeric(
+            UI_CUT_THRESHOLD, 
+            value=self.cut_threshold, 
+            default=pybox_comfyui_zdepth.DEFAULT_CUT_THRESHOLD, 
+            min=0, max=2, inc=0.01,
+            row=2, col=col, page=pybox_comfyui_zdepth.UI_PERFORMANCE_PAGE,
+            tooltip="Front difference starting a new full ensemble",
+            )
+        self.add_global_elements(cut_threshold)
+        
+        self.set_ui_hold_tolerance(row=3, col=col)
+        
+        col = 4
+        target_seconds = pybox.create_float_numeric(
+            UI_TARGET_SECONDS, 
+            value=self.target_seconds, 
+            default=DEFAULT_TARGET_SECONDS, 
+            min=0, max=600, inc=1,
+            row=0, col=col, page=pybox_comfyui_zdepth.UI_PERFORMANCE_PAGE,
+            tooltip="Target seconds per frame, 0 keeps the parameters fixed",
+            )
+        self.add_global_elements(target_seconds)
+        
+        min_denoise_steps = pybox.create_float_numeric(
+            UI_MIN_DENOISE_STEPS, 
+            value=self.min_denoise_steps, 
+            default=DEFAULT_MIN_DENOISE_STEPS, 
+            min=1, max=100, inc=1,
+            row=1, col=col, page=pybox_comfyui_zdepth.UI_PERFORMANCE_PAGE,
+            tooltip="Lowest denoise steps the time budget can use",
+            )
+        self.add_global_elements(min_denoise_steps)
+        
+        min_n_repeat = pybox.create_float_numeric(
+            UI_MIN_NREPEAT, 
+            value=self.min_n_repeat, 
+            default=DEFAULT_MIN_NREPEAT, 
+            min=1, max=100, inc=1,
+            row=2, col=col, page=pybox_comfyui_zdepth.UI_PERFORMANCE_PAGE,
+            tooltip="Lowest n repeat the time budget can use",
+            )
+        self.add_global_elements(min_n_repeat)
+        
+        member_store = pybox.create_toggle_button(
+            UI_MEMBER_STORE, 
+            self.member_store, 
+            default=DEFAULT_MEMBER_STORE,
+            row=3, col=col, page=pybox_comfyui_zdepth.UI_PERFORMANCE_PAGE,
+            tooltip="Keep every ensemble member: only missing members are computed",
+            )
+        self.add_global_elements(member_store)
+        
+        # Post page, invert and normalize are the Parameters ones
+        self.set_ui_post_process(invert_normalize=False)
+        
+        # I/O page
+        self.set_ui_stream(row=0, col=0)
+        self.set_ui_prefetch(row=0, col=1)
     
     
     def set_models(self):
@@ -267,119 +441,440 @@ class ComfyuiZDMG(pybox_comfyui.ComfyUIBaseClass):
     ###################################
     # Workflow
     
+    @traced("load_workflow")
     def load_workflow(self):
-        with open(self.workflow_path) as f:
-            print("Loading Workflow")
-            self.workflow = json.load(f)
-            self.workflow_id_to_class_type = {id: details['class_type'] for id, details in self.workflow.items()}
-            # load & save 
-            self.workflow_load_exr_front_idx = self.get_workflow_index('LoadEXR')
-            wf_ids_to_classes = self.workflow_id_to_class_type.items()
-            save_exr_nodes = [(key, self.workflow.get(key)["inputs"]) for key, value in wf_ids_to_classes if value == 'SaveEXR']
-            self.workflow_save_exr_result_idx = [key for (key, attr) in save_exr_nodes if attr["filename_prefix"] == "Result"][0]
-            # paramaters
-            self.workflow_marigold_depth_estimation_idx = self.get_workflow_index('MarigoldDepthEstimation')
-            self.denoise_steps = self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["denoise_steps"]
-            self.n_repeat = self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["n_repeat"]
-            self.regularizer_strength = self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["regularizer_strength"]
-            self.reduction_method = self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["reduction_method"]
-            self.max_iter = self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["max_iter"]
-            self.tol = self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["tol"]
-            self.invert = self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["invert"]
-            self.keep_model_loaded = self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["keep_model_loaded"]
-            self.n_repeat_batch_size = self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["n_repeat_batch_size"]
-            self.use_fp16 = self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["use_fp16"]
-            self.scheduler = self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["scheduler"]
-            self.normalize = self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["normalize"]
-            
-            self.out_frame_pad = self.workflow.get(self.workflow_save_exr_result_idx)["inputs"]["frame_pad"]
+        print("Loading Workflow")
+        template = load_workflow_template(self.workflow_path)
+        self.workflow = template.instantiate()
+        self.workflow_id_to_class_type = template.id_to_class_type
+        # load & save 
+        self.workflow_load_exr_front_idx = template.index('LoadEXR')
+        self.workflow_save_exr_result_idx = template.save_exr_index("Result")
+        # paramaters
+        self.workflow_marigold_depth_estimation_idx = template.index('MarigoldDepthEstimation')
+        inputs = self.marigold_inputs()
+        self.denoise_steps = inputs["denoise_steps"]
+        self.n_repeat = inputs["n_repeat"]
+        self.regularizer_strength = inputs["regularizer_strength"]
+        self.reduction_method = inputs["reduction_method"]
+        self.max_iter = inputs["max_iter"]
+        self.tol = inputs["tol"]
+        self.invert = inputs["invert"]
+        self.keep_model_loaded = inputs["keep_model_loaded"]
+        self.n_repeat_batch_size = inputs["n_repeat_batch_size"]
+        self.use_fp16 = inputs["use_fp16"]
+        self.scheduler = inputs["scheduler"]
+        self.normalize = inputs["normalize"]
+        self.seed = inputs["seed"]
+        
+        self.out_frame_pad = self.workflow.get(self.workflow_save_exr_result_idx)["inputs"]["frame_pad"]
+    
+    
+    def marigold_inputs(self):
+        return self.workflow[self.workflow_marigold_depth_estimation_idx]["inputs"]
     
     
     def set_workflow_denoise_steps(self):
         if self.workflow:  
             self.denoise_steps = int(self.get_global_element_value(UI_DENOISE_STEPS))
-            self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["denoise_steps"] = self.denoise_steps
+            self.marigold_inputs()["denoise_steps"] = self.denoise_steps
             print(f'Workflow Denoise steps: {self.denoise_steps}')
     
     
     def set_workflow_nrepeat(self):
         if self.workflow:  
             self.n_repeat = int(self.get_global_element_value(UI_NREPEAT))
-            self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["n_repeat"] = self.n_repeat
+            self.marigold_inputs()["n_repeat"] = self.n_repeat
             print(f'Workflow N Repeat: {self.n_repeat}')
     
     
     def set_workflow_reduction_method(self):
         if self.workflow:  
             self.reduction_method = self.reduction_methods[int(self.get_global_element_value(UI_REDUCTION_METHOD))]
-            self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["reduction_method"] = self.reduction_method
+            self.marigold_inputs()["reduction_method"] = self.reduction_method
             print(f'Workflow Reduction method: {self.reduction_method}')
     
     
     def set_workflow_regularizer_strength(self):
         if self.workflow:  
             self.regularizer_strength = self.get_global_element_value(UI_REGULARIZER_STRENGTH)
-            self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["regularizer_strength"] = self.regularizer_strength
+            self.marigold_inputs()["regularizer_strength"] = self.regularizer_strength
             print(f'Workflow Regularizer strength: {self.regularizer_strength}')
     
     
     def set_workflow_max_iter(self):
         if self.workflow:  
             self.max_iter = int(self.get_global_element_value(UI_MAX_ITER))
-            self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["max_iter"] = self.max_iter
+            self.marigold_inputs()["max_iter"] = self.max_iter
             print(f'Workflow Max iter: {self.max_iter}')
     
     
     def set_workflow_tol(self):
         if self.workflow:  
             self.tol = self.get_global_element_value(UI_TOL)
-            self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["tol"] = self.tol
+            self.marigold_inputs()["tol"] = self.tol
             print(f'Workflow Tolerance: {self.tol}')
     
 
     def set_workflow_invert(self):
         if self.workflow:  
             self.invert = self.get_global_element_value(UI_INVERT)
-            self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["invert"] = self.invert
+            # Inverted locally on the raw depth when possible
+            self.marigold_inputs()["invert"] = self.invert and not self.post_process_enabled()
             print(f'Workflow Invert: {self.invert}')
     
     
     def set_workflow_keep_model_loaded(self):
         if self.workflow:  
             self.keep_model_loaded = self.get_global_element_value(UI_KEEP_MODEL_LOADED)
-            self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["keep_model_loaded"] = self.keep_model_loaded
+            self.marigold_inputs()["keep_model_loaded"] = self.keep_model_loaded
             print(f'Workflow Keep model loaded: {self.keep_model_loaded}')
     
     
     def set_workflow_n_repeat_batch_size(self):
         if self.workflow:  
             self.n_repeat_batch_size = int(self.get_global_element_value(UI_KEEP_MODEL_LOADED))
-            self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["n_repeat_batch_size"] = self.n_repeat_batch_size
+            self.marigold_inputs()["n_repeat_batch_size"] = self.n_repeat_batch_size
             print(f'Workflow N Repeat batch size: {self.n_repeat_batch_size}')
     
     
     def set_workflow_use_fp16(self):
         if self.workflow:  
             self.use_fp16 = self.get_global_element_value(UI_USE_FP16)
-            self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["use_fp16"] = self.use_fp16
+            self.marigold_inputs()["use_fp16"] = self.use_fp16
             print(f'Workflow Use FP16: {self.use_fp16}')
     
     
     def set_workflow_scheduler(self):
         if self.workflow:  
             self.scheduler = self.schedulers[int(self.get_global_element_value(UI_SCHEDULER))]
-            self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["scheduler"] = self.scheduler
+            self.marigold_inputs()["scheduler"] = self.scheduler
             print(f'Workflow Scheduler: {self.scheduler}')
             
     
     def set_workflow_normalize(self):
         if self.workflow:  
             self.normalize = self.get_global_element_value(UI_NORMALIZE)
-            self.workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]["normalize"] = self.normalize
+            self.marigold_inputs()["normalize"] = self.normalize and not self.post_process_enabled()
             print(f'Workflow Normalize: {self.normalize}')
             
     
+    def set_workflow_seed(self):
+        if self.workflow:  
+            self.seed = int(self.get_global_element_value(UI_SEED))
+            self.marigold_inputs()["seed"] = self.seed
+            print(f'Workflow Seed: {self.seed}')
+            
+    
+    def get_post_invert_normalize(self):
+        self.invert = self.get_global_element_value(UI_INVERT)
+        self.normalize = self.get_global_element_value(UI_NORMALIZE)
+        return bool(self.invert), bool(self.normalize)
+    
+    
+    def get_cut_threshold(self):
+        self.cut_threshold = self.get_global_element_value(UI_CUT_THRESHOLD)
+        return self.cut_threshold
+    
+    
+    def split_batch_window(self, window):
+        # Cuts are found from the Front pixels, read with OpenImageIO
+        if not self.get_global_element_value(UI_SEQUENCE_MODE) or oiio is None:
+            return window
+        
+        # Scene cuts and large changes start a new window, so their first
+        # frame gets the full ensemble
+        sequence = self.front_sequence()
+        previous = self.front_signature(sequence[window[0]])
+        for i, frame in enumerate(window[1:], 1):
+            signature = self.front_signature(sequence[frame])
+            if signature_distance(previous, signature) > self.get_cut_threshold():
+                print(f'Workflow sequence cut at frame {frame}')
+                return window[:i]
+            previous = signature
+        return window
+    
+    
+    def restore_workflow_marigold_node(self):
+        # Put back the per frame node a previous window replaced
+        if self.workflow_marigold_node is not None:
+            self.workflow[self.workflow_marigold_depth_estimation_idx] = self.workflow_marigold_node
+            self.workflow_marigold_node = None
+    
+    
+    def set_workflow_sequence_mode(self):
+        self.sequence_mode = self.get_global_element_value(UI_SEQUENCE_MODE)
+        if not self.sequence_mode or len(self.batch_window_frames) <= 1:
+            return
+        
+        self.sequence_denoise_steps = int(self.get_global_element_value(UI_SEQUENCE_DENOISE_STEPS))
+        inputs = self.marigold_inputs()
+        self.workflow_marigold_node = self.workflow[self.workflow_marigold_depth_estimation_idx]
+        self.workflow[self.workflow_marigold_depth_estimation_idx] = {
+            "class_type": MARIGOLD_VIDEO_CLASS_TYPE,
+            "inputs": {
+                "seed": inputs["seed"],
+                "first_frame_denoise_steps": inputs["denoise_steps"],
+                "first_frame_n_repeat": inputs["n_repeat"],
+                "n_repeat_batch_size": inputs["n_repeat_batch_size"],
+                "invert": inputs["invert"],
+                "keep_model_loaded": inputs["keep_model_loaded"],
+                "scheduler": inputs["scheduler"],
+                "normalize": inputs["normalize"],
+                "denoise_steps": self.sequence_denoise_steps,
+                "flow_warping": True,
+                "flow_depth_mix": DEFAULT_FLOW_DEPTH_MIX,
+                "noise_ratio": DEFAULT_NOISE_RATIO,
+                "dtype": "fp16" if inputs["use_fp16"] else "fp32",
+                "image": inputs["image"],
+                },
+            }
+        print(f'Workflow sequence mode: {len(self.batch_window_frames)} frames, '
+              f'{self.sequence_denoise_steps} denoise steps after the first')
+    
+    
+    def set_workflow_time_budget(self):
+        # Denoise Steps and N Repeat become the upper bounds of the budget
+        self.budget_active = False
+        self.target_seconds = self.get_global_element_value(UI_TARGET_SECONDS)
+        if self.target_seconds <= 0 or len(self.batch_window_frames) > 1:
+            return
+        if self.preview_enabled():
+            # Preview timings would skew the cost model
+            return
+        
+        self.min_denoise_steps = min(self.denoise_steps, int(self.get_global_element_value(UI_MIN_DENOISE_STEPS)))
+        self.min_n_repeat = min(self.n_repeat, int(self.get_global_element_value(UI_MIN_NREPEAT)))
+        budget = TimeBudget(self.load_state().setdefault("budget", {}))
+        denoise_steps, n_repeat = budget.choose(
+            self.target_seconds, 
+            (self.min_denoise_steps, self.denoise_steps), 
+            (self.min_n_repeat, self.n_repeat),
+            )
+        
+        inputs = self.marigold_inputs()
+        inputs["denoise_steps"] = denoise_steps
+        inputs["n_repeat"] = n_repeat
+        inputs["n_repeat_batch_size"] = min(inputs["n_repeat_batch_size"], n_repeat)
+        self.budget_active = True
+        print(f'Workflow time budget {self.target_seconds}s: denoise steps {denoise_steps}, n repeat {n_repeat}')
+    
+    
+    def base_submission(self):
+        # Budgeted frames are timed from their prompt, which only in
+        # flight frames know
+        return super().base_submission() and not self.budget_active
+    
+    
+    def queue_frames(self, frame_workflows, exclude=(), priority=PRIORITY_INTERACTIVE):
+        queued = time.time()
+        super().queue_frames(frame_workflows, exclude, priority)
+        if not self.budget_active:
+            return
+        
+        # Only frames actually submitted teach the budget: held and cached
+        # frames never get here. Member workflows hold one single member
+        # Marigold node per seed.
+        in_flight = self.state.get("in_flight", {})
+        pending = self.state["budget"].setdefault("pending", {})
+        for frame, workflow in frame_workflows:
+            entry = in_flight.get(str(frame))
+            marigolds = [
+                details["inputs"] for details in workflow.values()
+                if details["class_type"] == MARIGOLD_CLASS_TYPE
+                ]
+            if entry is None or entry[3] < queued or not marigolds:
+                continue
+            prompt_id, result_path, address, submitted = entry
+            pending[str(frame)] = [
+                prompt_id, address, submitted,
+                marigolds[0]["denoise_steps"], sum(inputs["n_repeat"] for inputs in marigolds),
+                result_path,
+                ]
+        self.save_state()
+    
+    
+    def update_time_budget(self):
+        # Seconds the server spent on the prompt, from its completion
+        # event or its history: queueing and hand-off are not counted
+        budget_state = self.load_state().get("budget")
+        if not budget_state or not budget_state.get("pending"):
+            return
+        
+        budget = TimeBudget(budget_state)
+        pending = budget_state["pending"]
+        pool = self.get_server_pool()
+        for frame, (prompt_id, address, submitted, denoise_steps, n_repeat, result_path) in list(pending.items()):
+            server = pool.server(address)
+            try:
+                finished, seconds = server.execution_seconds(prompt_id, submitted) if server else (True, None)
+            except ComfyUIServerError as e:
+                print(f'Unable to get prompt execution time: {e}')
+                finished, seconds = True, None
+            if not finished:
+                continue
+            del pending[frame]
+            if seconds is None:
+                continue
+            budget.record(seconds, denoise_steps, n_repeat)
+            self.log_time_budget(Path(result_path).parent, {
+                "frame": int(frame),
+                "target_seconds": self.get_global_element_value(UI_TARGET_SECONDS),
+                "seconds": round(seconds, 3),
+                "denoise_steps": denoise_steps,
+                "n_repeat": n_repeat,
+                "unit_cost": budget_state["unit_cost"],
+                })
+        self.save_state()
+    
+    
+    def log_time_budget(self, output_dir, entry):
+        try:
+            with open(output_dir / BUDGET_LOG_FILENAME, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+        except OSError as e:
+            print(f'Unable to log time budget: {e}')
+    
+    
+    ###################################
+    # Ensemble members
+    
+    def member_store_enabled(self):
+        # Members are read and reduced locally, which needs OpenImageIO
+        self.member_store = self.get_global_element_value(UI_MEMBER_STORE)
+        return self.member_store and oiio is not None
+    
+    
+    def get_member_store(self):
+        return MemberStore(max_bytes=self.get_depth_cache().max_bytes)
+    
+    
+    def ensemble_key(self, store, front_path):
+        # Members only depend on the Front and the per member parameters
+        workflow = self.cache_workflow()
+        inputs = workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]
+        for name in ENSEMBLE_INPUTS:
+            inputs.pop(name, None)
+        return store.key(front_path, workflow)
+    
+    
+    def member_workflow(self, frame, seeds):
+        # One single member Marigold node and one SaveEXR per seed, all
+        # reading the same Front
+        workflow = copy_workflow(self.workflow)
+        marigold = workflow.pop(self.workflow_marigold_depth_estimation_idx)
+        save_exr = workflow.pop(self.workflow_save_exr_result_idx)
+        for seed in seeds:
+            marigold_id = f"{self.workflow_marigold_depth_estimation_idx}_{seed}"
+            workflow[marigold_id] = dict(
+                marigold, 
+                inputs=dict(marigold["inputs"], seed=seed, n_repeat=1, n_repeat_batch_size=1),
+                )
+            workflow[f"{self.workflow_save_exr_result_idx}_{seed}"] = dict(
+                save_exr, 
+                inputs=dict(
+                    save_exr["inputs"], 
+                    images=[marigold_id, 0], 
+                    filename_prefix=f"{self.result_filename_prefix()}_member_{seed}", 
+                    start_frame=frame,
+                    ),
+                )
+        return workflow
+    
+    
+    def submit_member_frame(self, frame):
+        front_path = self.front_filepath()
+        store = self.get_member_store()
+        ensemble_key = self.ensemble_key(store, front_path)
+        inputs = self.marigold_inputs()
+        seeds = member_seeds(self.seed, int(inputs["n_repeat"]))
+        member_paths = [
+            result_path(f"{self.result_filename_prefix()}_member_{seed}", frame, self.out_frame_pad)
+            for seed in seeds
+            ]
+        missing = [
+            seed for seed, path in zip(seeds, member_paths)
+            if not store.fetch(member_key(ensemble_key, seed), path)
+            ]
+        
+        state = self.load_state()
+        state.setdefault("members", {})[str(frame)] = {
+            "ensemble_key": ensemble_key,
+            "seeds": seeds,
+            "paths": [str(path) for path in member_paths],
+            "reduction_method": inputs["reduction_method"],
+            "regularizer_strength": inputs["regularizer_strength"],
+            "max_iter": inputs["max_iter"],
+            "tol": inputs["tol"],
+            }
+        self.save_state()
+        print(f'Workflow frame {frame}: {len(seeds) - len(missing)} stored members, {len(missing)} to compute')
+        
+        if missing:
+            self.queue_frames([(frame, self.member_workflow(frame, missing))])
+        else:
+            self.update_members()
+    
+    
+    def update_members(self):
+        members = self.load_state().get("members")
+        if not members:
+            return
+        
+        store = None
+        for frame, ensemble in list(members.items()):
+            member_paths = [Path(path) for path in ensemble["paths"]]
+            if not all(path.is_file() for path in member_paths):
+                continue
+            store = store or self.get_member_store()
+            for seed, path in zip(ensemble["seeds"], member_paths):
+                store.store(member_key(ensemble["ensemble_key"], seed), path)
+            depth = ensemble_depths(
+                [read_exr(path)[..., 0] for path in member_paths],
+                ensemble["reduction_method"], 
+                ensemble["regularizer_strength"], 
+                int(ensemble["max_iter"]), 
+                ensemble["tol"],
+                )
+            self.write_result(self.depth_filepath(int(frame)), depth)
+            self.post_process_result(int(frame))
+            for path in member_paths:
+                path.unlink()
+            del members[frame]
+            print(f'Workflow frame {frame}: {len(member_paths)} members reduced by {ensemble["reduction_method"]}')
+        self.save_state()
+    
+    
+    def submit_frame_workflow(self, frame):
+        if (len(self.batch_window_frames) <= 1 and self.member_store_enabled()
+                and not self.preview_enabled() and not self.tiled_enabled()):
+            self.submit_member_frame(frame)
+            return
+        super().submit_frame_workflow(frame)
+    
+    
+    def frame_results_ready(self):
+        self.update_members()
+        super().frame_results_ready()
+        self.update_time_budget()
+    
+    
+    def preview_parameters(self, workflow):
+        inputs = workflow.get(self.workflow_marigold_depth_estimation_idx)["inputs"]
+        inputs["denoise_steps"] = min(inputs["denoise_steps"], PREVIEW_DENOISE_STEPS)
+        inputs["n_repeat"] = 1
+        inputs["n_repeat_batch_size"] = 1
+    
+    
+    def server_affinity(self):
+        if not self.keep_model_loaded:
+            return None
+        return 'marigold_fp16' if self.use_fp16 else 'marigold_fp32'
+    
+    
+    @traced("workflow_setup")
     def workflow_setup(self):
+        self.restore_workflow_marigold_node()
         self.set_workflow_denoise_steps()
         self.set_workflow_nrepeat()
         self.set_workflow_reduction_method()
@@ -392,9 +887,14 @@ class ComfyuiZDMG(pybox_comfyui.ComfyUIBaseClass):
         self.set_workflow_use_fp16()
         self.set_workflow_scheduler()
         self.set_workflow_normalize()
+        self.set_workflow_seed()
         
         self.set_workflow_load_exr_filepath()
         self.set_workflow_save_exr_filename_prefix(layers=self.operator_layers)
+        self.set_workflow_batch_window()
+        self.set_workflow_stream_window()
+        self.set_workflow_sequence_mode()
+        self.set_workflow_time_budget()
     
     
     
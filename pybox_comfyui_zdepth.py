@@ -0,0 +1,1776 @@
+##########################################################################
+#
+# Filename: pybox_comfyui_zdepth.py
+#
+# Author: Julien Martin
+# Created: 2024-03
+#
+###########################################################################
+from __future__ import print_function
+
+import os
+import re
+import copy
+import json
+import shutil
+import time
+import socket
+import hashlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import pybox_v1 as pybox
+import pybox_comfyui
+
+from pybox_comfyui import UI_HOST_INFO
+
+from zdepth_cache import DepthCache
+from zdepth_cache import link_or_copy
+from zdepth_events import ensure_event_relay
+from zdepth_image import frame_signature
+from zdepth_image import is_identity_post_process
+from zdepth_image import oiio
+from zdepth_image import post_process
+from zdepth_image import linear_to_srgb
+from zdepth_image import read_exr
+from zdepth_image import signature_distance
+from zdepth_image import srgb_to_linear
+from zdepth_image import write_exr
+from zdepth_paths import private_dir
+from zdepth_paths import prune_files
+from zdepth_prefetch import RESULT_RING
+from zdepth_prefetch import file_signature
+from zdepth_server import COMFYUI_ZDEPTH_SERVERS
+from zdepth_server import ComfyUIServerError
+from zdepth_server import ServerPool
+from zdepth_server import server_address
+from zdepth_scheduler import PRIORITY_BATCH
+from zdepth_scheduler import PRIORITY_INTERACTIVE
+from zdepth_scheduler import SchedulerClient
+from zdepth_scheduler import ensure_scheduler
+from zdepth_shm import SharedFrame
+from zdepth_shm import unlink_shared_frame
+from zdepth_tiles import blend_tiles
+from zdepth_tiles import resize
+from zdepth_tiles import split_tiles
+from zdepth_tiles import tile_boxes
+from zdepth_trace import TRACER
+from zdepth_trace import traced
+from zdepth_workflow import copy_workflow
+from zdepth_workflow import frame_from_path
+from zdepth_workflow import result_path
+from zdepth_workflow import sequence_pattern
+
+
+UI_BATCH_FRAMES = "Batch Frames"
+UI_CACHE_SIZE = "Cache Size (GB)"
+UI_IN_FLIGHT = "In Flight"
+UI_QUEUE_DEPTH = "Queue Depth"
+UI_SHARED_MEMORY = "Shared Memory"
+UI_TILED = "Tiled"
+UI_TILE_OVERLAP = "Tile Overlap"
+UI_PREVIEW = "Preview"
+UI_PREVIEW_SCALE = "Preview Scale"
+UI_SINGLE_CHANNEL = "Single Channel"
+UI_HALF_FLOAT = "Half Float"
+UI_COMPRESSION = "Compression"
+UI_HOLD_TOLERANCE = "Hold Tolerance"
+UI_NEAR = "Near"
+UI_FAR = "Far"
+UI_CLAMP = "Clamp"
+UI_GAMMA = "Gamma"
+UI_POST_NORMALIZE = "Depth Normalize"
+UI_POST_INVERT = "Depth Invert"
+UI_STREAM_FRAMES = "Stream Frames"
+UI_PREFETCH_DEPTH = "Prefetch Depth"
+UI_PREFETCH_HIT_RATE = "Prefetch Hit Rate"
+
+UI_PERFORMANCE_PAGE = 1
+UI_POST_PAGE = 2
+UI_IO_PAGE = 3
+
+DEFAULT_BATCH_FRAMES = 1
+MAX_BATCH_FRAMES = 100
+DEFAULT_CACHE_SIZE = 10
+MAX_CACHE_SIZE = 1000
+DEFAULT_IN_FLIGHT = 1
+MAX_IN_FLIGHT = 16
+MAX_SIGNATURES = 256
+DEFAULT_SHARED_MEMORY = False
+DEFAULT_TILED = False
+DEFAULT_TILE_SIZE = 518
+DEFAULT_TILE_OVERLAP = 64
+DEFAULT_PREVIEW = False
+DEFAULT_PREVIEW_SCALE = 0.25
+DEFAULT_SINGLE_CHANNEL = False
+DEFAULT_HALF_FLOAT = False
+DEFAULT_COMPRESSION = "ZIP"
+COMPRESSIONS = ["ZIP", "PIZ", "DWAA", "None"]
+DEFAULT_HOLD_TOLERANCE = 0
+MAX_HOLD_TOLERANCE = 0.25
+DEFAULT_CUT_THRESHOLD = 0.25
+DEFAULT_NEAR = 0.0
+DEFAULT_FAR = 1.0
+DEFAULT_CLAMP = False
+DEFAULT_GAMMA = 1.0
+DEFAULT_POST_NORMALIZE = False
+DEFAULT_POST_INVERT = False
+DEFAULT_STREAM_FRAMES = 0
+MAX_STREAM_FRAMES = 256
+MAX_STREAM_GENERATIONS = 4
+DEFAULT_PREFETCH_DEPTH = 0
+MAX_PREFETCH_DEPTH = 64
+
+LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1", socket.gethostname(), socket.getfqdn()}
+
+VERSION_SUFFIX = re.compile(r"[._-]?v?\d+$")
+
+
+class ComfyUIZDepthBaseClass(pybox_comfyui.ComfyUIBaseClass):
+
+    batch_frames = DEFAULT_BATCH_FRAMES
+    batch_window_frames = []
+    cache_size = DEFAULT_CACHE_SIZE
+    in_flight = DEFAULT_IN_FLIGHT
+    shared_memory = DEFAULT_SHARED_MEMORY
+    tiled = DEFAULT_TILED
+    tile_size = DEFAULT_TILE_SIZE
+    tile_overlap = DEFAULT_TILE_OVERLAP
+    preview = DEFAULT_PREVIEW
+    preview_scale = DEFAULT_PREVIEW_SCALE
+    single_channel = DEFAULT_SINGLE_CHANNEL
+    half_float = DEFAULT_HALF_FLOAT
+    compression = DEFAULT_COMPRESSION
+    hold_tolerance = DEFAULT_HOLD_TOLERANCE
+    cut_threshold = DEFAULT_CUT_THRESHOLD
+    near = DEFAULT_NEAR
+    far = DEFAULT_FAR
+    clamp = DEFAULT_CLAMP
+    gamma = DEFAULT_GAMMA
+    post_normalize = DEFAULT_POST_NORMALIZE
+    post_invert = DEFAULT_POST_INVERT
+    stream_frames = DEFAULT_STREAM_FRAMES
+    prefetch_depth = DEFAULT_PREFETCH_DEPTH
+
+    front_path = None
+    state = None
+    server_pool = None
+    result_prefix_set = False
+    window_key = None
+
+
+    ###########################################################################
+    # Overrided functions from pybox_comfyui.ComfyUIBaseClass
+
+    @traced("submit_workflow")
+    def submit_workflow(self):
+        super().submit_workflow()
+
+
+    def interrupt_workflow(self):
+        # Scheduled prompts are cancelled for this node only, prompts of
+        # other sessions keep running
+        pool = self.get_server_pool()
+        if pool.scheduled():
+            try:
+                pool.scheduler.interrupt()
+                print("Workflow scheduled prompts cancelled")
+                return
+            except ComfyUIServerError as e:
+                print(f'Unable to cancel scheduled prompts: {e}')
+        super().interrupt_workflow()
+
+
+    @traced("update_workflow_execution")
+    def update_workflow_execution(self):
+        super().update_workflow_execution()
+
+
+    @traced("update_outputs")
+    def update_outputs(self, layers):
+        self.record_readback()
+        super().update_outputs(layers=layers)
+
+
+    def set_workflow_load_exr_filepath(self):
+        super().set_workflow_load_exr_filepath()
+        # LoadEXR may then read a sequence directory, the Front stays
+        self.front_path = Path(self.workflow.get(self.workflow_load_exr_front_idx)["inputs"]["filepath"])
+
+
+    def set_workflow_save_exr_filename_prefix(self, layers):
+        super().set_workflow_save_exr_filename_prefix(layers=layers)
+        self.set_workflow_save_exr_format()
+        self.result_prefix_set = True
+
+
+    ###########################################################################
+    # State shared between pybox invocations
+
+    def node_key(self):
+        # One state per node and user: the Result prefix, less its version
+        # number, names the output of the node
+        if not self.workflow:
+            return None
+        if not self.result_prefix_set:
+            self.set_workflow_save_exr_filename_prefix(layers=self.operator_layers)
+        prefix = VERSION_SUFFIX.sub("", self.result_filename_prefix())
+        return hashlib.sha1(f"{self.operator_name}:{prefix}".encode()).hexdigest()[:16]
+
+
+    def state_path(self):
+        key = self.node_key()
+        if key is None:
+            return None
+        return private_dir("state", self.operator_name) / f"{key}.json"
+
+
+    def load_state(self):
+        if self.state is None:
+            try:
+                with open(self.state_path()) as f:
+                    self.state = json.load(f)
+            except (OSError, TypeError, ValueError):
+                self.state = {}
+        return self.state
+
+
+    def save_state(self):
+        if self.state is None:
+            return
+        try:
+            path = self.state_path()
+            if path is None:
+                return
+            tmp_path = path.with_suffix(".tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(self.state, f)
+            tmp_path.replace(path)
+        except OSError as e:
+            print(f'Unable to save workflow state: {e}')
+
+
+    ###########################################################################
+    # Paths
+
+    def front_filepath(self):
+        if self.front_path is not None:
+            return self.front_path
+        return Path(self.workflow.get(self.workflow_load_exr_front_idx)["inputs"]["filepath"])
+
+
+    def result_filename_prefix(self):
+        return self.workflow.get(self.workflow_save_exr_result_idx)["inputs"]["filename_prefix"]
+
+
+    def result_filepath(self, frame):
+        return result_path(self.result_filename_prefix(), frame, self.out_frame_pad)
+
+
+    def front_signature(self, front_path):
+        # Signatures are cached per Front file version: Flame rewrites the
+        # file when the upstream changes. They are kept one file per frame
+        # out of the state, which is rewritten on every exchange.
+        front_path = Path(front_path)
+        mtime = front_path.stat().st_mtime_ns
+        signatures_dir = private_dir("signatures", self.operator_name, self.node_key())
+        signature_path = signatures_dir / f"{front_path.name}.json"
+        try:
+            with open(signature_path) as f:
+                cached_mtime, signature = json.load(f)
+            if cached_mtime == mtime:
+                return signature
+        except (OSError, TypeError, ValueError):
+            pass
+
+        signature = [round(v, 4) for v in frame_signature(read_exr(front_path)).tolist()]
+        try:
+            tmp_path = signature_path.with_suffix(".tmp")
+            with open(tmp_path, "w") as f:
+                json.dump([mtime, signature], f)
+            tmp_path.replace(signature_path)
+            prune_files(signatures_dir, "*.json", MAX_SIGNATURES)
+        except OSError as e:
+            print(f'Unable to save Front signature: {e}')
+        return signature
+
+
+    def front_sequence(self):
+        # Frames of the Front sequence already written on the server mount,
+        # by frame number. The in directory is shared by every node of the
+        # operator: only files named like the Front belong to it.
+        front_path = self.front_filepath()
+        pattern = sequence_pattern(front_path)
+        sequence = {}
+        if pattern is None:
+            return sequence
+        try:
+            entries = list(os.scandir(front_path.parent))
+        except OSError:
+            return sequence
+        for entry in entries:
+            match = pattern.fullmatch(entry.name)
+            if match is not None and entry.is_file():
+                sequence[int(match.group(1))] = Path(entry.path)
+        return dict(sorted(sequence.items()))
+
+
+    ###########################################################################
+    # Server
+
+    def server_addresses(self):
+        # The host set in the UI, then the extra servers of the environment
+        addresses = [server_address(self.get_global_element_value(UI_HOST_INFO))]
+        addresses += [address for address in COMFYUI_ZDEPTH_SERVERS if address not in addresses]
+        return addresses
+
+
+    def get_server_pool(self):
+        if self.server_pool is None:
+            self.server_pool = ServerPool(self.server_addresses(), private_dir() / "servers.json")
+            for address in self.server_pool.servers:
+                ensure_event_relay(address)
+            if ensure_scheduler(self.server_pool.state_path):
+                self.server_pool.scheduler = SchedulerClient(self.scheduler_session())
+        return self.server_pool
+
+
+    def scheduler_session(self):
+        return f"{socket.gethostname()}/{self.operator_name}/{self.node_key()}"
+
+
+    def server_affinity(self):
+        # Key of the model state the workflow needs loaded on the server
+        return None
+
+
+    def server_is_local(self):
+        pool = self.get_server_pool()
+        return len(pool) == 1 and all(server.host in LOCAL_HOSTS for server in pool.servers.values())
+
+
+    def submit_frame_workflow(self, frame):
+        if len(self.batch_window_frames) <= 1 and self.preview_enabled():
+            self.submit_preview_frame(frame)
+            return
+
+        if len(self.batch_window_frames) <= 1:
+            workflow = self.tiled_workflow(frame) if self.tiled_enabled() else None
+            if workflow is None and self.shared_memory_enabled():
+                workflow = self.shared_memory_workflow(frame)
+            if workflow is not None:
+                self.queue_frames([(frame, workflow)])
+                return
+
+        # A single server is driven by the base class, a pool of servers
+        # gets the frame like any other in flight frame
+        if self.base_submission():
+            self.submit_workflow()
+            self.record_base_frames(self.batch_window_frames if len(self.batch_window_frames) > 1 else [frame])
+            return
+        self.queue_frames([(frame, copy_workflow(self.workflow))])
+
+
+    def base_submission(self):
+        # Raw depth goes to its own prefix, which only in flight frames know
+        pool = self.get_server_pool()
+        return len(pool) <= 1 and not pool.scheduled() and not self.post_process_enabled()
+
+
+    def record_base_frames(self, frames):
+        # The base class keeps its prompt to itself: its frames are known
+        # by their Result only, so the stream they read is kept meanwhile
+        base_frames = self.load_state().setdefault("base_frames", {})
+        now = time.time()
+        for frame in frames:
+            base_frames[str(frame)] = now
+        self.save_state()
+
+
+    def update_base_frames(self):
+        base_frames = self.load_state().get("base_frames")
+        if not base_frames:
+            return set()
+        for frame, submitted in list(base_frames.items()):
+            try:
+                if self.result_filepath(int(frame)).stat().st_mtime >= submitted:
+                    del base_frames[frame]
+            except OSError:
+                pass
+        return {int(frame) for frame in base_frames}
+
+
+    def clear_base_frames(self):
+        self.load_state().pop("base_frames", None)
+        self.save_state()
+
+
+    ###########################################################################
+    # UI
+
+    def create_performance_page(self, *columns):
+        return pybox.create_page(
+            "ZDepth Performance",
+            "Submission", "Cache & Output", "Pipeline", *columns
+            )
+
+
+    ###########################################################################
+    # Frame requests
+
+    def request_frame(self, frame):
+        # Pending frames are only those submitted with the current settings
+        self.preview_enabled()
+        self.workflow_setup()
+        front_path = self.front_filepath()
+        if self.frame_pending(frame, front_path) or self.frame_computed(frame, front_path):
+            return
+
+        if TRACER.enabled:
+            self.load_state()["trace_dir"] = str(self.result_filepath(frame).parent / "zdepth_trace")
+        if len(self.batch_window_frames) > 1:
+            self.link_batch_window()
+            self.submit_frame_workflow(frame)
+            self.register_batch(self.batch_window_frames)
+        elif not self.hold_frame(frame) and not self.fetch_cached_result(frame):
+            self.submit_frame_workflow(frame)
+
+        if not self.preview:
+            self.submit_upcoming_frames(frame)
+
+
+    def frame_pending(self, frame, front_path):
+        return self.batch_frame_pending(frame, front_path) or self.in_flight_frame_pending(frame, front_path)
+
+
+    def frame_computed(self, frame, front_path):
+        # Frames queued ahead or in a window leave the pending records
+        # once their Result lands. The Result stays done while it was
+        # submitted with the current settings, after the Front was written.
+        submissions = self.load_state().get("submissions")
+        if not submissions or submissions["key"] != self.window_key or str(frame) not in submissions["frames"]:
+            return False
+        try:
+            result_mtime = self.result_filepath(frame).stat().st_mtime
+            front_mtime = Path(front_path).stat().st_mtime
+        except OSError:
+            return False
+        return front_mtime <= min(result_mtime, submissions["frames"][str(frame)])
+
+
+    def record_submissions(self, frames):
+        # Per settings: a new workflow key forgets the earlier submissions
+        state = self.load_state()
+        submissions = state.get("submissions")
+        if submissions is None or submissions["key"] != self.window_key:
+            submissions = state["submissions"] = {"key": self.window_key, "frames": {}}
+        now = time.time()
+        for frame in frames:
+            submissions["frames"][str(frame)] = now
+        self.save_state()
+
+
+    def forget_submission(self, frame):
+        # Failed frames are submitted again when Flame requests them
+        submissions = self.load_state().get("submissions")
+        if submissions is not None:
+            submissions["frames"].pop(str(frame), None)
+
+
+    def frame_results_ready(self):
+        self.update_shared_frames()
+        self.update_tiled_frames()
+        self.update_previews()
+        self.store_cached_results()
+        self.update_raw_results()
+        self.update_batches()
+        self.update_in_flight()
+        self.prefetch_results()
+        self.reclaim_stream()
+        if TRACER.enabled and "trace_dir" in self.load_state():
+            # Spans of this pybox exchange are written when it exits
+            TRACER.set_output_dir(self.state["trace_dir"])
+
+
+    def clear_pending_frames(self):
+        self.clear_base_frames()
+        self.clear_batches()
+        self.clear_in_flight()
+        self.clear_shared_frames()
+        self.clear_tiled_frames()
+        self.clear_previews()
+
+
+    ###########################################################################
+    # Batched multi-frame submission
+
+    def set_ui_batch_frames(self, row, col):
+        batch_frames = pybox.create_float_numeric(
+            UI_BATCH_FRAMES,
+            value=self.batch_frames,
+            default=DEFAULT_BATCH_FRAMES,
+            min=1, max=MAX_BATCH_FRAMES, inc=1,
+            row=row, col=col, page=UI_PERFORMANCE_PAGE,
+            tooltip="Number of frames submitted in a single prompt",
+            )
+        self.add_global_elements(batch_frames)
+
+
+    def get_batch_frames(self):
+        self.batch_frames = max(1, int(self.get_global_element_value(UI_BATCH_FRAMES)))
+        return self.batch_frames
+
+
+    def workflow_key(self):
+        # Result prefix and parameters of the patched workflow, before the
+        # frame and window specific inputs
+        return hashlib.sha1(json.dumps(
+            [self.result_filename_prefix(), self.cache_workflow()], sort_keys=True
+            ).encode()).hexdigest()[:16]
+
+
+    def update_render(self, frame):
+        # A render is a run of consecutive frames requested with the same
+        # settings: Fronts written before it started are left over from an
+        # earlier render
+        try:
+            mtime = self.front_filepath().stat().st_mtime
+        except OSError:
+            return
+        state = self.load_state()
+        render = state.get("render")
+        if render is None or render["key"] != self.window_key or frame not in (render["frame"], render["frame"] + 1):
+            render = {"key": self.window_key, "start": mtime}
+            print(f'Workflow render from frame {frame}')
+        render["frame"] = frame
+        state["render"] = render
+        self.save_state()
+
+
+    def front_is_current(self, front_path):
+        render = self.load_state().get("render")
+        try:
+            return render is None or Path(front_path).stat().st_mtime >= render["start"]
+        except OSError:
+            return False
+
+
+    def front_newer_than(self, front_path, submitted):
+        try:
+            return Path(front_path).stat().st_mtime > submitted
+        except OSError:
+            return False
+
+
+    def batch_frame_pending(self, frame, front_path):
+        # The requested frame is already covered by a window submitted
+        # for an earlier frame with the same settings: its result only has
+        # to be picked up, unless Flame rewrote its Front since
+        batches = self.load_state().get("batches", [])
+        for batch in batches:
+            if batch["key"] != self.window_key or frame not in batch["frames"]:
+                continue
+            if not self.front_newer_than(front_path, batch["submitted"]):
+                return True
+            print(f'Workflow frame {frame} Front changed since its window was submitted')
+            self.drop_in_flight(batch["start"])
+            shutil.rmtree(batch["dir"], ignore_errors=True)
+            batches.remove(batch)
+            self.save_state()
+            return False
+        return False
+
+
+    def batched_frames(self):
+        return {frame for batch in self.load_state().get("batches", []) for frame in batch["frames"]}
+
+
+    def clear_batches(self):
+        for batch in self.load_state().get("batches", []):
+            shutil.rmtree(batch["dir"], ignore_errors=True)
+        self.state["batches"] = []
+        self.save_state()
+
+
+    def register_batch(self, window):
+        # Windows of other settings are never picked up again
+        state = self.load_state()
+        batches = []
+        for batch in state.get("batches", []):
+            if batch["key"] == self.window_key and not set(batch["frames"]) & set(window):
+                batches.append(batch)
+            elif batch["dir"] != str(self.batch_window_dir(window[0])):
+                shutil.rmtree(batch["dir"], ignore_errors=True)
+        batches.append({
+            "key": self.window_key,
+            "prefix": self.result_filename_prefix(),
+            "frame_pad": self.out_frame_pad,
+            "start": window[0],
+            "frames": list(window),
+            "dir": str(self.batch_window_dir(window[0])),
+            "submitted": time.time(),
+            })
+        state["batches"] = batches[-MAX_BATCH_FRAMES:]
+        self.save_state()
+        self.record_submissions(window)
+
+
+    def update_batches(self):
+        # Frames leave their window once their Result is written, the
+        # window goes with its last frame
+        batches = self.load_state().get("batches")
+        if not batches:
+            return
+        for batch in list(batches):
+            batch["frames"] = [
+                frame for frame in batch["frames"]
+                if not result_path(batch["prefix"], frame, batch["frame_pad"]).exists()
+                ]
+            if not batch["frames"] or (self.window_key is not None and batch["key"] != self.window_key):
+                shutil.rmtree(batch["dir"], ignore_errors=True)
+                batches.remove(batch)
+        self.save_state()
+
+
+    def batch_window(self, frame):
+        # Contiguous run of Front frames already on the server mount,
+        # starting at the requested frame and without a Result yet
+        sequence = self.front_sequence()
+        if frame not in sequence:
+            return []
+
+        window = [frame]
+        for next_frame in range(frame + 1, frame + self.batch_frames):
+            if (next_frame not in sequence
+                    or not self.front_is_current(sequence[next_frame])
+                    or self.result_filepath(next_frame).exists()):
+                break
+            window.append(next_frame)
+        return self.split_batch_window(window)
+
+
+    def batch_window_dir(self, frame):
+        return self.front_filepath().parent / "zdepth_windows" / self.node_key() / f"{frame:0{self.out_frame_pad}d}"
+
+
+    def split_batch_window(self, window):
+        # Handlers can end a window early, e.g. on a scene cut
+        return window
+
+
+    def set_workflow_batch_window(self):
+        self.batch_window_frames = []
+        self.window_key = None
+        if not self.workflow:
+            return
+        self.window_key = self.workflow_key()
+        frame = self.get_frame()
+        self.update_render(frame)
+        if self.get_batch_frames() <= 1:
+            return
+
+        window = self.batch_window(frame)
+        if len(window) <= 1:
+            return
+
+        # LoadEXR lists every EXR of the directory it reads: the window is
+        # linked into a directory of its own when it is submitted
+        load_exr_inputs = self.workflow.get(self.workflow_load_exr_front_idx)["inputs"]
+        load_exr_inputs["filepath"] = str(self.batch_window_dir(frame))
+        load_exr_inputs["skip_first_images"] = 0
+        load_exr_inputs["image_load_cap"] = len(window)
+        load_exr_inputs["select_every_nth"] = 1
+        self.workflow.get(self.workflow_save_exr_result_idx)["inputs"]["start_frame"] = frame
+
+        self.batch_window_frames = window
+        print(f'Workflow batch window: {window[0]}-{window[-1]} ({len(window)} frames)')
+
+
+    def link_batch_window(self):
+        # Only once the window is known not to be pending, and unless the
+        # stream directory replaced it
+        window_dir = self.batch_window_dir(self.batch_window_frames[0])
+        if self.workflow.get(self.workflow_load_exr_front_idx)["inputs"]["filepath"] != str(window_dir):
+            return
+        sequence = self.front_sequence()
+        shutil.rmtree(window_dir, ignore_errors=True)
+        for window_frame in self.batch_window_frames:
+            link_or_copy(sequence[window_frame], window_dir / f"front.{window_frame:0{self.out_frame_pad}d}.exr")
+
+
+    ###########################################################################
+    # Streaming sequence input
+
+    def create_io_page(self):
+        return pybox.create_page(
+            "ZDepth I/O",
+            "Input", "Output"
+            )
+
+
+    def set_ui_stream(self, row, col):
+        stream_frames = pybox.create_float_numeric(
+            UI_STREAM_FRAMES,
+            value=self.stream_frames,
+            default=DEFAULT_STREAM_FRAMES,
+            min=0, max=MAX_STREAM_FRAMES, inc=1,
+            row=row, col=col, page=UI_IO_PAGE,
+            tooltip="Frames of the rolling sequence LoadEXR reads the Front from, 0 disables",
+            )
+        self.add_global_elements(stream_frames)
+
+
+    def stream_enabled(self):
+        self.stream_frames = int(self.get_global_element_value(UI_STREAM_FRAMES))
+        return self.stream_frames > 0
+
+
+    def stream_dir(self, generation):
+        return Path(self.load_state()["stream"]["root"]) / f"{int(generation):06d}"
+
+
+    def stream_window(self, frame_paths):
+        # Sequence directory and skip of the frames. Frames are only ever
+        # appended in order and generations removed whole, so the window
+        # of a queued prompt never moves. None when the stream is full.
+        frames = [frame for frame, _ in frame_paths]
+        if len(frames) > self.stream_frames:
+            return None
+        stream = self.load_state().setdefault("stream", {
+            "root": str(self.front_filepath().parent / "zdepth_stream" / self.node_key()),
+            "generation": 0,
+            "generations": {},
+            })
+        generations = stream["generations"]
+        streamed = generations.setdefault(str(stream["generation"]), [])
+        skip = streamed.index(frames[0]) if frames[0] in streamed else len(streamed)
+        present = streamed[skip:]
+        if (frames[:len(present)] != present[:len(frames)]
+                or (not present and streamed and frames[0] < streamed[-1])
+                or skip + len(frames) > self.stream_frames):
+            self.reclaim_stream()
+            if len(generations) >= MAX_STREAM_GENERATIONS:
+                return None
+            stream["generation"] += 1
+            streamed = generations.setdefault(str(stream["generation"]), [])
+            skip, present = 0, []
+
+        stream_dir = self.stream_dir(stream["generation"])
+        for i, (frame, front_path) in enumerate(frame_paths):
+            stream_path = stream_dir / f"front.{frame:0{self.out_frame_pad}d}.exr"
+            if i >= len(present):
+                streamed.append(frame)
+            elif stream_path.exists() and stream_path.stat().st_mtime_ns >= Path(front_path).stat().st_mtime_ns:
+                continue
+            # New frames, and Fronts Flame rewrote since they were streamed
+            link_or_copy(front_path, stream_path)
+        self.save_state()
+        return stream_dir, skip
+
+
+    def stream_load_exr(self, workflow, frame_paths):
+        stream = self.stream_window(frame_paths)
+        if stream is None:
+            return
+        stream_dir, skip = stream
+        load_exr_inputs = workflow.get(self.workflow_load_exr_front_idx)["inputs"]
+        load_exr_inputs["filepath"] = str(stream_dir)
+        load_exr_inputs["skip_first_images"] = skip
+        load_exr_inputs["image_load_cap"] = len(frame_paths)
+        load_exr_inputs["select_every_nth"] = 1
+
+
+    def set_workflow_stream_window(self):
+        if not self.workflow or not self.stream_enabled():
+            return
+        frame = self.get_frame()
+        if len(self.batch_window_frames) > 1:
+            sequence = self.front_sequence()
+            frame_paths = [(f, sequence[f]) for f in self.batch_window_frames]
+        else:
+            frame_paths = [(frame, self.front_filepath())]
+        self.stream_load_exr(self.workflow, frame_paths)
+
+
+    def stream_frame_workflow(self, frame, front_path):
+        workflow = self.frame_workflow(frame, front_path)
+        if self.stream_enabled():
+            self.stream_load_exr(workflow, [(frame, front_path)])
+        return workflow
+
+
+    def reclaim_stream(self):
+        # Generations go once every frame is read back or, past the
+        # bound, once none is still computed, by the pool or the base class
+        stream = self.load_state().get("stream")
+        if not stream:
+            return
+        in_flight = self.state.get("in_flight", {})
+        batched = self.batched_frames() | self.update_base_frames()
+        generations = stream["generations"]
+        for generation, frames in sorted(generations.items(), key=lambda item: int(item[0])):
+            pending = any(str(f) in in_flight or f in batched for f in frames)
+            done = all(self.result_filepath(f).exists() for f in frames)
+            if pending or not (done or len(generations) >= MAX_STREAM_GENERATIONS):
+                continue
+            shutil.rmtree(self.stream_dir(generation), ignore_errors=True)
+            del generations[generation]
+            if int(generation) == stream["generation"]:
+                stream["generation"] += 1
+        self.save_state()
+
+
+    ###########################################################################
+    # Result readback prefetch
+
+    def set_ui_prefetch(self, row, col):
+        prefetch_depth = pybox.create_float_numeric(
+            UI_PREFETCH_DEPTH,
+            value=self.prefetch_depth,
+            default=DEFAULT_PREFETCH_DEPTH,
+            min=0, max=MAX_PREFETCH_DEPTH, inc=1,
+            row=row, col=col, page=UI_IO_PAGE,
+            tooltip="Results of the next frames mapped in memory as they complete, 0 disables",
+            )
+        self.add_global_elements(prefetch_depth)
+
+        hit_rate = pybox.create_float_numeric(
+            UI_PREFETCH_HIT_RATE,
+            value=0,
+            default=0,
+            min=0, max=100, inc=1,
+            row=row + 1, col=col, page=UI_IO_PAGE,
+            tooltip="Percentage of the Results read back by Flame which were prefetched",
+            )
+        self.add_global_elements(hit_rate)
+
+
+    def get_prefetch_depth(self):
+        self.prefetch_depth = int(self.get_global_element_value(UI_PREFETCH_DEPTH))
+        return self.prefetch_depth
+
+
+    def prefetch_results(self):
+        # Completed Results of the frames after the current one, in
+        # playback order
+        if not self.workflow or self.get_prefetch_depth() <= 0:
+            return
+        prefetch = self.load_state().setdefault("prefetch", {"frames": {}, "hits": 0, "misses": 0, "last": None})
+        frames = prefetch["frames"]
+        frame = self.get_frame()
+        for next_frame in range(frame + 1, frame + 1 + self.prefetch_depth):
+            path = self.result_filepath(next_frame)
+            try:
+                frames[str(path)] = RESULT_RING.prefetch(path, self.prefetch_depth)
+            except (OSError, ValueError):
+                # Not computed yet
+                continue
+        for path in list(frames)[:-2 * self.prefetch_depth]:
+            del frames[path]
+        self.save_state()
+
+
+    def record_readback(self):
+        # A hit is a Result read back unchanged since it was prefetched,
+        # and still mapped: an exchange run in process, or a mapping
+        # evicted since, reads it from the mount
+        if not self.workflow or not self.out_frame_requested() or self.get_prefetch_depth() <= 0:
+            return
+        result_path = self.result_filepath(self.get_frame())
+        try:
+            signature = file_signature(result_path)
+        except OSError:
+            return
+        prefetch = self.load_state().setdefault("prefetch", {"frames": {}, "hits": 0, "misses": 0, "last": None})
+        readback = [str(result_path), signature]
+        if prefetch["last"] == readback:
+            return
+        prefetch["last"] = readback
+        if prefetch["frames"].get(str(result_path)) == signature and RESULT_RING.holds(result_path, signature):
+            prefetch["hits"] += 1
+        else:
+            prefetch["misses"] += 1
+        self.save_state()
+        hit_rate = 100 * prefetch["hits"] / (prefetch["hits"] + prefetch["misses"])
+        self.set_global_element_value(UI_PREFETCH_HIT_RATE, round(hit_rate))
+        print(f'Workflow readback: {prefetch["hits"]} prefetched, {prefetch["misses"]} read on demand ({hit_rate:.0f}%)')
+
+
+    ###########################################################################
+    # Held frames
+
+    def set_ui_hold_tolerance(self, row, col):
+        hold_tolerance = pybox.create_float_numeric(
+            UI_HOLD_TOLERANCE,
+            value=self.hold_tolerance,
+            default=DEFAULT_HOLD_TOLERANCE,
+            min=0, max=MAX_HOLD_TOLERANCE, inc=0.005,
+            row=row, col=col, page=UI_PERFORMANCE_PAGE,
+            tooltip="Front difference under which the previous depth is reused, 0 disables",
+            )
+        self.add_global_elements(hold_tolerance)
+
+
+    def get_hold_tolerance(self):
+        self.hold_tolerance = self.get_global_element_value(UI_HOLD_TOLERANCE)
+        return self.hold_tolerance
+
+
+    def get_cut_threshold(self):
+        # Handlers exposing a cut threshold read it from the UI
+        return self.cut_threshold
+
+
+    def hold_frame(self, frame):
+        # Frames of a locked off or held shot reuse the depth of the last
+        # computed frame, as long as no cut happened in between
+        front_path = self.front_filepath()
+        if oiio is None or self.get_hold_tolerance() <= 0 or not front_path.is_file():
+            return False
+
+        holds = self.load_state().setdefault("holds", {"held": 0, "computed": 0})
+        signature = self.front_signature(front_path)
+        last = holds.get("last")
+        reference = holds.get("reference")
+        held = False
+        if last is not None and reference is not None and last[0] == frame - 1:
+            if signature_distance(last[1], signature) > self.get_cut_threshold():
+                print(f'Workflow cut at frame {frame}')
+            elif (signature_distance(reference[1], signature) <= self.hold_tolerance
+                    and Path(reference[2]).is_file()):
+                link_or_copy(reference[2], self.result_filepath(frame))
+                held = True
+
+        if held:
+            holds["held"] += 1
+            print(f'Workflow frame {frame} held from frame {reference[0]}')
+        else:
+            holds["computed"] += 1
+            holds["reference"] = [frame, signature, str(self.result_filepath(frame))]
+        holds["last"] = [frame, signature]
+        self.save_state()
+        print(f'Workflow held frames: {holds["held"]}, computed frames: {holds["computed"]}')
+        return held
+
+
+    def frame_would_hold(self, front_path):
+        # Upcoming frames which will reuse the current depth are not queued
+        if oiio is None or self.hold_tolerance <= 0:
+            return False
+        reference = self.load_state().get("holds", {}).get("reference")
+        return reference is not None and \
+            signature_distance(reference[1], self.front_signature(front_path)) <= self.hold_tolerance
+
+
+    ###########################################################################
+    # Depth result cache
+
+    def set_ui_cache_size(self, row, col):
+        cache_size = pybox.create_float_numeric(
+            UI_CACHE_SIZE,
+            value=self.cache_size,
+            default=DEFAULT_CACHE_SIZE,
+            min=0, max=MAX_CACHE_SIZE, inc=1,
+            row=row, col=col, page=UI_PERFORMANCE_PAGE,
+            tooltip="Local depth result cache size, 0 disables the cache",
+            )
+        self.add_global_elements(cache_size)
+
+
+    def get_depth_cache(self):
+        self.cache_size = self.get_global_element_value(UI_CACHE_SIZE)
+        return DepthCache(max_bytes=int(self.cache_size * (1 << 30)))
+
+
+    def cache_workflow(self):
+        # Patched workflow without the frame specific inputs
+        workflow = copy.deepcopy(self.workflow)
+        load_exr_inputs = workflow.get(self.workflow_load_exr_front_idx)["inputs"]
+        for name in ("filepath", "image_load_cap", "skip_first_images", "select_every_nth"):
+            load_exr_inputs.pop(name, None)
+        save_exr_inputs = workflow.get(self.workflow_save_exr_result_idx)["inputs"]
+        for name in ("filename_prefix", "start_frame", "version"):
+            save_exr_inputs.pop(name, None)
+        return workflow
+
+
+    def fetch_cached_result(self, frame):
+        cache = self.get_depth_cache()
+        front_path = self.front_filepath()
+        if cache.max_bytes <= 0 or not front_path.is_file():
+            return False
+
+        key = cache.key(front_path, self.cache_workflow())
+        result_path = self.depth_filepath(frame)
+        hit = cache.fetch(key, result_path)
+        if hit:
+            self.post_process_result(frame)
+        else:
+            state = self.load_state()
+            state.setdefault("cache_pending", {})[str(frame)] = [key, str(result_path)]
+            self.save_state()
+
+        stats = cache.stats()
+        print(f'Depth cache {"hit" if hit else "miss"} frame {frame} '
+              f'(hits: {stats["hits"]}, misses: {stats["misses"]})')
+        return hit
+
+
+    def store_cached_results(self):
+        pending = self.load_state().get("cache_pending")
+        if not pending:
+            return
+
+        cache = self.get_depth_cache()
+        for frame, (key, result_path) in list(pending.items()):
+            if Path(result_path).is_file():
+                cache.store(key, result_path)
+                del pending[frame]
+        self.save_state()
+
+
+    ###########################################################################
+    # Result format
+
+    def set_ui_output_format(self, row, col):
+        single_channel = pybox.create_toggle_button(
+            UI_SINGLE_CHANNEL,
+            self.single_channel,
+            default=DEFAULT_SINGLE_CHANNEL,
+            row=row, col=col, page=UI_PERFORMANCE_PAGE,
+            tooltip="Write the depth as a single Y channel instead of RGB",
+            )
+        self.add_global_elements(single_channel)
+
+        half_float = pybox.create_toggle_button(
+            UI_HALF_FLOAT,
+            self.half_float,
+            default=DEFAULT_HALF_FLOAT,
+            row=row + 1, col=col, page=UI_PERFORMANCE_PAGE,
+            tooltip="Store the depth as 16 bit half float",
+            )
+        self.add_global_elements(half_float)
+
+        compression = pybox.create_popup(
+            UI_COMPRESSION,
+            COMPRESSIONS,
+            value=COMPRESSIONS.index(self.compression),
+            default=COMPRESSIONS.index(DEFAULT_COMPRESSION),
+            row=row + 2, col=col, page=UI_PERFORMANCE_PAGE,
+            tooltip="EXR compression of the Result",
+            )
+        self.add_global_elements(compression)
+
+
+    def get_output_format(self):
+        self.single_channel = bool(self.get_global_element_value(UI_SINGLE_CHANNEL))
+        self.half_float = bool(self.get_global_element_value(UI_HALF_FLOAT))
+        self.compression = COMPRESSIONS[int(self.get_global_element_value(UI_COMPRESSION))]
+        return self.single_channel, self.half_float, self.compression.lower()
+
+
+    def set_workflow_save_exr_format(self):
+        # The stock SaveEXR only writes full float RGB: other formats go
+        # through the ZDepth SaveDepthEXR node
+        single_channel, half_float, compression = self.get_output_format()
+        save_exr = self.workflow.get(self.workflow_save_exr_result_idx)
+        inputs = {
+            name: value for name, value in save_exr["inputs"].items()
+            if name not in ("single_channel", "half_float", "compression")
+            }
+        if not single_channel and not half_float and compression == DEFAULT_COMPRESSION.lower():
+            self.workflow[self.workflow_save_exr_result_idx] = dict(save_exr, class_type="SaveEXR", inputs=inputs)
+            return
+
+        # No version suffix: the Result keeps the name the handler reads back
+        inputs.update(single_channel=single_channel, half_float=half_float, compression=compression, version=-1)
+        self.workflow[self.workflow_save_exr_result_idx] = dict(save_exr, class_type="SaveDepthEXR", inputs=inputs)
+        print(f'Workflow result format: {"Y" if single_channel else "RGB"} '
+              f'{"half" if half_float else "float"} {compression}')
+
+
+    def write_result(self, path, pixels):
+        # Results assembled locally are written in the format the server
+        # would have used
+        single_channel, half_float, compression = self.get_output_format()
+        if pixels.ndim == 2:
+            pixels = pixels[..., np.newaxis]
+        if single_channel:
+            pixels = pixels[..., :1]
+        elif pixels.shape[2] == 1:
+            pixels = np.repeat(pixels, 3, axis=2)
+        write_exr(path, pixels, half=half_float, compression=compression)
+
+
+    ###########################################################################
+    # Local depth post-process
+
+    def create_post_page(self):
+        return pybox.create_page(
+            "ZDepth Post",
+            "Range", "Tone"
+            )
+
+
+    def set_ui_post_process(self, invert_normalize=True):
+        # Handlers with their own invert and normalize settings skip them
+        elements = [
+            pybox.create_float_numeric(
+                UI_NEAR, value=self.near, default=DEFAULT_NEAR, min=-10, max=10, inc=0.01,
+                row=0, col=0, page=UI_POST_PAGE, tooltip="Depth mapped to 0",
+                ),
+            pybox.create_float_numeric(
+                UI_FAR, value=self.far, default=DEFAULT_FAR, min=-10, max=10, inc=0.01,
+                row=1, col=0, page=UI_POST_PAGE, tooltip="Depth mapped to 1",
+                ),
+            pybox.create_toggle_button(
+                UI_CLAMP, self.clamp, default=DEFAULT_CLAMP,
+                row=2, col=0, page=UI_POST_PAGE, tooltip="Clamp the remapped depth to 0-1",
+                ),
+            pybox.create_float_numeric(
+                UI_GAMMA, value=self.gamma, default=DEFAULT_GAMMA, min=0.1, max=10, inc=0.05,
+                row=0, col=1, page=UI_POST_PAGE, tooltip="Gamma applied last",
+                ),
+            ]
+        if invert_normalize:
+            elements += [
+                pybox.create_toggle_button(
+                    UI_POST_NORMALIZE, self.post_normalize, default=DEFAULT_POST_NORMALIZE,
+                    row=1, col=1, page=UI_POST_PAGE, tooltip="Stretch the depth of each frame to 0-1",
+                    ),
+                pybox.create_toggle_button(
+                    UI_POST_INVERT, self.post_invert, default=DEFAULT_POST_INVERT,
+                    row=2, col=1, page=UI_POST_PAGE, tooltip="Invert the depth",
+                    ),
+                ]
+        for element in elements:
+            self.add_global_elements(element)
+
+
+    def post_process_enabled(self):
+        # The server output is the Result unless the settings grade it,
+        # which needs OpenImageIO to read and write the raw depth
+        return oiio is not None and not is_identity_post_process(**self.get_post_parameters())
+
+
+    def get_post_invert_normalize(self):
+        self.post_invert = bool(self.get_global_element_value(UI_POST_INVERT))
+        self.post_normalize = bool(self.get_global_element_value(UI_POST_NORMALIZE))
+        return self.post_invert, self.post_normalize
+
+
+    def get_post_parameters(self):
+        invert, normalize = self.get_post_invert_normalize()
+        self.near = self.get_global_element_value(UI_NEAR)
+        self.far = self.get_global_element_value(UI_FAR)
+        self.clamp = bool(self.get_global_element_value(UI_CLAMP))
+        self.gamma = self.get_global_element_value(UI_GAMMA)
+        return {
+            "normalize": normalize,
+            "invert": invert,
+            "near": self.near,
+            "far": self.far,
+            "gamma": self.gamma,
+            "clamp": self.clamp,
+            }
+
+
+    def raw_filepath(self, frame):
+        return result_path(f"{self.result_filename_prefix()}_raw", frame, self.out_frame_pad)
+
+
+    def depth_filepath(self, frame):
+        # Where the server and the local assembly write the depth of a frame
+        return self.raw_filepath(frame) if self.post_process_enabled() else self.result_filepath(frame)
+
+
+    def raw_workflow(self, workflow):
+        save_exr = workflow.get(self.workflow_save_exr_result_idx)
+        if self.post_process_enabled() and save_exr is not None:
+            save_exr_inputs = save_exr["inputs"]
+            if save_exr_inputs.get("filename_prefix") == self.result_filename_prefix():
+                save_exr_inputs["filename_prefix"] = f"{self.result_filename_prefix()}_raw"
+        return workflow
+
+
+    def post_process_result(self, frame):
+        # The raw depth stays in the depth cache: changing these parameters
+        # only runs this again
+        raw_path = self.raw_filepath(frame)
+        if not raw_path.is_file():
+            return False
+
+        parameters = self.get_post_parameters()
+        if is_identity_post_process(**parameters):
+            raw_path.replace(self.result_filepath(frame))
+            return True
+        depth = read_exr(raw_path)[..., 0]
+        self.write_result(self.result_filepath(frame), post_process(depth, **parameters))
+        raw_path.unlink()
+        return True
+
+
+    def update_raw_results(self):
+        state = self.load_state()
+        producers = ("in_flight", "batches", "shared_frames", "tiled_frames", "previews")
+        # Gated on OpenImageIO rather than post_process_enabled(): frames
+        # queued while the settings graded the depth still write a raw
+        # depth after the settings went back to identity, and it is still
+        # moved to the Result
+        if oiio is None or not any(state.get(name) for name in producers):
+            return
+        raw_prefix = Path(f"{self.result_filename_prefix()}_raw")
+        for raw_path in raw_prefix.parent.glob(f"{raw_prefix.name}.*.exr"):
+            frame = frame_from_path(raw_path)
+            if frame is not None:
+                self.post_process_result(frame)
+
+
+    ###########################################################################
+    # Pipelined submission
+
+    def set_ui_in_flight(self, row, col):
+        in_flight = pybox.create_float_numeric(
+            UI_IN_FLIGHT,
+            value=self.in_flight,
+            default=DEFAULT_IN_FLIGHT,
+            min=1, max=MAX_IN_FLIGHT, inc=1,
+            row=row, col=col, page=UI_PERFORMANCE_PAGE,
+            tooltip="Number of prompts kept queued on the ComfyUI server",
+            )
+        self.add_global_elements(in_flight)
+
+        queue_depth = pybox.create_float_numeric(
+            UI_QUEUE_DEPTH,
+            value=0,
+            default=0,
+            min=0, max=MAX_IN_FLIGHT, inc=1,
+            row=row + 1, col=col, page=UI_PERFORMANCE_PAGE,
+            tooltip="Prompts currently in flight",
+            )
+        self.add_global_elements(queue_depth)
+
+
+    def get_in_flight(self):
+        self.in_flight = max(1, int(self.get_global_element_value(UI_IN_FLIGHT)))
+        return self.in_flight
+
+
+    def in_flight_frame_pending(self, frame, front_path):
+        # Frames queued for another Result version or from an older Front
+        # are dropped, the frame is submitted again
+        entry = self.load_state().get("in_flight", {}).get(str(frame))
+        if entry is None:
+            return False
+        _, result_path, _, submitted = entry
+        if result_path == str(self.result_filepath(frame)) and not self.front_newer_than(front_path, submitted):
+            return True
+        print(f'Workflow frame {frame} in flight is stale, submitting it again')
+        self.drop_in_flight(frame)
+        return False
+
+
+    def drop_in_flight(self, frame):
+        in_flight = self.load_state().get("in_flight", {})
+        entry = in_flight.pop(str(frame), None)
+        if entry is None:
+            return
+        self.forget_submission(frame)
+        prompt_id, _, address, _ = entry
+        server = self.get_server_pool().server(address)
+        try:
+            if server is not None:
+                server.cancel_prompt(prompt_id)
+        except ComfyUIServerError as e:
+            print(f'Unable to cancel prompt {prompt_id}: {e}')
+        self.save_state()
+        self.set_ui_queue_depth(len(in_flight))
+
+
+    def frame_workflow(self, frame, front_path):
+        workflow = copy_workflow(self.workflow)
+        workflow.get(self.workflow_load_exr_front_idx)["inputs"]["filepath"] = str(front_path)
+        workflow.get(self.workflow_save_exr_result_idx)["inputs"]["start_frame"] = frame
+        return workflow
+
+
+    def submit_upcoming_frames(self, frame):
+        # Queue the next Front frames Flame already wrote on the mount for
+        # this render, so the server computes them while Flame picks up
+        # the current result
+        in_flight = self.load_state().setdefault("in_flight", {})
+        # The requested frame may have gone through the base class
+        reserved = 1 if self.base_submission() else 0
+        free_slots = self.get_in_flight() - reserved - len(in_flight)
+        if free_slots <= 0:
+            return
+
+        upcoming = []
+        for next_frame, front_path in self.front_sequence().items():
+            if len(upcoming) == free_slots:
+                break
+            if (next_frame < frame + max(1, len(self.batch_window_frames))
+                    or not self.front_is_current(front_path)
+                    or self.frame_pending(next_frame, front_path)
+                    or self.result_filepath(next_frame).exists()
+                    or self.frame_would_hold(front_path)):
+                continue
+            upcoming.append((next_frame, front_path))
+        if not upcoming:
+            return
+
+        self.queue_frames([(f, self.stream_frame_workflow(f, p)) for f, p in upcoming], priority=PRIORITY_BATCH)
+
+
+    def queue_frames(self, frame_workflows, exclude=(), priority=PRIORITY_INTERACTIVE):
+        pool = self.get_server_pool()
+        affinity = self.server_affinity()
+
+        def queue_frame(frame_workflow):
+            frame, workflow = frame_workflow
+            try:
+                return pool.queue_prompt(workflow, affinity, exclude, priority)
+            except ComfyUIServerError as e:
+                print(f'Unable to queue frame {frame}: {e}')
+                return None
+
+        frame_workflows = [(frame, self.raw_workflow(workflow)) for frame, workflow in frame_workflows]
+        with ThreadPoolExecutor(max_workers=len(frame_workflows)) as executor:
+            results = list(executor.map(queue_frame, frame_workflows))
+
+        in_flight = self.load_state().setdefault("in_flight", {})
+        for (frame, _), result in zip(frame_workflows, results):
+            if result is not None:
+                address, prompt_id = result
+                in_flight[str(frame)] = [prompt_id, str(self.result_filepath(frame)), address, time.time()]
+                print(f'Workflow queued frame {frame} on {address}: {prompt_id}')
+        self.save_state()
+        self.record_submissions([frame for (frame, _), result in zip(frame_workflows, results) if result is not None])
+        self.set_ui_queue_depth(len(in_flight))
+
+
+    def update_in_flight(self):
+        in_flight = self.load_state().get("in_flight")
+        if not in_flight:
+            return
+
+        pool = self.get_server_pool()
+        previews = self.state.get("previews", {})
+        lost_frames = []
+        for frame, (prompt_id, result_path, address, submitted) in list(in_flight.items()):
+            # A previewed frame's Result is the preview until the
+            # refinement lands
+            done_path = previews[frame]["refine_path"] if frame in previews else result_path
+            if Path(done_path).is_file():
+                # The scheduler records its prompts against the server
+                # which ran them
+                pool.record_latency(address, time.time() - submitted)
+                del in_flight[frame]
+                continue
+
+            server = pool.server(address)
+            event = server.prompt_event(prompt_id, submitted) if server is not None else None
+            if event is not None and event["status"] == "error":
+                print(f'Workflow frame {frame} failed on node {event["node"]}: {event.get("error")}')
+                del in_flight[frame]
+                self.forget_submission(frame)
+                continue
+            if event is not None and event["progress"]:
+                value, maximum = event["progress"]
+                print(f'Workflow frame {frame} node {event["node"]}: {value}/{maximum}')
+            try:
+                if server is None or server.is_done(prompt_id, submitted):
+                    # Finished without writing its result: let the frame
+                    # be submitted again when it is requested
+                    print(f'Workflow frame {frame} finished without result: {prompt_id}')
+                    del in_flight[frame]
+                    self.forget_submission(frame)
+            except ComfyUIServerError as e:
+                print(f'Unable to get prompt status: {e}')
+                pool.mark_dead(address)
+                lost_frames.append((int(frame), address))
+                del in_flight[frame]
+                if frame in previews:
+                    # Resubmitted at full quality, no refinement to wait for
+                    self.remove_preview_files(previews.pop(frame))
+        self.save_state()
+
+        if lost_frames:
+            self.resubmit_frames(lost_frames)
+        self.set_ui_queue_depth(len(in_flight))
+
+
+    def resubmit_frames(self, lost_frames):
+        # Frames queued on a server which dropped go to the rest of the pool
+        self.workflow_setup()
+        sequence = self.front_sequence()
+        frame_workflows = [
+            (frame, self.frame_workflow(frame, sequence[frame]))
+            for frame, _ in lost_frames if frame in sequence
+            ]
+        if frame_workflows:
+            self.queue_frames(frame_workflows, exclude={address for _, address in lost_frames})
+
+
+    def clear_in_flight(self):
+        in_flight = self.load_state().get("in_flight")
+        if in_flight:
+            pool = self.get_server_pool()
+            for prompt_id, _, address, _ in in_flight.values():
+                try:
+                    pool.server(address).delete_from_queue([prompt_id])
+                except (AttributeError, ComfyUIServerError) as e:
+                    print(f'Unable to clear queued prompt {prompt_id}: {e}')
+            in_flight.clear()
+            self.save_state()
+        self.set_ui_queue_depth(0)
+
+
+    def set_ui_queue_depth(self, depth):
+        self.set_global_element_value(UI_QUEUE_DEPTH, depth)
+
+
+    ###########################################################################
+    # Shared memory transport
+
+    def set_ui_shared_memory(self, row, col):
+        shared_memory = pybox.create_toggle_button(
+            UI_SHARED_MEMORY,
+            self.shared_memory,
+            default=DEFAULT_SHARED_MEMORY,
+            row=row, col=col, page=UI_PERFORMANCE_PAGE,
+            tooltip="Exchange frames through shared memory when ComfyUI runs on this host",
+            )
+        self.add_global_elements(shared_memory)
+
+
+    def shared_memory_enabled(self):
+        # The handler decodes the Front and encodes the Result itself
+        self.shared_memory = self.get_global_element_value(UI_SHARED_MEMORY)
+        return self.shared_memory and oiio is not None and self.server_is_local()
+
+
+    def shared_frame_name(self, frame, layer):
+        return f"zdepth_{self.node_key()[:12]}_{layer}_{frame}"
+
+
+    def shared_memory_workflow(self, frame):
+        # Front pixels are decoded once here and the server reads them
+        # from memory, the depth comes back the same way
+        load_exr_inputs = self.workflow.get(self.workflow_load_exr_front_idx)["inputs"]
+        save_exr_inputs = self.workflow.get(self.workflow_save_exr_result_idx)["inputs"]
+        front_name = self.shared_frame_name(frame, "front")
+        result_name = self.shared_frame_name(frame, "result")
+
+        pixels = read_exr(self.front_filepath())
+        if load_exr_inputs.get("linear_to_sRGB"):
+            pixels = linear_to_srgb(pixels)
+        SharedFrame.from_pixels(front_name, pixels).close()
+        unlink_shared_frame(result_name)
+
+        workflow = copy_workflow(self.workflow)
+        workflow[self.workflow_load_exr_front_idx] = {
+            "class_type": "LoadSharedFrame",
+            "inputs": {"name": front_name},
+            }
+        workflow[self.workflow_save_exr_result_idx] = {
+            "class_type": "SaveSharedFrame",
+            "inputs": {"images": save_exr_inputs["images"], "name": result_name},
+            }
+
+        shared_frames = self.load_state().setdefault("shared_frames", {})
+        shared_frames[str(frame)] = [
+            front_name, result_name, str(self.depth_filepath(frame)), bool(save_exr_inputs.get("sRGB_to_linear"))
+            ]
+        self.save_state()
+        return workflow
+
+
+    def update_shared_frames(self):
+        shared_frames = self.load_state().get("shared_frames")
+        if not shared_frames:
+            return
+
+        for frame, (front_name, result_name, result_path, to_linear) in list(shared_frames.items()):
+            result = SharedFrame.attach(result_name)
+            if result is None:
+                continue
+            pixels = result.array
+            self.write_result(result_path, srgb_to_linear(pixels) if to_linear else pixels)
+            del pixels
+            result.unlink()
+            unlink_shared_frame(front_name)
+            del shared_frames[frame]
+        self.save_state()
+
+
+    def clear_shared_frames(self):
+        shared_frames = self.load_state().get("shared_frames")
+        if shared_frames:
+            for front_name, result_name, _, _ in shared_frames.values():
+                unlink_shared_frame(front_name)
+                unlink_shared_frame(result_name)
+            shared_frames.clear()
+            self.save_state()
+
+
+    ###########################################################################
+    # Tiled inference
+
+    def set_ui_tiled(self, row, col):
+        tiled = pybox.create_toggle_button(
+            UI_TILED,
+            self.tiled,
+            default=DEFAULT_TILED,
+            row=row, col=col, page=UI_PERFORMANCE_PAGE,
+            tooltip="Split plates larger than the model resolution into blended tiles",
+            )
+        self.add_global_elements(tiled)
+
+        tile_overlap = pybox.create_float_numeric(
+            UI_TILE_OVERLAP,
+            value=self.tile_overlap,
+            default=DEFAULT_TILE_OVERLAP,
+            min=0, max=self.tile_size // 2, inc=8,
+            row=row + 1, col=col, page=UI_PERFORMANCE_PAGE,
+            tooltip="Overlap in pixels feathered between tiles",
+            )
+        self.add_global_elements(tile_overlap)
+
+
+    def tiled_enabled(self):
+        # Tiles are cut and blended by the handler
+        self.tiled = self.get_global_element_value(UI_TILED)
+        return self.tiled and oiio is not None
+
+
+    def tiled_workflow(self, frame):
+        # One prompt over a low resolution global pass followed by the
+        # tiles, all at the model resolution
+        pixels = read_exr(self.front_filepath())
+        height, width = pixels.shape[:2]
+        if max(height, width) <= self.tile_size:
+            return None
+
+        self.tile_overlap = int(self.get_global_element_value(UI_TILE_OVERLAP))
+        boxes = tile_boxes(height, width, self.tile_size, self.tile_overlap)
+        tiles = [resize(pixels, self.tile_size, self.tile_size)] + split_tiles(pixels, boxes, self.tile_size)
+
+        tiles_dir = self.front_filepath().parent / f".zdepth_tiles_{frame:0{self.out_frame_pad}d}"
+        shutil.rmtree(tiles_dir, ignore_errors=True)
+        tiles_dir.mkdir(parents=True)
+        for i, tile in enumerate(tiles):
+            write_exr(tiles_dir / f"tile.{i:04d}.exr", tile, compression="none")
+
+        tiles_prefix = f"{self.result_filename_prefix()}_tiles_{frame:0{self.out_frame_pad}d}"
+        workflow = copy_workflow(self.workflow)
+        load_exr_inputs = workflow.get(self.workflow_load_exr_front_idx)["inputs"]
+        load_exr_inputs["filepath"] = str(tiles_dir)
+        load_exr_inputs["skip_first_images"] = 0
+        load_exr_inputs["image_load_cap"] = len(tiles)
+        load_exr_inputs["select_every_nth"] = 1
+        save_exr_inputs = workflow.get(self.workflow_save_exr_result_idx)["inputs"]
+        save_exr_inputs["filename_prefix"] = tiles_prefix
+        save_exr_inputs["start_frame"] = 0
+
+        tiled_frames = self.load_state().setdefault("tiled_frames", {})
+        tiled_frames[str(frame)] = {
+            "tiles_dir": str(tiles_dir),
+            "tiles_prefix": tiles_prefix,
+            "frame_pad": self.out_frame_pad,
+            "result_path": str(self.depth_filepath(frame)),
+            "height": height,
+            "width": width,
+            "overlap": self.tile_overlap,
+            "boxes": boxes,
+            }
+        self.save_state()
+        print(f'Workflow tiled frame {frame}: {len(boxes)} tiles of {self.tile_size}px')
+        return workflow
+
+
+    def update_tiled_frames(self):
+        tiled_frames = self.load_state().get("tiled_frames")
+        if not tiled_frames:
+            return
+
+        for frame, tiled in list(tiled_frames.items()):
+            tile_paths = self.tile_result_paths(tiled)
+            if not all(path.is_file() for path in tile_paths):
+                continue
+
+            results = [read_exr(path) for path in tile_paths]
+            depth = blend_tiles(
+                [result[..., 0] for result in results[1:]],
+                [tuple(box) for box in tiled["boxes"]],
+                results[0][..., 0],
+                tiled["height"], tiled["width"], tiled["overlap"],
+                )
+            self.write_result(tiled["result_path"], depth)
+
+            self.remove_tiles(tiled, tile_paths)
+            del tiled_frames[frame]
+        self.save_state()
+
+
+    def tile_result_paths(self, tiled):
+        # Global pass first, then the tiles in box order
+        return [
+            result_path(tiled["tiles_prefix"], i, tiled["frame_pad"])
+            for i in range(len(tiled["boxes"]) + 1)
+            ]
+
+
+    def remove_tiles(self, tiled, tile_paths):
+        shutil.rmtree(tiled["tiles_dir"], ignore_errors=True)
+        for path in tile_paths:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
+    def clear_tiled_frames(self):
+        tiled_frames = self.load_state().get("tiled_frames")
+        if tiled_frames:
+            for tiled in tiled_frames.values():
+                self.remove_tiles(tiled, self.tile_result_paths(tiled))
+            tiled_frames.clear()
+            self.save_state()
+
+
+    ###########################################################################
+    # Preview with progressive refinement
+
+    def set_ui_preview(self, row, col):
+        preview = pybox.create_toggle_button(
+            UI_PREVIEW,
+            self.preview,
+            default=DEFAULT_PREVIEW,
+            row=row, col=col, page=UI_PERFORMANCE_PAGE,
+            tooltip="Return a cheap proxy result first, then refine it at full quality",
+            )
+        self.add_global_elements(preview)
+
+        preview_scale = pybox.create_float_numeric(
+            UI_PREVIEW_SCALE,
+            value=self.preview_scale,
+            default=DEFAULT_PREVIEW_SCALE,
+            min=0.05, max=1, inc=0.05,
+            row=row + 1, col=col, page=UI_PERFORMANCE_PAGE,
+            tooltip="Resolution of the preview relative to the Front plate",
+            )
+        self.add_global_elements(preview_scale)
+
+
+    def preview_enabled(self):
+        # The handler downscales the preview Front and upscales its depth
+        self.preview = self.get_global_element_value(UI_PREVIEW) and oiio is not None
+        return self.preview
+
+
+    def preview_parameters(self, workflow):
+        # Handlers lower the model cost of the preview prompt
+        pass
+
+
+    def submit_preview_frame(self, frame):
+        self.cancel_stale_refinements(frame)
+
+        front_path = self.front_filepath()
+        pixels = read_exr(front_path)
+        height, width = pixels.shape[:2]
+        self.preview_scale = self.get_global_element_value(UI_PREVIEW_SCALE)
+        preview_front = front_path.parent / f".zdepth_preview_{frame:0{self.out_frame_pad}d}.exr"
+        write_exr(
+            preview_front,
+            resize(pixels, max(1, int(height * self.preview_scale)), max(1, int(width * self.preview_scale))),
+            compression="none",
+            )
+
+        # The preview prompt is not in flight: its latency says nothing of
+        # the servers' full quality latency
+        preview_prefix = f"{self.result_filename_prefix()}_preview"
+        preview_workflow = self.frame_workflow(frame, preview_front)
+        preview_workflow.get(self.workflow_save_exr_result_idx)["inputs"]["filename_prefix"] = preview_prefix
+        self.preview_parameters(preview_workflow)
+        try:
+            address, preview_id = self.get_server_pool().queue_prompt(preview_workflow, self.server_affinity())
+            print(f'Workflow queued preview of frame {frame} on {address}: {preview_id}')
+        except ComfyUIServerError as e:
+            print(f'Unable to queue preview of frame {frame}: {e}')
+
+        # The refinement is the frame in flight
+        refine_prefix = f"{self.result_filename_prefix()}_refine"
+        refine_workflow = copy_workflow(self.workflow)
+        refine_workflow.get(self.workflow_save_exr_result_idx)["inputs"]["filename_prefix"] = refine_prefix
+        self.queue_frames([(frame, refine_workflow)])
+
+        # The cache only gets the refined result
+        state = self.load_state()
+        cache_key = state.get("cache_pending", {}).pop(str(frame), [None])[0]
+        state.setdefault("previews", {})[str(frame)] = {
+            "front": str(preview_front),
+            "preview_path": str(result_path(preview_prefix, frame, self.out_frame_pad)),
+            "refine_path": str(result_path(refine_prefix, frame, self.out_frame_pad)),
+            "result_path": str(self.depth_filepath(frame)),
+            "height": height,
+            "width": width,
+            "cache_key": cache_key,
+            "delivered": False,
+            }
+        self.save_state()
+        print(f'Workflow preview frame {frame} at {self.preview_scale:.2f}')
+
+
+    def update_previews(self):
+        previews = self.load_state().get("previews")
+        if not previews:
+            return
+
+        for frame, preview in list(previews.items()):
+            preview_path = Path(preview["preview_path"])
+            refine_path = Path(preview["refine_path"])
+            if refine_path.is_file():
+                refine_path.replace(preview["result_path"])
+                if preview["cache_key"]:
+                    self.get_depth_cache().store(preview["cache_key"], preview["result_path"])
+                print(f'Workflow refined frame {frame}')
+                self.remove_preview_files(preview)
+                del previews[frame]
+            elif not preview["delivered"] and preview_path.is_file():
+                depth = read_exr(preview_path)
+                self.write_result(preview["result_path"], resize(depth, preview["height"], preview["width"]))
+                preview_path.unlink()
+                preview["delivered"] = True
+        self.save_state()
+
+
+    def cancel_stale_refinements(self, frame):
+        # The user moved on: refinements of other frames are not wanted
+        previews = self.load_state().get("previews")
+        if not previews:
+            return
+
+        for stale_frame, preview in list(previews.items()):
+            if stale_frame == str(frame):
+                continue
+            self.drop_in_flight(stale_frame)
+            print(f'Workflow cancelled refinement of frame {stale_frame}')
+            self.remove_preview_files(preview)
+            del previews[stale_frame]
+        self.save_state()
+
+
+    def remove_preview_files(self, preview):
+        for path in (preview["front"], preview["preview_path"]):
+            try:
+                Path(path).unlink()
+            except OSError:
+                pass
+
+
+    def clear_previews(self):
+        self.cancel_stale_refinements(None)
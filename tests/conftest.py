@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The modules live at the root of the checkout, next to the handlers
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
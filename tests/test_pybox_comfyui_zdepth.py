@@ -0,0 +1,119 @@
+import os
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+import zdepth_paths
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "bench"))
+# Flame modules are only stubbed when they are not installed
+sys.path.append(str(Path(__file__).resolve().parents[1] / "bench" / "flame_stubs"))
+
+import pybox_comfyui_zdepth
+from pybox_comfyui_zdepth import MAX_STREAM_GENERATIONS
+
+from fake_comfyui_server import write_exr
+
+
+@pytest.fixture(autouse=True)
+def user_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(zdepth_paths, "ZDEPTH_USER_DIR", tmp_path / "user")
+
+
+class StreamHandler(pybox_comfyui_zdepth.ComfyUIZDepthBaseClass):
+    # Paths and state of a node, without a pybox exchange behind them
+    operator_name = "zdepth_test"
+    stream_frames = 4
+
+    def __init__(self, tmp_path):
+        self.tmp_path = tmp_path
+        self.state = {}
+
+    def node_key(self):
+        return "node"
+
+    def front_filepath(self):
+        return self.tmp_path / "in" / "front.0001.exr"
+
+    def result_filepath(self, frame):
+        return self.tmp_path / "out" / f"result.{frame:04d}.exr"
+
+
+@pytest.fixture
+def handler(tmp_path):
+    return StreamHandler(tmp_path)
+
+
+def front(handler, frame):
+    path = handler.tmp_path / "in" / f"front.{frame:04d}.exr"
+    if not path.exists():
+        write_exr(path, 4, 2)
+    return path
+
+
+def stream(handler, *frames):
+    return handler.stream_window([(frame, front(handler, frame)) for frame in frames])
+
+
+def write_result(handler, frame, mtime=None):
+    path = handler.result_filepath(frame)
+    write_exr(path, 4, 2)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def test_frames_in_order_share_a_generation(handler):
+    stream_dir, skip = stream(handler, 1)
+    assert (stream_dir, skip) == stream(handler, 1)
+    assert stream(handler, 2, 3) == (stream_dir, 1)
+    assert sorted(path.name for path in stream_dir.iterdir()) == [f"front.{f:04d}.exr" for f in (1, 2, 3)]
+
+
+def test_full_generation_moves_to_the_next(handler):
+    first_dir, _ = stream(handler, 1, 2, 3, 4)
+    second_dir, skip = stream(handler, 5)
+    assert second_dir != first_dir and skip == 0
+    # Nothing was read back: the first generation stays
+    assert first_dir.is_dir()
+
+
+def test_read_back_generation_is_reclaimed(handler):
+    first_dir, _ = stream(handler, 1, 2)
+    write_result(handler, 1)
+    write_result(handler, 2)
+    handler.reclaim_stream()
+    assert not first_dir.exists()
+    assert stream(handler, 3)[0] != first_dir
+
+
+def test_base_class_frames_keep_their_generation(handler):
+    first_dir, _ = stream(handler, 10)
+    handler.record_base_frames([10])
+    # Earlier frames start a generation each, up to the bound
+    second_dir, _ = stream(handler, 9)
+    for frame in range(8, 10 - MAX_STREAM_GENERATIONS, -1):
+        stream(handler, frame)
+    # Past the bound, unread generations go but the one the base class
+    # prompt still reads stays
+    handler.reclaim_stream()
+    assert first_dir.is_dir()
+    assert not second_dir.exists()
+
+    write_result(handler, 10)
+    handler.reclaim_stream()
+    assert not first_dir.exists()
+    assert handler.state["base_frames"] == {}
+
+
+def test_base_class_resubmission_waits_for_a_new_result(handler):
+    first_dir, _ = stream(handler, 1)
+    write_result(handler, 1, mtime=time.time() - 60)
+    handler.record_base_frames([1])
+    handler.reclaim_stream()
+    assert first_dir.is_dir()
+
+    handler.clear_base_frames()
+    handler.reclaim_stream()
+    assert not first_dir.exists()
@@ -0,0 +1,44 @@
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+import zdepth_paths
+from zdepth_farm import HANDLER_WORKFLOWS
+from zdepth_farm import FarmWorkflow
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "bench"))
+
+from fake_comfyui_server import FakeComfyUI
+from fake_comfyui_server import write_exr
+
+
+@pytest.fixture(autouse=True)
+def user_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(zdepth_paths, "ZDEPTH_USER_DIR", tmp_path / "user")
+
+
+def run_prompt(comfyui, workflow, timeout=10):
+    prompt_id, _ = comfyui.queue_prompt(workflow)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with comfyui.lock:
+            history = comfyui.history.get(prompt_id)
+        if history is not None:
+            return history["status"]["status_str"]
+        time.sleep(0.01)
+    raise TimeoutError(prompt_id)
+
+
+@pytest.mark.parametrize("handler", sorted(HANDLER_WORKFLOWS))
+@pytest.mark.parametrize("output_format", [None, {"single_channel": True, "half_float": True, "compression": "piz"}])
+def test_result_lands_where_the_farm_reads_it(tmp_path, handler, output_format):
+    front = tmp_path / "in" / "shot.0012.exr"
+    write_exr(front, 8, 4)
+    workflow = FarmWorkflow(HANDLER_WORKFLOWS[handler], str(tmp_path / "out" / "depth"), [], output_format)
+    comfyui = FakeComfyUI(tmp_path, latency=0, width=8, height=4)
+
+    assert run_prompt(comfyui, workflow.frame_workflow(12, front)) == "success"
+    assert workflow.result_path(12).is_file()
+    assert [path.name for path in (tmp_path / "out").iterdir()] == [workflow.result_path(12).name]
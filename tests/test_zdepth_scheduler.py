@@ -0,0 +1,247 @@
+import os
+import stat
+import socket
+
+import pytest
+
+import zdepth_paths
+import zdepth_server
+import zdepth_scheduler
+from zdepth_scheduler import PRIORITY_BATCH
+from zdepth_scheduler import PRIORITY_INTERACTIVE
+from zdepth_scheduler import Scheduler
+from zdepth_scheduler import SchedulerClient
+from zdepth_scheduler import scheduler_path
+from zdepth_paths import peer_uid
+from zdepth_server import ServerPool
+
+
+class FakeServer(object):
+    # In process ComfyUI server: prompts are done once finish() is called
+
+    def __init__(self, address):
+        self.address = address
+        self.prompts = []
+        self.done = set()
+        self.cancelled = []
+
+
+    def queue_length(self):
+        return len([prompt_id for prompt_id in self.prompts if prompt_id not in self.done])
+
+
+    def queue_prompt(self, workflow):
+        prompt_id = f"{self.address}-{len(self.prompts)}"
+        self.prompts.append(prompt_id)
+        return prompt_id
+
+
+    def finish(self, prompt_id):
+        self.done.add(prompt_id)
+
+
+    def prompt_event(self, prompt_id, submitted=None):
+        if prompt_id in self.done:
+            return {"status": "success", "node": None, "progress": None}
+        return None
+
+
+    def is_done(self, prompt_id, submitted=None):
+        return prompt_id in self.done
+
+
+    def execution_seconds(self, prompt_id, submitted=None):
+        return prompt_id in self.done, 1.5 if prompt_id in self.done else None
+
+
+    def cancel_prompt(self, prompt_id):
+        self.cancelled.append(prompt_id)
+
+
+@pytest.fixture
+def user_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(zdepth_paths, "ZDEPTH_USER_DIR", tmp_path / "user")
+    monkeypatch.setattr(zdepth_scheduler, "ZDEPTH_SCHEDULER_DIR", tmp_path / "host" / "scheduler")
+    return tmp_path / "user"
+
+
+@pytest.fixture
+def servers(monkeypatch):
+    fakes = {address: FakeServer(address) for address in ("gpu-a:8188", "gpu-b:8188", "gpu-c:8188")}
+    monkeypatch.setattr(zdepth_server, "_servers", dict(fakes))
+    monkeypatch.setattr(zdepth_scheduler, "ensure_event_relay", lambda address: None)
+    return fakes
+
+
+@pytest.fixture
+def scheduler(user_dir, servers):
+    return Scheduler(user_dir / "servers.json")
+
+
+def submit(scheduler, uid, session, workflow, servers, priority=None, **settings):
+    return scheduler.handle(dict(
+        settings, command="submit", session=session, workflow=workflow, servers=servers, priority=priority,
+        ), uid)["job_id"]
+
+
+def finish_all(scheduler, servers):
+    for job in scheduler.jobs.values():
+        if job["prompt_id"] is not None:
+            servers[job["address"]].finish(job["prompt_id"])
+    scheduler.last_status = 0
+    scheduler.update()
+
+
+def test_socket_in_sticky_host_dir(user_dir, monkeypatch):
+    monkeypatch.setattr(zdepth_scheduler, "ZDEPTH_SCHEDULER_SHARED", True)
+    path = scheduler_path("scheduler.sock")
+    assert path.parent == zdepth_scheduler.ZDEPTH_SCHEDULER_DIR
+    assert stat.S_IMODE(os.stat(path.parent).st_mode) == 0o1777
+
+
+def test_socket_in_private_dir_without_peer_credentials(user_dir, monkeypatch):
+    monkeypatch.setattr(zdepth_scheduler, "ZDEPTH_SCHEDULER_SHARED", False)
+    path = scheduler_path("scheduler.sock")
+    assert path.parent == user_dir / "scheduler"
+    for directory in (user_dir, path.parent):
+        assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+
+
+@pytest.mark.skipif(not hasattr(socket, "SO_PEERCRED"), reason="SO_PEERCRED only")
+def test_peer_uid():
+    a, b = socket.socketpair(socket.AF_UNIX)
+    with a, b:
+        assert peer_uid(a) == os.getuid()
+
+
+def test_jobs_go_to_the_servers_of_their_handler(scheduler, servers):
+    job_a = submit(scheduler, 1000, "flame/a", {"frame": 1}, ["gpu-a:8188"])
+    job_b = submit(scheduler, 1001, "flame/b", {"frame": 2}, ["gpu-b:8188"])
+    scheduler.dispatch()
+
+    assert set(scheduler.pool.servers) == {"gpu-a:8188", "gpu-b:8188"}
+    assert scheduler.jobs[job_a]["address"] == "gpu-a:8188"
+    assert scheduler.jobs[job_b]["address"] == "gpu-b:8188"
+    assert not servers["gpu-c:8188"].prompts
+
+
+def test_residency_settings_are_kept_per_job(scheduler, monkeypatch):
+    budgets = []
+    def mark_resident(address, key):
+        budgets.append((key, scheduler.pool.vram_budget, set(scheduler.pool.pinned)))
+    monkeypatch.setattr(scheduler.pool, "mark_resident", mark_resident)
+
+    submit(
+        scheduler, 1000, "flame/a", {"frame": 1}, ["gpu-a:8188"], affinity="model_a",
+        vram_budget=8 << 30, model_sizes={"model_a": 2 << 30}, pinned=["model_a"],
+        )
+    submit(
+        scheduler, 1001, "flame/b", {"frame": 2}, ["gpu-b:8188"], affinity="model_b",
+        vram_budget=4 << 30, model_sizes={"model_b": 1 << 30},
+        )
+    scheduler.dispatch()
+
+    assert sorted(budgets) == [("model_a", 8 << 30, {"model_a"}), ("model_b", 4 << 30, set())]
+    assert scheduler.pool.model_sizes == {"model_a": 2 << 30, "model_b": 1 << 30}
+
+
+def test_finish_records_latency_and_reports_the_server(scheduler, servers):
+    job_id = submit(scheduler, 1000, "flame/a", {"frame": 1}, ["gpu-a:8188"])
+    scheduler.dispatch()
+    finish_all(scheduler, servers)
+
+    assert scheduler.pool.server_state("gpu-a:8188")["latency"] is not None
+    status = scheduler.handle({"command": "status", "session": "flame/a"}, 1000)["jobs"][job_id]
+    assert status["status"] == "success"
+    assert status["address"] == "gpu-a:8188"
+    assert status["seconds"] == 1.5
+
+
+def test_servers_are_never_given_more_than_their_depth(scheduler, servers):
+    for frame in range(5):
+        submit(scheduler, 1000, "flame/a", {"frame": frame}, ["gpu-a:8188"])
+    scheduler.dispatch()
+
+    assert len(servers["gpu-a:8188"].prompts) == zdepth_scheduler.SERVER_DEPTH
+    finish_all(scheduler, servers)
+    scheduler.dispatch()
+    assert len(servers["gpu-a:8188"].prompts) == 2 * zdepth_scheduler.SERVER_DEPTH
+
+
+def test_interactive_before_batch(scheduler, servers):
+    for frame in range(3):
+        submit(scheduler, 1000, "flame/a", {"frame": frame}, ["gpu-a:8188"], PRIORITY_BATCH)
+    interactive = submit(scheduler, 1000, "flame/b", {"frame": 10}, ["gpu-a:8188"], PRIORITY_INTERACTIVE)
+    scheduler.dispatch()
+
+    assert scheduler.jobs[interactive]["status"] == "queued"
+
+
+def test_users_share_the_servers_fairly(scheduler):
+    # Two sessions of one user weigh as much as the single session of another
+    jobs_a = [submit(scheduler, 1000, f"flame/a{frame % 2}", {"frame": frame}, ["gpu-a:8188"]) for frame in range(4)]
+    job_b = submit(scheduler, 1001, "flame/b", {"frame": 10}, ["gpu-a:8188"])
+    scheduler.dispatch()
+
+    assert scheduler.jobs[jobs_a[0]]["status"] == "queued"
+    assert scheduler.jobs[jobs_a[1]]["status"] == "pending"
+    assert scheduler.jobs[job_b]["status"] == "queued"
+    assert scheduler.snapshot()["users"][zdepth_scheduler.user_name(1000)]["running"] == 1
+
+
+def test_users_only_see_and_cancel_their_own_jobs(scheduler):
+    job_id = submit(scheduler, 1000, "flame/a", {"frame": 1}, ["gpu-a:8188"])
+    assert scheduler.handle({"command": "status", "session": "flame/a"}, 1001)["jobs"] == {}
+
+    scheduler.handle({"command": "cancel", "session": "flame/a"}, 1001)
+    assert not scheduler.jobs[job_id]["cancelled"]
+
+
+def test_identical_prompts_are_shared(scheduler, servers):
+    job_a = submit(scheduler, 1000, "flame/a", {"frame": 1}, ["gpu-a:8188"])
+    job_b = submit(scheduler, 1001, "flame/b", {"frame": 1}, ["gpu-a:8188"])
+    assert job_a == job_b
+
+    scheduler.handle({"command": "cancel", "session": "flame/a"}, 1000)
+    scheduler.dispatch()
+    assert scheduler.jobs[job_a]["status"] == "queued"
+    assert scheduler.handle({"command": "status", "session": "flame/a"}, 1000)["jobs"][job_a]["status"] == "cancelled"
+
+
+def test_cancel_pending_and_dispatched(scheduler, servers):
+    job_id = submit(scheduler, 1000, "flame/a", {"frame": 1}, ["gpu-a:8188"])
+    scheduler.dispatch()
+    scheduler.handle({"command": "cancel", "session": "flame/a", "job_ids": [job_id]}, 1000)
+    scheduler.update()
+
+    assert scheduler.jobs[job_id]["status"] == "cancelled"
+    assert servers["gpu-a:8188"].cancelled == [scheduler.jobs[job_id]["prompt_id"]]
+
+
+def test_client_sends_the_pool_settings(user_dir, servers, monkeypatch):
+    pool = ServerPool(["gpu-b:8188", "gpu-c:8188"], user_dir / "servers.json", vram_budget=4 << 30)
+    pool.model_sizes = {"model": 1 << 30}
+    pool.pinned = {"model"}
+    requests = []
+    client = SchedulerClient("flame/a")
+    monkeypatch.setattr(client, "request", lambda command, **payload: requests.append(payload) or {"job_id": "1"})
+
+    assert client.queue_prompt({"frame": 1}, "model", {"gpu-c:8188"}, PRIORITY_BATCH, pool) == "1"
+    assert requests[0]["servers"] == ["gpu-b:8188", "gpu-c:8188"]
+    assert requests[0]["vram_budget"] == 4 << 30
+    assert requests[0]["model_sizes"] == {"model": 1 << 30}
+    assert requests[0]["pinned"] == ["model"]
+    assert requests[0]["exclude"] == ["gpu-c:8188"]
+
+
+def test_jobs_of_dead_servers_do_not_hold_back_others(scheduler, servers):
+    def unreachable(workflow):
+        raise zdepth_server.ComfyUIServerError("gpu-a:8188: unreachable")
+
+    servers["gpu-a:8188"].queue_prompt = unreachable
+    stuck = submit(scheduler, 1000, "flame/a", {"frame": 1}, ["gpu-a:8188"])
+    job_id = submit(scheduler, 1001, "flame/b", {"frame": 2}, ["gpu-b:8188"])
+    scheduler.dispatch()
+
+    assert scheduler.jobs[stuck]["status"] == "pending"
+    assert scheduler.jobs[job_id]["address"] == "gpu-b:8188"
@@ -0,0 +1,51 @@
+##########################################################################
+#
+# Filename: zdepth_budget.py
+#
+# Author: Julien Martin
+# Created: 2024-03
+#
+###########################################################################
+from __future__ import print_function
+
+import math
+
+
+COST_SMOOTHING = 0.3
+
+
+class TimeBudget(object):
+    # Marigold time is roughly linear in denoise_steps * n_repeat: keep a
+    # smoothed per-unit cost and size the next frame's work from it
+
+    def __init__(self, state):
+        self.state = state
+        state.setdefault("unit_cost", None)
+
+
+    def record(self, seconds, denoise_steps, n_repeat):
+        units = max(1, denoise_steps * n_repeat)
+        unit_cost = seconds / units
+        previous = self.state["unit_cost"]
+        self.state["unit_cost"] = unit_cost if previous is None else (1 - COST_SMOOTHING) * previous + COST_SMOOTHING * unit_cost
+
+
+    def choose(self, target, denoise_steps_bounds, n_repeat_bounds):
+        min_steps, max_steps = denoise_steps_bounds
+        min_repeat, max_repeat = n_repeat_bounds
+        unit_cost = self.state["unit_cost"]
+        if unit_cost is None or unit_cost <= 0:
+            # Nothing measured yet: start cheap and grow from there
+            return min_steps, min_repeat
+
+        units = max(1.0, target / unit_cost)
+        if units >= max_steps * max_repeat:
+            return max_steps, max_repeat
+
+        # Scale both parameters evenly from the upper bounds, then give
+        # the units left by clamping to the other one
+        scale = math.sqrt(units / (max_steps * max_repeat))
+        denoise_steps = min(max_steps, max(min_steps, int(max_steps * scale)))
+        n_repeat = min(max_repeat, max(min_repeat, int(units // denoise_steps)))
+        denoise_steps = min(max_steps, max(min_steps, int(units // n_repeat)))
+        return denoise_steps, n_repeat
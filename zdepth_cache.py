@@ -0,0 +1,168 @@
+##########################################################################
+#
+# Filename: zdepth_cache.py
+#
+# Author: Julien Martin
+# Created: 2024-03
+#
+###########################################################################
+from __future__ import print_function
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import contextlib
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+ZDEPTH_CACHE_DIR = Path(os.environ.get(
+    "COMFYUI_ZDEPTH_CACHE_DIR",
+    Path.home() / ".cache" / "comfyui_zdepth"
+    ))
+
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_or_copy(src, dst):
+    dst = Path(dst)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dst = dst.with_name(f".{dst.name}.tmp")
+    try:
+        if tmp_dst.exists():
+            tmp_dst.unlink()
+        os.link(src, tmp_dst)
+    except OSError:
+        shutil.copyfile(src, tmp_dst)
+    tmp_dst.replace(dst)
+
+
+class DepthCache(object):
+
+    def __init__(self, root=ZDEPTH_CACHE_DIR, max_bytes=0):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.index_path = self.root / "index.json"
+        self.lock_path = self.root / "index.lock"
+        self.index = None
+
+
+    ###################################
+    # Index
+
+    def load_index(self):
+        if self.index is None:
+            try:
+                with open(self.index_path) as f:
+                    self.index = json.load(f)
+            except (OSError, ValueError):
+                self.index = {"entries": {}, "hits": 0, "misses": 0}
+        return self.index
+
+
+    @contextlib.contextmanager
+    def locked_index(self):
+        # The handlers, the session helpers and the farm share the index:
+        # each read-modify-write holds the lock and starts from the file
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self.index = None
+                yield self.load_index()
+                self.save_index()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+    def save_index(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        tmp_path.replace(self.index_path)
+
+
+    def entry_path(self, key):
+        return self.root / key[:2] / f"{key}.exr"
+
+
+    def size(self):
+        return sum(entry["size"] for entry in self.load_index()["entries"].values())
+
+
+    def stats(self):
+        index = self.load_index()
+        return {
+            "hits": index["hits"],
+            "misses": index["misses"],
+            "entries": len(index["entries"]),
+            "bytes": self.size(),
+            }
+
+
+    ###################################
+    # Keys
+
+    def key(self, front_path, workflow):
+        digest = hashlib.sha256()
+        digest.update(file_digest(front_path).encode())
+        digest.update(json.dumps(workflow, sort_keys=True).encode())
+        return digest.hexdigest()
+
+
+    ###################################
+    # Lookup & store
+
+    def fetch(self, key, dst):
+        with self.locked_index() as index:
+            entry = index["entries"].get(key)
+            path = self.entry_path(key)
+            if entry is None or not path.exists():
+                index["entries"].pop(key, None)
+                index["misses"] += 1
+                return False
+
+            link_or_copy(path, dst)
+            entry["used"] = time.time()
+            index["hits"] += 1
+            return True
+
+
+    def store(self, key, src):
+        if self.max_bytes <= 0:
+            return
+        with self.locked_index() as index:
+            path = self.entry_path(key)
+            link_or_copy(src, path)
+            index["entries"][key] = {"size": path.stat().st_size, "used": time.time()}
+            self.evict()
+
+
+    def evict(self):
+        entries = self.load_index()["entries"]
+        total = sum(entry["size"] for entry in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]["used"]):
+            if total <= self.max_bytes:
+                break
+            total -= entries.pop(key)["size"]
+            try:
+                self.entry_path(key).unlink()
+            except OSError:
+                pass
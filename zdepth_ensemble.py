@@ -0,0 +1,75 @@
+##########################################################################
+#
+# Filename: zdepth_ensemble.py
+#
+# Author: Julien Martin
+# Created: 2024-03
+#
+###########################################################################
+from __future__ import print_function
+
+import hashlib
+
+import numpy as np
+
+from zdepth_cache import ZDEPTH_CACHE_DIR
+from zdepth_cache import DepthCache
+
+
+MEMBERS_DIR = ZDEPTH_CACHE_DIR / "members"
+
+FIT_SAMPLES = 1 << 16
+
+# Marigold inputs which only shape the ensemble, not the members
+ENSEMBLE_INPUTS = ("seed", "n_repeat", "n_repeat_batch_size", "reduction_method", "regularizer_strength", "max_iter", "tol")
+
+
+def member_seeds(seed, n_repeat):
+    # Member i always gets the same seed: raising n_repeat adds members
+    return [seed + i for i in range(n_repeat)]
+
+
+def member_key(ensemble_key, seed):
+    return hashlib.sha256(f"{ensemble_key}:{seed}".encode()).hexdigest()
+
+
+class MemberStore(DepthCache):
+    # Depth cache of the individual predictions of an ensemble
+
+    def __init__(self, root=MEMBERS_DIR, max_bytes=0):
+        super().__init__(root, max_bytes)
+
+
+def reduce_depths(depths, reduction):
+    return np.median(depths, axis=0) if reduction == "median" else np.mean(depths, axis=0)
+
+
+def ensemble_depths(members, reduction="median", regularizer_strength=0.1, max_iter=5, tol=1e-3):
+    # Every member gets the scale and shift which best fits the reduced
+    # depth, iterated. The regularizer pulls the reduced depth towards
+    # the 0-1 range, the result is stretched to 0-1 like Marigold does.
+    depths = np.stack([np.asarray(member, dtype=np.float32) for member in members])
+    count = len(depths)
+    flat = depths.reshape(count, -1)
+    sample = flat[:, ::max(1, flat.shape[1] // FIT_SAMPLES)]
+    scales = np.ones(count, dtype=np.float32)
+    shifts = np.zeros(count, dtype=np.float32)
+    for _ in range(max_iter if count > 1 else 0):
+        target = reduce_depths(sample * scales[:, None] + shifts[:, None], reduction)
+        low, high = target.min(), target.max()
+        if high > low:
+            target = (1 - regularizer_strength) * target + regularizer_strength * (target - low) / (high - low)
+        sample_mean = sample.mean(axis=1)
+        covariance = ((sample - sample_mean[:, None]) * (target - target.mean())).mean(axis=1)
+        new_scales = covariance / np.maximum(sample.var(axis=1), 1e-12)
+        new_shifts = target.mean() - new_scales * sample_mean
+        change = max(np.abs(new_scales - scales).max(), np.abs(new_shifts - shifts).max())
+        scales, shifts = new_scales.astype(np.float32), new_shifts.astype(np.float32)
+        if change < tol:
+            break
+
+    depths *= scales[:, None, None]
+    depths += shifts[:, None, None]
+    depth = reduce_depths(depths, reduction)
+    low, high = depth.min(), depth.max()
+    return (depth - low) / (high - low) if high > low else depth - low
@@ -0,0 +1,366 @@
+##########################################################################
+#
+# Filename: zdepth_events.py
+#
+# Author: Julien Martin
+# Created: 2024-03
+#
+###########################################################################
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import base64
+import socket
+import struct
+import subprocess
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from zdepth_paths import private_dir
+from zdepth_paths import user_id
+
+
+# ComfyUI only sends execution events to the client which queued the
+# prompt: every handler of this user on this host queues with the client
+# id of the user's relay
+COMFYUI_ZDEPTH_CLIENT_ID = f"zdepth-{socket.gethostname()}-{user_id()}"
+
+COMFYUI_ZDEPTH_EVENTS = os.environ.get("COMFYUI_ZDEPTH_EVENTS", "1") != "0"
+
+HEARTBEAT_INTERVAL = 1.0
+HEARTBEAT_TIMEOUT = 5.0
+FLUSH_INTERVAL = 0.05
+RECONNECT_DELAY = 2.0
+IDLE_TIMEOUT = 600
+FINISHED_PROMPT_TTL = 600
+
+FINISHED_STATUSES = ("success", "error", "interrupted")
+
+WS_TEXT = 0x1
+WS_BINARY = 0x2
+WS_CLOSE = 0x8
+WS_PING = 0x9
+WS_PONG = 0xA
+
+
+class WebSocketRefused(Exception):
+    pass
+
+
+def events_path(address):
+    # Per user: no other local user can plant events of the prompts
+    return private_dir("events") / f"{address.replace(':', '_')}.json"
+
+
+###########################################################################
+# Minimal websocket client
+
+class WebSocket(object):
+
+    def __init__(self, host, port, path, timeout=HEARTBEAT_INTERVAL):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.buffer = b""
+        self.message = b""
+        self.message_opcode = None
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.sock.sendall((
+            f"GET {path} HTTP/1.1\r\n"
+            f"Host: {host}:{port}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n\r\n"
+            ).encode())
+        while b"\r\n\r\n" not in self.buffer:
+            self.fill()
+        response, _, self.buffer = self.buffer.partition(b"\r\n\r\n")
+        if not response.startswith(b"HTTP/1.1 101"):
+            raise WebSocketRefused(f'Websocket upgrade refused: {response.splitlines()[0]!r}')
+
+
+    def fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise ConnectionError("Websocket closed")
+        self.buffer += data
+
+
+    def frame(self):
+        # Next complete frame, None while it is still being received so a
+        # timeout never leaves a frame half consumed
+        if len(self.buffer) < 2:
+            return None
+        first, second = self.buffer[0], self.buffer[1]
+        length, offset = second & 0x7F, 2
+        if length == 126:
+            if len(self.buffer) < 4:
+                return None
+            length, = struct.unpack(">H", self.buffer[2:4])
+            offset = 4
+        elif length == 127:
+            if len(self.buffer) < 10:
+                return None
+            length, = struct.unpack(">Q", self.buffer[2:10])
+            offset = 10
+        if len(self.buffer) < offset + length:
+            return None
+        payload = self.buffer[offset:offset + length]
+        self.buffer = self.buffer[offset + length:]
+        return first & 0x80, first & 0x0F, payload
+
+
+    def send(self, opcode, payload=b""):
+        # Client frames are masked
+        mask = os.urandom(4)
+        header = bytes([0x80 | opcode])
+        if len(payload) < 126:
+            header += bytes([0x80 | len(payload)])
+        elif len(payload) < 1 << 16:
+            header += bytes([0x80 | 126]) + struct.pack(">H", len(payload))
+        else:
+            header += bytes([0x80 | 127]) + struct.pack(">Q", len(payload))
+        masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        self.sock.sendall(header + mask + masked)
+
+
+    def recv(self):
+        # Next text message, None for binary messages (previews)
+        while True:
+            frame = self.frame()
+            if frame is None:
+                self.fill()
+                continue
+            fin, opcode, payload = frame
+            if opcode == WS_PING:
+                self.send(WS_PONG, payload)
+                continue
+            if opcode == WS_CLOSE:
+                raise ConnectionError("Websocket closed by the server")
+            if opcode in (WS_TEXT, WS_BINARY):
+                self.message_opcode = opcode
+                self.message = b""
+            self.message += payload
+            if fin:
+                return self.message.decode() if self.message_opcode == WS_TEXT else None
+
+
+    def close(self):
+        try:
+            self.send(WS_CLOSE)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+###########################################################################
+# Relay: one process and one websocket per server and host
+
+class EventRelay(object):
+
+    def __init__(self, address):
+        self.address = address
+        host, _, port = address.partition(":")
+        self.host = host
+        self.port = int(port) if port else 8188
+        self.path = events_path(address)
+        self.events = {
+            "heartbeat": 0, "retry_after": 0, "connected_since": None, "queue_remaining": None, "prompts": {},
+            }
+        self.dirty = True
+        self.last_flush = 0
+        self.last_event = time.time()
+
+
+    def flush(self, force=False):
+        now = time.time()
+        if not force and (not self.dirty or now - self.last_flush < FLUSH_INTERVAL) \
+                and now - self.events["heartbeat"] < HEARTBEAT_INTERVAL:
+            return
+        prompts = self.events["prompts"]
+        for prompt_id, prompt in list(prompts.items()):
+            if prompt["status"] in FINISHED_STATUSES and now - prompt["time"] > FINISHED_PROMPT_TTL:
+                del prompts[prompt_id]
+        self.events["heartbeat"] = now
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.events, f)
+        tmp_path.replace(self.path)
+        self.dirty = False
+        self.last_flush = now
+
+
+    def handle(self, message):
+        message = json.loads(message)
+        event, data = message.get("type"), message.get("data") or {}
+        if event == "status":
+            self.events["queue_remaining"] = data.get("status", {}).get("exec_info", {}).get("queue_remaining")
+            self.dirty = True
+            return
+        prompt_id = data.get("prompt_id")
+        if prompt_id is None:
+            return
+
+        self.last_event = time.time()
+        prompt = self.events["prompts"].setdefault(prompt_id, {"status": "running", "node": None, "progress": None})
+        prompt["time"] = self.last_event
+        if event == "executing":
+            if data.get("node") is None:
+                if prompt["status"] == "running":
+                    prompt["status"] = "success"
+            else:
+                prompt["node"] = data["node"]
+                prompt["progress"] = None
+        elif event == "progress":
+            prompt["node"] = data.get("node", prompt["node"])
+            prompt["progress"] = [data.get("value"), data.get("max")]
+        elif event == "execution_success":
+            prompt["status"] = "success"
+        elif event == "execution_error":
+            prompt["status"] = "error"
+            prompt["node"] = data.get("node_id")
+            prompt["error"] = f'{data.get("node_type")}: {data.get("exception_message", "").strip()}'
+        elif event == "execution_interrupted":
+            prompt["status"] = "interrupted"
+        elif event == "execution_start":
+            prompt["started"] = self.last_event
+        if prompt["status"] in FINISHED_STATUSES:
+            prompt.setdefault("finished", self.last_event)
+        self.dirty = True
+
+
+    def run(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        lock = open(self.path.with_suffix(".lock"), "w")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # Another relay already listens to this server
+                return
+
+        while time.time() - self.last_event < IDLE_TIMEOUT:
+            try:
+                ws = WebSocket(self.host, self.port, f"/ws?clientId={COMFYUI_ZDEPTH_CLIENT_ID}")
+            except WebSocketRefused as e:
+                # No event stream on this server: handlers keep polling
+                # and do not start another relay for a while
+                print(f'No events from {self.address}: {e}')
+                self.events["retry_after"] = time.time() + IDLE_TIMEOUT
+                self.flush(force=True)
+                return
+            except OSError as e:
+                print(f'Unable to connect to {self.address}: {e}')
+                self.flush(force=True)
+                time.sleep(RECONNECT_DELAY)
+                continue
+
+            # Prompts queued before this point may have missed events
+            self.events["connected_since"] = time.time()
+            self.flush(force=True)
+            try:
+                while time.time() - self.last_event < IDLE_TIMEOUT:
+                    # Short timeouts while throttled events wait to be written
+                    ws.sock.settimeout(FLUSH_INTERVAL if self.dirty else HEARTBEAT_INTERVAL)
+                    try:
+                        message = ws.recv()
+                    except socket.timeout:
+                        message = None
+                    if message is not None:
+                        self.handle(message)
+                    self.flush()
+            except (OSError, ValueError) as e:
+                print(f'Lost events of {self.address}: {e}')
+                self.events["connected_since"] = None
+                self.flush(force=True)
+            finally:
+                ws.close()
+
+        try:
+            self.path.unlink()
+        except OSError:
+            pass
+
+
+###########################################################################
+# Handler side
+
+class ServerEvents(object):
+
+    def __init__(self, address):
+        self.address = address
+        self.path = None
+        self.events = None
+        self.mtime = None
+
+
+    def load(self):
+        try:
+            if self.path is None:
+                self.path = events_path(self.address)
+            mtime = self.path.stat().st_mtime_ns
+            if mtime != self.mtime:
+                with open(self.path) as f:
+                    self.events = json.load(f)
+                self.mtime = mtime
+        except (OSError, ValueError):
+            self.events = None
+        return self.events
+
+
+    def running(self):
+        events = self.load()
+        return bool(events) and (time.time() - events["heartbeat"] < HEARTBEAT_TIMEOUT
+                                 or time.time() < events["retry_after"])
+
+
+    def alive(self):
+        events = self.load()
+        return bool(events) and events["connected_since"] is not None \
+            and time.time() - events["heartbeat"] < HEARTBEAT_TIMEOUT
+
+
+    def prompt(self, prompt_id, submitted=None):
+        # Pushed state of the prompt. A prompt queued while connected
+        # without any event yet is still pending. None when unknown.
+        if not COMFYUI_ZDEPTH_EVENTS or not self.alive():
+            return None
+        prompt = self.events["prompts"].get(prompt_id)
+        if prompt is None and submitted is not None and self.events["connected_since"] < submitted:
+            return {"status": "pending", "node": None, "progress": None}
+        return prompt
+
+
+    def queue_remaining(self):
+        if not COMFYUI_ZDEPTH_EVENTS or not self.alive():
+            return None
+        return self.events["queue_remaining"]
+
+
+def ensure_event_relay(address):
+    # Without a relay the handlers poll the server over HTTP
+    try:
+        if not COMFYUI_ZDEPTH_EVENTS or ServerEvents(address).running():
+            return
+        log = open(events_path(address).with_suffix(".log"), "a")
+        subprocess.Popen(
+            [sys.executable, str(Path(__file__).resolve()), address],
+            stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+            start_new_session=True, close_fds=True,
+            )
+        log.close()
+    except OSError as e:
+        print(f'Unable to start the event relay of {address}: {e}')
+
+
+def _main(argv):
+    EventRelay(argv[0]).run()
+
+if __name__ == "__main__":
+    _main(sys.argv[1:])
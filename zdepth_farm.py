@@ -0,0 +1,318 @@
+##########################################################################
+#
+# Filename: zdepth_farm.py
+#
+# Author: Julien Martin
+# Created: 2024-03
+#
+###########################################################################
+from __future__ import print_function
+
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+
+from zdepth_events import ensure_event_relay
+from zdepth_paths import private_dir
+from zdepth_server import COMFYUI_ZDEPTH_SERVERS
+from zdepth_server import DEFAULT_COMFYUI_ADDRESS
+from zdepth_server import ComfyUIServerError
+from zdepth_server import ServerPool
+from zdepth_workflow import load_workflow_template
+from zdepth_workflow import result_path
+
+
+WORKFLOWS_DIR = Path(__file__).resolve().parent
+
+HANDLER_WORKFLOWS = {
+    "depth_anything": WORKFLOWS_DIR / "comfyui_zdepth_depth_anything_workflow_api.json",
+    "marigold": WORKFLOWS_DIR / "comfyui_zdepth_marigold_workflow_api.json",
+    }
+
+# Node input --model sets, per handler
+HANDLER_MODEL_INPUTS = {
+    "depth_anything": ("DownloadAndLoadDepthAnythingV2Model", "model"),
+    }
+
+DEFAULT_IN_FLIGHT = 2
+DEFAULT_RETRIES = 1
+DEFAULT_OUTAGE_TIMEOUT = 600
+POLL_INTERVAL = 0.5
+RETRY_DELAY = 2.0
+MAX_RETRY_DELAY = 60.0
+
+
+###########################################################################
+# Arguments
+
+def parse_frames(frames):
+    start, _, end = frames.partition("-")
+    return list(range(int(start), int(end or start) + 1))
+
+
+def parse_shard(shard):
+    index, _, count = shard.partition("/")
+    index, count = int(index), int(count)
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f'Invalid shard {shard}, expected index/count with 1 <= index <= count')
+    return index, count
+
+
+def shard_frames(frames, index, count):
+    # Contiguous slices keep neighbouring frames on the same worker
+    size, extra = divmod(len(frames), count)
+    start = (index - 1) * size + min(index - 1, extra)
+    return frames[start:start + size + (1 if index <= extra else 0)]
+
+
+def parse_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def input_path(pattern, frame):
+    # shot.####.exr or shot.%04d.exr
+    if "#" in pattern:
+        padding = pattern.count("#")
+        return Path(pattern.replace("#" * padding, f"{frame:0{padding}d}"))
+    return Path(pattern % frame)
+
+
+###########################################################################
+# Workflow patching
+
+class FarmWorkflow(object):
+
+    def __init__(self, workflow_path, output_prefix, overrides, output_format=None):
+        self.template = load_workflow_template(str(workflow_path))
+        self.load_exr_idx = self.template.index("LoadEXR")
+        self.save_exr_idx = self.template.save_exr_index("Result")
+        self.output_prefix = output_prefix
+        self.output_format = output_format
+        self.frame_pad = self.template.inputs(self.save_exr_idx)["frame_pad"]
+        # Overrides are checked once, before any frame is queued
+        self.overrides = []
+        for class_type, name, value in overrides:
+            idx = self.template.index(class_type)
+            if idx == -1:
+                raise ValueError(f'No {class_type} node in {workflow_path}')
+            self.overrides.append((idx, name, value))
+
+
+    def frame_workflow(self, frame, front_path):
+        workflow = self.template.instantiate()
+        for idx, name, value in self.overrides:
+            workflow[idx]["inputs"][name] = value
+        load_exr_inputs = workflow[self.load_exr_idx]["inputs"]
+        load_exr_inputs["filepath"] = str(front_path)
+        load_exr_inputs["image_load_cap"] = 0
+        load_exr_inputs["skip_first_images"] = 0
+        load_exr_inputs["select_every_nth"] = 1
+        save_exr_inputs = workflow[self.save_exr_idx]["inputs"]
+        save_exr_inputs["filename_prefix"] = self.output_prefix
+        save_exr_inputs["start_frame"] = frame
+        if self.output_format:
+            # Same node swap as the handlers' result format options, without
+            # the version suffix result_path does not expect
+            save_exr_inputs.update(self.output_format, version=-1)
+            workflow[self.save_exr_idx] = dict(workflow[self.save_exr_idx], class_type="SaveDepthEXR")
+        return workflow
+
+
+    def result_path(self, frame):
+        return result_path(self.output_prefix, frame, self.frame_pad)
+
+
+###########################################################################
+# Checkpoint & manifest
+
+class Checkpoint(object):
+
+    def __init__(self, path):
+        self.path = Path(path)
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {"done": {}, "failed": {}}
+
+
+    def is_done(self, frame, result):
+        return str(frame) in self.data["done"] and Path(result).is_file()
+
+
+    def done(self, frame, result, seconds, address):
+        self.data["done"][str(frame)] = {"result": str(result), "seconds": round(seconds, 3), "server": address}
+        self.data["failed"].pop(str(frame), None)
+        self.save()
+
+
+    def failed(self, frame, reason):
+        self.data["failed"][str(frame)] = reason
+        self.save()
+
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f, indent=2)
+        tmp_path.replace(self.path)
+
+
+###########################################################################
+# Rendering
+
+def render(args):
+    frames = shard_frames(parse_frames(args.frames), *args.shard)
+    shard_name = f"shard{args.shard[0]}of{args.shard[1]}"
+    overrides = []
+    for override in args.set:
+        key, _, value = override.partition("=")
+        class_type, _, name = key.rpartition(".")
+        overrides.append((class_type, name, parse_value(value)))
+    if args.model:
+        overrides.append(HANDLER_MODEL_INPUTS[args.handler] + (args.model,))
+
+    output_format = None
+    if args.single_channel or args.half_float or args.compression != "zip":
+        output_format = {
+            "single_channel": args.single_channel,
+            "half_float": args.half_float,
+            "compression": args.compression,
+            }
+    try:
+        workflow = FarmWorkflow(args.workflow or HANDLER_WORKFLOWS[args.handler], args.output, overrides, output_format)
+    except ValueError as e:
+        print(f'{shard_name}: {e}')
+        return 2
+    output_dir = Path(args.output).parent
+    checkpoint = Checkpoint(output_dir / f"{Path(args.output).name}.{shard_name}.checkpoint.json")
+    pool = ServerPool(args.servers, private_dir() / "servers.json")
+    for address in pool.servers:
+        ensure_event_relay(address)
+
+    todo = [f for f in frames if not checkpoint.is_done(f, workflow.result_path(f))]
+    print(f'{shard_name}: {len(frames)} frames, {len(frames) - len(todo)} already done')
+
+    attempts = {}
+    in_flight = {}
+    # Server outage: frames wait for the pool to come back, with an
+    # exponential backoff, until it has been down for the outage timeout
+    outage_since = None
+    retry_delay = RETRY_DELAY
+    retry_at = 0
+    start = time.time()
+    while todo or in_flight:
+        # Queue lengths and dead servers as of this round
+        pool.state = None
+        pool.queue_lengths = {}
+        while todo and len(in_flight) < args.in_flight and time.time() >= retry_at:
+            frame = todo.pop(0)
+            front_path = input_path(args.input, frame)
+            if not front_path.is_file():
+                print(f'Frame {frame}: missing input {front_path}')
+                checkpoint.failed(frame, "missing input")
+                continue
+            try:
+                address, prompt_id = pool.queue_prompt(workflow.frame_workflow(frame, front_path))
+            except ComfyUIServerError as e:
+                outage_since = outage_since or time.time()
+                if time.time() - outage_since > args.outage_timeout:
+                    print(f'No server for {args.outage_timeout}s, giving up: {e}')
+                    for frame in [frame] + todo:
+                        checkpoint.failed(frame, str(e))
+                    todo = []
+                    break
+                print(f'Frame {frame}: {e}, retrying in {retry_delay:.0f}s')
+                todo.insert(0, frame)
+                retry_at = time.time() + retry_delay
+                retry_delay = min(MAX_RETRY_DELAY, 2 * retry_delay)
+                break
+            outage_since = None
+            retry_delay = RETRY_DELAY
+            in_flight[frame] = (address, prompt_id, time.time())
+
+        time.sleep(POLL_INTERVAL)
+        for frame, (address, prompt_id, submitted) in list(in_flight.items()):
+            result = workflow.result_path(frame)
+            if result.is_file():
+                seconds = time.time() - submitted
+                pool.record_latency(address, seconds)
+                checkpoint.done(frame, result, seconds, address)
+                del in_flight[frame]
+                print(f'Frame {frame}: done in {seconds:.1f}s on {address}')
+                continue
+            event = pool.server(address).prompt_event(prompt_id, submitted)
+            if event is not None and event["status"] == "error":
+                print(f'Frame {frame}: failed on node {event["node"]}: {event.get("error")}')
+                checkpoint.failed(frame, event.get("error"))
+                del in_flight[frame]
+                continue
+            try:
+                finished = pool.server(address).is_done(prompt_id, submitted)
+            except ComfyUIServerError as e:
+                # Lost with its server: queued again on the rest of the
+                # pool, without using up one of its retries
+                print(f'Frame {frame}: {e}, queueing it again')
+                pool.mark_dead(address)
+                del in_flight[frame]
+                todo.insert(0, frame)
+                continue
+            if finished:
+                del in_flight[frame]
+                attempts[frame] = attempts.get(frame, 0) + 1
+                if attempts[frame] <= args.retries:
+                    print(f'Frame {frame}: no result from {address}, retrying')
+                    todo.insert(0, frame)
+                else:
+                    checkpoint.failed(frame, f'no result from {address}')
+
+    manifest = {
+        "handler": args.handler,
+        "workflow": str(args.workflow or HANDLER_WORKFLOWS[args.handler]),
+        "overrides": [list(o) for o in overrides],
+        "shard": list(args.shard),
+        "frames": frames,
+        "done": checkpoint.data["done"],
+        "failed": checkpoint.data["failed"],
+        "seconds": round(time.time() - start, 3),
+        }
+    manifest_path = output_dir / f"{Path(args.output).name}.{shard_name}.manifest.json"
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    print(f'{shard_name}: {len(checkpoint.data["done"])} done, {len(checkpoint.data["failed"])} failed, '
+          f'manifest {manifest_path}')
+    return 1 if checkpoint.data["failed"] else 0
+
+
+def _main(argv):
+    parser = argparse.ArgumentParser(description="Headless ZDepth depth pass over a shard of an EXR sequence")
+    parser.add_argument("handler", choices=sorted(HANDLER_WORKFLOWS))
+    parser.add_argument("--input", required=True, help="Front sequence on the server mount, shot.####.exr or shot.%%04d.exr")
+    parser.add_argument("--output", required=True, help="Result filename prefix on the server mount")
+    parser.add_argument("--frames", required=True, help="Frame range, e.g. 1001-1100")
+    parser.add_argument("--shard", type=parse_shard, default=(1, 1), help="Slice of the range to render, e.g. 3/8")
+    parser.add_argument("--workflow", help="API workflow, the bundled one of the handler by default")
+    parser.add_argument("--model", help="Depth Anything model")
+    parser.add_argument("--set", action="append", default=[], metavar="CLASS.INPUT=VALUE",
+                        help="Node input override, e.g. MarigoldDepthEstimation.n_repeat=5")
+    parser.add_argument("--single-channel", action="store_true", help="Write the depth as a single Y channel")
+    parser.add_argument("--half-float", action="store_true", help="Store the depth as 16 bit half float")
+    parser.add_argument("--compression", choices=["zip", "piz", "dwaa", "none"], default="zip")
+    parser.add_argument("--servers", type=lambda s: s.split(","), default=COMFYUI_ZDEPTH_SERVERS or [DEFAULT_COMFYUI_ADDRESS])
+    parser.add_argument("--in-flight", type=int, default=DEFAULT_IN_FLIGHT)
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES)
+    parser.add_argument("--outage-timeout", type=float, default=DEFAULT_OUTAGE_TIMEOUT,
+                        help="Seconds to wait for a server to come back before failing the remaining frames")
+    args = parser.parse_args(argv)
+    if args.model and args.handler not in HANDLER_MODEL_INPUTS:
+        parser.error(f'--model is not supported by the {args.handler} handler')
+    return render(args)
+
+if __name__ == "__main__":
+    sys.exit(_main(sys.argv[1:]))
@@ -0,0 +1,233 @@
+##########################################################################
+#
+# Filename: zdepth_helper.py
+#
+# Author: Julien Martin
+# Created: 2024-03
+#
+###########################################################################
+from __future__ import print_function
+
+# Imported before anything else by the handlers: standard library only,
+# the point is to leave the heavy imports to the helper process
+import io
+import os
+import sys
+import json
+import time
+import socket
+import traceback
+import importlib
+import subprocess
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from zdepth_paths import peer_uid
+from zdepth_paths import private_dir
+
+
+COMFYUI_ZDEPTH_HELPER = os.environ.get("COMFYUI_ZDEPTH_HELPER", "1") != "0" and hasattr(socket, "AF_UNIX")
+
+CONNECT_TIMEOUT = 0.5
+# A pybox exchange may wait on the server: only a dead helper times out
+REQUEST_TIMEOUT = 600
+ACCEPT_TIMEOUT = 1.0
+IDLE_TIMEOUT = 1800
+
+
+def helper_path(handler_path, session, suffix):
+    # In the per user tree: no other local user can reach the socket
+    name = os.path.splitext(os.path.basename(handler_path))[0]
+    return os.path.join(private_dir("helpers"), f"{name}-{session}{suffix}")
+
+
+def code_signature(handler_path):
+    # The helper only serves the code it loaded: any edit of the handlers
+    # checkout starts a new one
+    directory = os.path.dirname(os.path.abspath(handler_path))
+    return max(
+        os.stat(os.path.join(directory, name)).st_mtime_ns
+        for name in os.listdir(directory) if name.endswith(".py")
+        )
+
+
+def peer_is_user(conn):
+    # The helper runs exchanges as this user: it only serves this user.
+    # Without SO_PEERCRED the 0700 directory is the only guard.
+    uid = peer_uid(conn)
+    return uid is None or uid == os.getuid()
+
+
+def recv_message(sock):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("Helper connection closed")
+        data += chunk
+    return json.loads(data)
+
+
+###########################################################################
+# Client: the handler _main
+
+def forward(handler_path, argv):
+    # Exit code of the exchange run by the session helper, None when the
+    # caller has to run it in process
+    if not COMFYUI_ZDEPTH_HELPER:
+        return None
+    session = int(os.environ.get("COMFYUI_ZDEPTH_SESSION", os.getppid()))
+    request = {
+        "argv": argv,
+        "cwd": os.getcwd(),
+        "signature": code_signature(handler_path),
+        }
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CONNECT_TIMEOUT)
+            sock.connect(helper_path(handler_path, session, ".sock"))
+            sock.settimeout(REQUEST_TIMEOUT)
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            response = recv_message(sock)
+    except (OSError, ValueError):
+        start_helper(handler_path, session)
+        return None
+
+    if response.get("stale"):
+        return None
+    sys.stdout.write(response["output"])
+    sys.stdout.flush()
+    return response["exit_code"]
+
+
+def start_helper(handler_path, session):
+    # This exchange runs in process while the helper warms up
+    try:
+        log = open(helper_path(handler_path, session, ".log"), "a")
+    except OSError as e:
+        print(f'Unable to start the session helper: {e}')
+        return
+    subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), os.path.abspath(handler_path), str(session)],
+        stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+        start_new_session=True, close_fds=True,
+        )
+    log.close()
+
+
+###########################################################################
+# Helper: one per Flame session and handler
+
+class Helper(object):
+
+    def __init__(self, handler_path, session):
+        self.handler_path = handler_path
+        self.session = session
+        self.socket_path = helper_path(handler_path, session, ".sock")
+        self.signature = code_signature(handler_path)
+        self.last_request = time.time()
+        self.module = None
+        self.tracer = None
+
+
+    def load(self):
+        # Everything the handler imports stays loaded between exchanges
+        directory = os.path.dirname(self.handler_path)
+        if directory not in sys.path:
+            sys.path.insert(0, directory)
+        self.module = importlib.import_module(os.path.splitext(os.path.basename(self.handler_path))[0])
+        self.tracer = importlib.import_module("zdepth_trace").TRACER
+        print(f'Helper loaded {self.handler_path}')
+
+
+    def session_alive(self):
+        try:
+            os.kill(self.session, 0)
+            return True
+        except ProcessLookupError:
+            return False
+        except OSError:
+            return True
+
+
+    def run(self, request):
+        if request["signature"] != self.signature:
+            return {"stale": True}
+
+        os.chdir(request["cwd"])
+        output = io.StringIO()
+        exit_code = 0
+        start = time.time()
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            try:
+                self.module._main(request["argv"])
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                traceback.print_exc()
+                exit_code = 1
+            if self.tracer.enabled:
+                # Spans are written per exchange, the helper does not exit
+                self.tracer.flush()
+        print(f'Helper exchange {request["argv"]} in {time.time() - start:.3f}s')
+        return {"output": output.getvalue(), "exit_code": exit_code}
+
+
+    def serve(self):
+        lock = open(helper_path(self.handler_path, self.session, ".lock"), "w")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # Another helper already serves this session
+                return
+
+        self.load()
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen(8)
+        server.settimeout(ACCEPT_TIMEOUT)
+        try:
+            while self.session_alive() and time.time() - self.last_request < IDLE_TIMEOUT:
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    continue
+                if not peer_is_user(conn):
+                    print('Helper connection of another user refused')
+                    conn.close()
+                    continue
+                # Exchanges of a session run one at a time, as in Flame
+                response = {}
+                with conn:
+                    conn.settimeout(REQUEST_TIMEOUT)
+                    try:
+                        response = self.run(recv_message(conn))
+                        conn.sendall(json.dumps(response).encode() + b"\n")
+                    except (OSError, ValueError) as e:
+                        print(f'Helper exchange failed: {e}')
+                self.last_request = time.time()
+                if response.get("stale"):
+                    print("Helper code changed, exiting")
+                    break
+        finally:
+            server.close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+
+def _main(argv):
+    Helper(argv[0], int(argv[1])).serve()
+
+if __name__ == "__main__":
+    _main(sys.argv[1:])
@@ -0,0 +1,138 @@
+##########################################################################
+#
+# Filename: zdepth_image.py
+#
+# Author: Julien Martin
+# Created: 2024-03
+#
+###########################################################################
+from __future__ import print_function
+
+from pathlib import Path
+
+import numpy as np
+
+try:
+    import OpenImageIO as oiio
+except ImportError:
+    oiio = None
+
+
+SIGNATURE_SIZE = 16
+
+LUMINANCE_WEIGHTS = np.array([0.2126, 0.7152, 0.0722], dtype=np.float32)
+
+
+###########################################################################
+# EXR I/O
+
+def read_exr(path):
+    if oiio is None:
+        raise ImportError("OpenImageIO is required to read EXR pixels")
+    image = oiio.ImageInput.open(str(path))
+    if image is None:
+        raise IOError(f'Unable to open {path}: {oiio.geterror()}')
+    try:
+        spec = image.spec()
+        pixels = image.read_image(0, 0, 0, spec.nchannels, oiio.FLOAT)
+    finally:
+        image.close()
+    if pixels is None:
+        raise IOError(f'Unable to read {path}: {oiio.geterror()}')
+    return pixels.reshape(spec.height, spec.width, spec.nchannels)
+
+
+def write_exr(path, pixels, half=False, compression="zip"):
+    if oiio is None:
+        raise ImportError("OpenImageIO is required to write EXR pixels")
+    if pixels.ndim == 2:
+        pixels = pixels[..., np.newaxis]
+    height, width, channels = pixels.shape
+    spec = oiio.ImageSpec(width, height, channels, oiio.HALF if half else oiio.FLOAT)
+    if channels == 1:
+        # A Y channel is read as luminance, by Flame as by other readers
+        spec.channelnames = ("Y",)
+    spec.attribute("compression", compression)
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.tmp.exr")
+    image = oiio.ImageOutput.create(str(tmp_path))
+    if image is None or not image.open(str(tmp_path), spec):
+        raise IOError(f'Unable to write {path}: {oiio.geterror()}')
+    try:
+        image.write_image(np.ascontiguousarray(pixels, dtype=np.float32))
+    finally:
+        image.close()
+    tmp_path.replace(path)
+
+
+###########################################################################
+# Color
+
+def linear_to_srgb(pixels):
+    pixels = np.clip(pixels, 0, None)
+    return np.where(pixels <= 0.0031308, pixels * 12.92, 1.055 * np.power(pixels, 1 / 2.4) - 0.055)
+
+
+def srgb_to_linear(pixels):
+    pixels = np.clip(pixels, 0, None)
+    return np.where(pixels <= 0.04045, pixels / 12.92, np.power((pixels + 0.055) / 1.055, 2.4))
+
+
+###########################################################################
+# Signatures
+
+def luminance(pixels):
+    if pixels.ndim == 2 or pixels.shape[2] == 1:
+        return pixels.reshape(pixels.shape[0], pixels.shape[1])
+    if pixels.shape[2] < 3:
+        return pixels[..., 0]
+    return pixels[..., :3] @ LUMINANCE_WEIGHTS
+
+
+def downsample(plane, size=SIGNATURE_SIZE):
+    # Block mean on a grid sampled to a multiple of the signature size
+    height, width = plane.shape
+    rows = np.linspace(0, height - 1, size * max(1, min(height // size, 8))).astype(np.intp)
+    cols = np.linspace(0, width - 1, size * max(1, min(width // size, 8))).astype(np.intp)
+    sampled = plane[np.ix_(rows, cols)]
+    return sampled.reshape(size, len(rows) // size, size, len(cols) // size).mean(axis=(1, 3))
+
+
+def frame_signature(pixels, size=SIGNATURE_SIZE):
+    # Exposure normalized low resolution luminance
+    plane = np.nan_to_num(luminance(pixels.astype(np.float32, copy=False)))
+    small = downsample(np.clip(plane, 0, None), size)
+    return (small / (small.mean() + 1e-6)).astype(np.float32).ravel()
+
+
+def signature_distance(a, b):
+    return float(np.mean(np.abs(np.asarray(a, dtype=np.float32) - np.asarray(b, dtype=np.float32))))
+
+
+###########################################################################
+# Depth post-process
+
+def post_process(depth, normalize=False, invert=False, near=0.0, far=1.0, gamma=1.0, clamp=False):
+    # Vectorized grade of a raw depth plane, applied in place on a copy
+    depth = np.array(depth, dtype=np.float32)
+    if normalize:
+        finite = depth[np.isfinite(depth)]
+        if finite.size:
+            low, high = finite.min(), finite.max()
+            depth -= low
+            if high > low:
+                depth *= 1 / (high - low)
+    if invert:
+        np.subtract(1, depth, out=depth)
+    if (near, far) != (0, 1) and far != near:
+        depth -= near
+        depth *= 1 / (far - near)
+    if clamp:
+        np.clip(depth, 0, 1, out=depth)
+    if gamma != 1 and gamma > 0:
+        np.copysign(np.power(np.abs(depth), 1 / gamma), depth, out=depth)
+    return depth
+
+
+def is_identity_post_process(normalize=False, invert=False, near=0.0, far=1.0, gamma=1.0, clamp=False):
+    return not normalize and not invert and (near, far) == (0, 1) and gamma == 1 and not clamp
@@ -0,0 +1,131 @@
+##########################################################################
+#
+# Filename: zdepth_models.py
+#
+# Author: Julien Martin
+# Created: 2024-03
+#
+###########################################################################
+from __future__ import print_function
+
+import os
+import json
+import hashlib
+import threading
+from pathlib import Path
+
+from zdepth_cache import ZDEPTH_CACHE_DIR
+
+
+MODELS_INDEX_PATH = ZDEPTH_CACHE_DIR / "models_index.json"
+
+MODEL_EXTENSIONS = (".safetensors", ".pth", ".pt", ".ckpt", ".bin")
+
+CHECKSUM_CHUNK_SIZE = 1 << 20
+
+
+def quick_checksum(path, size):
+    # Head, tail and size: enough to notice a replaced model without
+    # reading gigabytes over the network mount
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, "rb") as f:
+        digest.update(f.read(CHECKSUM_CHUNK_SIZE))
+        if size > 2 * CHECKSUM_CHUNK_SIZE:
+            f.seek(size - CHECKSUM_CHUNK_SIZE)
+            digest.update(f.read(CHECKSUM_CHUNK_SIZE))
+    return digest.hexdigest()
+
+
+class ModelIndex(object):
+
+    def __init__(self, path=MODELS_INDEX_PATH):
+        self.path = Path(path)
+        self.index = None
+        self.refresh_thread = None
+
+
+    def load(self):
+        if self.index is None:
+            try:
+                with open(self.path) as f:
+                    self.index = json.load(f)
+            except (OSError, ValueError):
+                self.index = {}
+        return self.index
+
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f, indent=2)
+        tmp_path.replace(self.path)
+
+
+    def indexed(self, dir_paths):
+        return all(str(dir_path) in self.load() for dir_path in dir_paths)
+
+
+    def models(self, dir_paths):
+        index = self.load()
+        names = set()
+        for dir_path in dir_paths:
+            names.update(index.get(str(dir_path), {}).get("models", {}))
+        return sorted(names)
+
+
+    def entry(self, dir_path, name):
+        return self.load().get(str(dir_path), {}).get("models", {}).get(name)
+
+
+    def refresh(self, dir_paths):
+        # Only directories whose mtime changed are listed again, and only
+        # new or modified files are checksummed
+        index = self.load()
+        changed = False
+        for dir_path in dir_paths:
+            dir_path = Path(dir_path)
+            try:
+                dir_mtime = dir_path.stat().st_mtime_ns
+            except OSError:
+                changed |= index.pop(str(dir_path), None) is not None
+                continue
+            dir_entry = index.get(str(dir_path))
+            if dir_entry is not None and dir_entry["mtime"] == dir_mtime:
+                continue
+
+            previous = dir_entry["models"] if dir_entry else {}
+            models = {}
+            for file_entry in os.scandir(dir_path):
+                if not file_entry.is_file() or not file_entry.name.endswith(MODEL_EXTENSIONS):
+                    continue
+                stat = file_entry.stat()
+                model = previous.get(file_entry.name)
+                if model is None or model["size"] != stat.st_size or model["mtime"] != stat.st_mtime_ns:
+                    model = {
+                        "size": stat.st_size,
+                        "mtime": stat.st_mtime_ns,
+                        "checksum": quick_checksum(file_entry.path, stat.st_size),
+                        }
+                models[file_entry.name] = model
+            index[str(dir_path)] = {"mtime": dir_mtime, "models": models}
+            changed = True
+
+        if changed:
+            self.save()
+        return changed
+
+
+    def refresh_in_background(self, dir_paths):
+        # A daemon, so a stalled mount never holds the pybox process open.
+        # The index is replaced atomically: an exchange exiting before the
+        # refresh is done leaves the previous index, refreshed next time.
+        self.refresh_thread = threading.Thread(target=self.refresh, args=(dir_paths,), daemon=True)
+        self.refresh_thread.start()
+
+
+    def refreshed(self, timeout=0):
+        if self.refresh_thread is None:
+            return False
+        self.refresh_thread.join(timeout)
+        return not self.refresh_thread.is_alive()
@@ -0,0 +1,69 @@
+##########################################################################
+#
+# Filename: zdepth_paths.py
+#
+# Author: Julien Martin
+# Created: 2024-03
+#
+###########################################################################
+from __future__ import print_function
+
+# Standard library only: the session helper client imports it
+import os
+import stat
+import socket
+import struct
+import getpass
+import tempfile
+from pathlib import Path
+
+
+def user_id():
+    return os.getuid() if hasattr(os, "getuid") else getpass.getuser()
+
+
+ZDEPTH_USER_DIR = Path(tempfile.gettempdir()) / f"comfyui_zdepth-{user_id()}"
+
+
+def private_dir(*names):
+    # Per user tree in the shared temp directory. The root is created
+    # 0700 and has to belong to the user, so no other local user can
+    # list it, plant files in it or connect to its sockets.
+    root = ZDEPTH_USER_DIR
+    try:
+        root.mkdir(mode=0o700)
+    except FileExistsError:
+        pass
+    root_stat = root.lstat()
+    if not stat.S_ISDIR(root_stat.st_mode) or (hasattr(os, "getuid") and root_stat.st_uid != os.getuid()):
+        raise PermissionError(f'{root} is not a directory owned by the current user')
+    if stat.S_IMODE(root_stat.st_mode) & 0o077:
+        os.chmod(root, 0o700)
+
+    path = root.joinpath(*names)
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    return path
+
+
+def prune_files(dir_path, pattern, max_files):
+    # Keep the most recently written files only
+    paths = []
+    for path in Path(dir_path).glob(pattern):
+        try:
+            paths.append((path.stat().st_mtime_ns, path))
+        except FileNotFoundError:
+            pass
+    for _, path in sorted(paths)[:-max_files]:
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def peer_uid(conn):
+    # Uid of the process at the other end of a unix socket, None where
+    # the platform does not tell
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    credentials = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    return struct.unpack("3i", credentials)[1]
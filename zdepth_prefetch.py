@@ -0,0 +1,92 @@
+##########################################################################
+#
+# Filename: zdepth_prefetch.py
+#
+# Author: Julien Martin
+# Created: 2024-03
+#
+###########################################################################
+from __future__ import print_function
+
+import os
+import mmap
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+
+def file_signature(path):
+    stat = Path(path).stat()
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class ResultRing(object):
+    # Read-only mappings of the latest prefetched Results. The pages stay
+    # resident while mapped, so the readback of the Result by Flame is
+    # served from memory instead of the network mount.
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def prefetch(self, path, depth):
+        path = str(path)
+        signature = file_signature(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == signature:
+                self.entries.move_to_end(path)
+                return signature
+        if signature[1] == 0:
+            return signature
+
+        with open(path, "rb") as f:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mapping, "madvise"):
+            mapping.madvise(mmap.MADV_WILLNEED)
+        # Fault the pages in off the exchange, the mapping outlives it in
+        # the session helper
+        threading.Thread(target=self.touch, args=(mapping,), daemon=True).start()
+
+        with self.lock:
+            previous = self.entries.pop(path, None)
+            self.entries[path] = (signature, mapping)
+            evicted = [previous] if previous is not None else []
+            while len(self.entries) > depth:
+                evicted.append(self.entries.popitem(last=False)[1])
+        for _, old_mapping in evicted:
+            self.close(old_mapping)
+        return signature
+
+
+    def holds(self, path, signature):
+        # Whether the Result is still mapped, as it was prefetched
+        with self.lock:
+            entry = self.entries.get(str(path))
+            return entry is not None and entry[0] == signature and not entry[1].closed
+
+
+    def touch(self, mapping):
+        try:
+            for offset in range(0, len(mapping), mmap.PAGESIZE):
+                mapping[offset]
+        except ValueError:
+            # Evicted meanwhile
+            pass
+
+
+    def close(self, mapping):
+        mapping.close()
+
+
+    def clear(self):
+        with self.lock:
+            entries, self.entries = self.entries, OrderedDict()
+        for _, mapping in entries.values():
+            self.close(mapping)
+
+
+RESULT_RING = ResultRing()
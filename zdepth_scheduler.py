@@ -0,0 +1,625 @@
+##########################################################################
+#
+# Filename: zdepth_scheduler.py
+#
+# Author: Julien Martin
+# Created: 2024-03
+#
+###########################################################################
+from __future__ import print_function
+
+import os
+import sys
+import stat
+import json
+import time
+import socket
+import hashlib
+import argparse
+import threading
+import subprocess
+import tempfile
+import socketserver
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import pwd
+except ImportError:
+    pwd = None
+
+from zdepth_events import FINISHED_STATUSES
+from zdepth_events import ensure_event_relay
+from zdepth_paths import peer_uid
+from zdepth_paths import private_dir
+from zdepth_server import ComfyUIServerError
+from zdepth_server import ServerPool
+from zdepth_server import get_server
+
+COMFYUI_ZDEPTH_SCHEDULER = os.environ.get("COMFYUI_ZDEPTH_SCHEDULER", "1") != "0" and hasattr(socket, "AF_UNIX")
+
+# One daemon per host where the uid of each connection is known, one per
+# user behind a 0700 directory elsewhere
+ZDEPTH_SCHEDULER_SHARED = hasattr(socket, "SO_PEERCRED")
+ZDEPTH_SCHEDULER_DIR = Path(tempfile.gettempdir()) / "comfyui_zdepth" / "scheduler"
+
+# Pseudo server address of the scheduled prompts in the handlers state
+SCHEDULER_ADDRESS = "scheduler"
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_BATCH)
+
+# Prompts handed to each server at once: the server queue stays short so
+# interactive prompts never wait behind a long batch backlog
+SERVER_DEPTH = 2
+
+CLIENT_TIMEOUT = 5.0
+SPAWN_TIMEOUT = 2.0
+STATUS_CACHE_SECONDS = 0.2
+DISPATCH_INTERVAL = 0.1
+STATUS_INTERVAL = 0.25
+SNAPSHOT_INTERVAL = 1.0
+USAGE_HALF_LIFE = 300
+FINISHED_JOB_TTL = 600
+IDLE_TIMEOUT = 600
+
+PENDING_STATUSES = ("pending", "dispatching", "queued")
+
+
+def scheduler_path(name):
+    # Socket, lock and queue snapshot of the daemon. The host directory is
+    # sticky and open to every user, like the temp directory: requests
+    # are told apart by the uid of their connection.
+    if not ZDEPTH_SCHEDULER_SHARED:
+        return private_dir("scheduler") / name
+    ZDEPTH_SCHEDULER_DIR.mkdir(parents=True, exist_ok=True)
+    dir_stat = ZDEPTH_SCHEDULER_DIR.stat()
+    if dir_stat.st_uid == os.getuid() and stat.S_IMODE(dir_stat.st_mode) != 0o1777:
+        os.chmod(ZDEPTH_SCHEDULER_DIR, 0o1777)
+    return ZDEPTH_SCHEDULER_DIR / name
+
+
+def user_name(uid):
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except (AttributeError, KeyError):
+        return str(uid)
+
+
+def job_key(workflow, affinity):
+    # Identical prompts write identical results: they are computed once
+    return hashlib.sha256(json.dumps([workflow, affinity], sort_keys=True).encode()).hexdigest()
+
+
+###########################################################################
+# Daemon: one per host, shared by every handler
+
+class Scheduler(object):
+
+    def __init__(self, state_path):
+        # Servers are added as the handlers list them in their requests
+        self.pool = ServerPool([], state_path)
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.usage = {}
+        self.next_id = 0
+        self.last_request = time.time()
+        self.last_decay = time.time()
+        self.last_status = 0
+        self.last_snapshot = 0
+        self.dirty = True
+        self.last_error = None
+
+
+    ###################################
+    # Requests
+
+    def handle(self, request, uid):
+        # Sessions are only known with the uid of their connection: a user
+        # never sees or cancels the jobs of another one
+        command = request.get("command")
+        session = f'{uid}:{request.get("session")}'
+        with self.lock:
+            self.last_request = time.time()
+            if command == "submit":
+                return self.submit(request, uid, session)
+            if command == "cancel":
+                return self.cancel(session, request.get("job_ids"))
+            if command == "status":
+                return self.status(session)
+            if command == "queue":
+                return self.snapshot()
+        return {"error": f'Unknown command {command!r}'}
+
+
+    def submit(self, request, uid, session):
+        # Model sizes are facts about the models, shared by every job
+        for address in request.get("servers") or []:
+            if address not in self.pool.servers:
+                self.pool.servers[address] = get_server(address)
+        self.pool.model_sizes.update(request.get("model_sizes") or {})
+
+        priority = request.get("priority") or PRIORITY_INTERACTIVE
+        key = job_key(request["workflow"], request.get("affinity"))
+        for job in self.jobs.values():
+            if job["key"] == key and job["status"] in PENDING_STATUSES + ("running",):
+                if session not in job["sessions"]:
+                    job["sessions"].append(session)
+                if priority == PRIORITY_INTERACTIVE:
+                    job["priority"] = priority
+                self.dirty = True
+                print(f'Job {job["id"]} shared with {session}')
+                return {"job_id": job["id"]}
+
+        self.next_id += 1
+        job_id = f"{os.getpid()}-{self.next_id}"
+        self.jobs[job_id] = {
+            "id": job_id,
+            "key": key,
+            "user": uid,
+            "sessions": [session],
+            "cancelled_sessions": [],
+            "priority": priority,
+            "workflow": request["workflow"],
+            "affinity": request.get("affinity"),
+            "servers": request.get("servers") or list(self.pool.servers),
+            "vram_budget": request.get("vram_budget") or 0,
+            "pinned": request.get("pinned") or [],
+            "exclude": request.get("exclude") or [],
+            "submitted": time.time(),
+            "status": "pending",
+            "cancelled": False,
+            "address": None,
+            "prompt_id": None,
+            "dispatched": None,
+            "node": None,
+            "progress": None,
+            "error": None,
+            "finished": None,
+            "seconds": None,
+            }
+        self.dirty = True
+        return {"job_id": job_id}
+
+
+    def cancel(self, session, job_ids=None):
+        # Jobs shared with other sessions keep running for them
+        cancelled = []
+        for job in self.jobs.values():
+            if session not in job["sessions"] or (job_ids is not None and job["id"] not in job_ids):
+                continue
+            if job["status"] not in PENDING_STATUSES + ("running",):
+                continue
+            job["sessions"].remove(session)
+            job["cancelled_sessions"].append(session)
+            if not job["sessions"]:
+                job["cancelled"] = True
+                cancelled.append(job["id"])
+        self.dirty = True
+        return {"cancelled": cancelled}
+
+
+    def status(self, session):
+        return {
+            "jobs": {
+                job["id"]: dict(
+                    {key: job[key] for key in ("status", "address", "node", "progress", "error", "seconds")},
+                    status=job["status"] if session in job["sessions"] else "cancelled",
+                    )
+                for job in self.jobs.values() if session in job["sessions"] + job["cancelled_sessions"]
+                },
+            }
+
+
+    def snapshot(self):
+        now = time.time()
+        users = {}
+        for job in self.jobs.values():
+            user = users.setdefault(user_name(job["user"]), {"usage": 0, "pending": 0, "running": 0})
+            if job["status"] in ("pending", "dispatching"):
+                user["pending"] += 1
+            elif job["status"] in ("queued", "running"):
+                user["running"] += 1
+        for uid, usage in self.usage.items():
+            users.setdefault(user_name(uid), {"usage": 0, "pending": 0, "running": 0})["usage"] = round(usage, 1)
+        return {
+            "time": now,
+            "users": users,
+            "jobs": [
+                {
+                    "id": job["id"], "user": user_name(job["user"]), "priority": job["priority"],
+                    "status": job["status"], "address": job["address"], "node": job["node"],
+                    "progress": job["progress"], "waiting": round((job["dispatched"] or now) - job["submitted"], 1),
+                    }
+                for job in sorted(self.jobs.values(), key=lambda job: job["submitted"])
+                if job["status"] not in FINISHED_STATUSES + ("cancelled",)
+                ],
+            }
+
+
+    ###################################
+    # Dispatch
+
+    def server_load(self):
+        load = {address: 0 for address in self.pool.servers}
+        for job in self.jobs.values():
+            if job["status"] in ("dispatching", "queued", "running") and job["address"] in load:
+                load[job["address"]] += 1
+        return load
+
+
+    def job_exclude(self, job, exclude):
+        # Servers the job may not go to: the busy ones, the ones its
+        # handler excluded and the ones its handler does not list
+        return set(exclude) | set(job["exclude"]) | (set(self.pool.servers) - set(job["servers"]))
+
+
+    def next_job(self, exclude, skip=()):
+        # Interactive before batch, then the user with the fewest running
+        # jobs and the least recent GPU time, then first come first served
+        running = {}
+        for job in self.jobs.values():
+            if job["status"] in ("dispatching", "queued", "running"):
+                running[job["user"]] = running.get(job["user"], 0) + 1
+        for priority in PRIORITIES:
+            pending = [
+                job for job in self.jobs.values()
+                if job["status"] == "pending" and job["priority"] == priority and not job["cancelled"]
+                and job["id"] not in skip and set(self.pool.servers) - self.job_exclude(job, exclude)
+                ]
+            if pending:
+                return min(pending, key=lambda job: (
+                    running.get(job["user"], 0), self.usage.get(job["user"], 0), job["submitted"]))
+        return None
+
+
+    def dispatch(self):
+        self.pool.state = None
+        self.pool.queue_lengths = {}
+        # Jobs whose servers are all down wait for the next round without
+        # holding back the jobs of other servers
+        skip = set()
+        while True:
+            with self.lock:
+                full = {address for address, count in self.server_load().items() if count >= SERVER_DEPTH}
+                job = self.next_job(full, skip)
+                if job is None:
+                    return
+                job["status"] = "dispatching"
+                job["address"] = None
+                exclude = self.job_exclude(job, full)
+            # Residency settings of the handler which submitted the job,
+            # for the eviction of the server it goes to
+            self.pool.vram_budget = job["vram_budget"]
+            self.pool.pinned = set(job["pinned"])
+
+            try:
+                address, prompt_id = self.pool.queue_prompt(job["workflow"], job["affinity"], exclude)
+            except ComfyUIServerError as e:
+                if str(e) != self.last_error:
+                    print(f'Unable to dispatch job {job["id"]}: {e}')
+                self.last_error = str(e)
+                with self.lock:
+                    job["status"] = "pending"
+                skip.add(job["id"])
+                continue
+            self.last_error = None
+
+            ensure_event_relay(address)
+            with self.lock:
+                job.update(status="queued", address=address, prompt_id=prompt_id, dispatched=time.time())
+                self.dirty = True
+                print(f'Job {job["id"]} of {user_name(job["user"])} ({job["priority"]}) on {address}: {prompt_id}')
+                if job["cancelled"]:
+                    self.cancel_dispatched(job)
+
+
+    def cancel_dispatched(self, job):
+        server = self.pool.server(job["address"])
+        try:
+            server.cancel_prompt(job["prompt_id"])
+        except ComfyUIServerError as e:
+            print(f'Unable to cancel job {job["id"]}: {e}')
+        self.finish(job, "cancelled")
+
+
+    def finish(self, job, status, error=None, seconds=None):
+        job["status"] = status
+        job["error"] = error
+        job["seconds"] = seconds
+        job["finished"] = time.time()
+        if job["dispatched"] is not None:
+            self.usage[job["user"]] = self.usage.get(job["user"], 0) + job["finished"] - job["dispatched"]
+            if status == "success":
+                # Recorded like the handlers do for their direct prompts,
+                # against the server which ran the job
+                with self.pool.lock:
+                    self.pool.record_latency(job["address"], job["finished"] - job["dispatched"])
+        job["workflow"] = None
+        self.dirty = True
+        print(f'Job {job["id"]} {status}')
+
+
+    def update(self):
+        now = time.time()
+        with self.lock:
+            decay = 0.5 ** ((now - self.last_decay) / USAGE_HALF_LIFE)
+            self.usage = {uid: usage * decay for uid, usage in self.usage.items() if usage * decay > 0.1}
+            self.last_decay = now
+            for job_id, job in list(self.jobs.items()):
+                if job["finished"] is not None and now - job["finished"] > FINISHED_JOB_TTL:
+                    del self.jobs[job_id]
+                elif job["cancelled"] and job["status"] == "pending":
+                    self.finish(job, "cancelled")
+                elif job["cancelled"] and job["status"] in ("queued", "running"):
+                    self.cancel_dispatched(job)
+            dispatched = [job for job in self.jobs.values() if job["status"] in ("queued", "running")]
+
+        if now - self.last_status < STATUS_INTERVAL:
+            return
+        self.last_status = now
+        for job in dispatched:
+            server = self.pool.server(job["address"])
+            seconds = None
+            try:
+                event = server.prompt_event(job["prompt_id"], job["dispatched"])
+                if event is None and server.is_done(job["prompt_id"], job["dispatched"]):
+                    event = {"status": "success", "node": None, "progress": None}
+                if event is not None and event["status"] == "success":
+                    _, seconds = server.execution_seconds(job["prompt_id"], job["dispatched"])
+            except ComfyUIServerError as e:
+                event = {"status": "error", "node": None, "progress": None, "error": str(e)}
+            if event is None:
+                continue
+            with self.lock:
+                if job["status"] not in ("queued", "running"):
+                    continue
+                if event["status"] in FINISHED_STATUSES:
+                    self.finish(job, event["status"], event.get("error"), seconds)
+                elif event["status"] == "running" and (job["status"] != "running" or event["progress"] != job["progress"]):
+                    job.update(status="running", node=event["node"], progress=event["progress"])
+                    self.dirty = True
+
+
+    def write_snapshot(self):
+        if not self.dirty or time.time() - self.last_snapshot < SNAPSHOT_INTERVAL:
+            return
+        with self.lock:
+            snapshot = self.snapshot()
+            self.dirty = False
+        queue_path = scheduler_path("queue.json")
+        tmp_path = queue_path.with_suffix(".tmp")
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(snapshot, f)
+            tmp_path.replace(queue_path)
+        except OSError as e:
+            # Left over by the daemon of another user
+            print(f'Unable to write the queue snapshot: {e}')
+        self.last_snapshot = time.time()
+
+
+    def idle(self):
+        with self.lock:
+            return time.time() - self.last_request > IDLE_TIMEOUT and all(
+                job["finished"] is not None for job in self.jobs.values())
+
+
+    def run(self):
+        socket_path = scheduler_path("scheduler.sock")
+        try:
+            # Whichever user starts the daemon next takes the same lock
+            lock = os.open(socket_path.with_suffix(".lock"), os.O_RDWR | os.O_CREAT, 0o666)
+            if ZDEPTH_SCHEDULER_SHARED and os.fstat(lock).st_uid == os.getuid():
+                os.fchmod(lock, 0o666)
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            # Another scheduler already serves this host
+            return
+
+        scheduler = self
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+
+            def handle(self):
+                line = self.rfile.readline()
+                if not line:
+                    # Liveness check of a handler
+                    return
+                # Only reachable by this user without SO_PEERCRED
+                uid = peer_uid(self.connection)
+                try:
+                    response = scheduler.handle(json.loads(line), os.getuid() if uid is None else uid)
+                except (ValueError, KeyError) as e:
+                    response = {"error": f'Bad request: {e}'}
+                self.wfile.write(json.dumps(response).encode() + b"\n")
+
+        try:
+            socket_path.unlink()
+        except OSError:
+            pass
+        try:
+            server = socketserver.ThreadingUnixStreamServer(str(socket_path), RequestHandler)
+        except OSError as e:
+            # A dead socket of another user in the sticky directory
+            print(f'Unable to listen on {socket_path}: {e}')
+            return
+        server.daemon_threads = True
+        if ZDEPTH_SCHEDULER_SHARED:
+            os.chmod(socket_path, 0o666)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f'Scheduler listening on {socket_path}')
+
+        try:
+            while not self.idle():
+                self.update()
+                self.dispatch()
+                self.write_snapshot()
+                time.sleep(DISPATCH_INTERVAL)
+        finally:
+            server.shutdown()
+            for path in (socket_path, scheduler_path("queue.json")):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+
+
+###########################################################################
+# Handler side: the scheduler looks like one more server of the pool
+
+class SchedulerClient(object):
+
+    address = SCHEDULER_ADDRESS
+
+    def __init__(self, session):
+        self.session = session
+        self.jobs = {}
+        self.jobs_time = 0
+
+
+    def request(self, command, **payload):
+        payload["command"] = command
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(CLIENT_TIMEOUT)
+                sock.connect(str(scheduler_path("scheduler.sock")))
+                sock.sendall(json.dumps(payload).encode() + b"\n")
+                data = b""
+                while not data.endswith(b"\n"):
+                    chunk = sock.recv(65536)
+                    if not chunk:
+                        break
+                    data += chunk
+            response = json.loads(data)
+        except (OSError, ValueError) as e:
+            raise ComfyUIServerError(f'{self.address}: {e}')
+        if "error" in response:
+            raise ComfyUIServerError(f'{self.address}: {response["error"]}')
+        return response
+
+
+    def queue_prompt(self, workflow, affinity=None, exclude=(), priority=None, pool=None):
+        # The servers and residency settings of the handler pool go with
+        # every job: the daemon is shared by sessions with other settings
+        settings = {}
+        if pool is not None:
+            settings = {
+                "servers": list(pool.servers),
+                "vram_budget": pool.vram_budget,
+                "model_sizes": pool.model_sizes,
+                "pinned": sorted(pool.pinned),
+                }
+        return self.request(
+            "submit", workflow=workflow, affinity=affinity, exclude=sorted(exclude),
+            priority=priority, session=self.session, **settings,
+            )["job_id"]
+
+
+    def prompt_event(self, job_id, submitted=None):
+        # One status request per tick covers every job of the session
+        if job_id not in self.jobs or time.time() - self.jobs_time > STATUS_CACHE_SECONDS:
+            self.jobs = self.request("status", session=self.session)["jobs"]
+            self.jobs_time = time.time()
+        job = self.jobs.get(job_id)
+        if job is None:
+            # The scheduler restarted: the job is lost
+            return {"status": "error", "node": None, "progress": None, "error": "Unknown scheduler job"}
+        status = job["status"]
+        if status in PENDING_STATUSES:
+            status = "pending"
+        elif status == "cancelled":
+            status = "interrupted"
+        return dict(job, status=status)
+
+
+    def is_done(self, job_id, submitted=None):
+        return self.prompt_event(job_id, submitted)["status"] in FINISHED_STATUSES
+
+
+    def execution_seconds(self, job_id, submitted=None):
+        event = self.prompt_event(job_id, submitted)
+        if event["status"] not in FINISHED_STATUSES:
+            return False, None
+        return True, event.get("seconds") if event["status"] == "success" else None
+
+
+    def delete_from_queue(self, job_ids):
+        if job_ids:
+            self.request("cancel", session=self.session, job_ids=list(job_ids))
+
+
+    def cancel_prompt(self, job_id):
+        self.delete_from_queue([job_id])
+
+
+    def interrupt(self):
+        self.request("cancel", session=self.session)
+
+
+    def get_queue(self):
+        return self.request("queue")
+
+
+def scheduler_running():
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(str(scheduler_path("scheduler.sock")))
+        return True
+    except OSError:
+        return False
+
+
+def ensure_scheduler(state_path):
+    if not COMFYUI_ZDEPTH_SCHEDULER:
+        return False
+    if scheduler_running():
+        return True
+
+    log = open(private_dir("scheduler") / "scheduler.log", "a")
+    subprocess.Popen(
+        [sys.executable, str(Path(__file__).resolve()), "--daemon", str(state_path)],
+        stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+        start_new_session=True, close_fds=True,
+        )
+    log.close()
+    deadline = time.time() + SPAWN_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(0.05)
+        if scheduler_running():
+            return True
+    return False
+
+
+def print_queue(snapshot):
+    print(f'{"user":<16}{"running":>8}{"pending":>8}{"usage (s)":>12}')
+    for user, stats in sorted(snapshot["users"].items()):
+        print(f'{user:<16}{stats["running"]:>8}{stats["pending"]:>8}{stats["usage"]:>12}')
+    print()
+    for job in snapshot["jobs"]:
+        progress = f'{job["progress"][0]}/{job["progress"][1]}' if job["progress"] else ""
+        print(f'{job["id"]:<12}{job["user"]:<16}{job["priority"]:<12}{job["status"]:<12}'
+              f'{job["address"] or "":<22}{progress:<10}waited {job["waiting"]}s')
+
+
+def _main(argv):
+    parser = argparse.ArgumentParser(description="ZDepth prompt scheduler")
+    parser.add_argument("--daemon", metavar="SERVERS_STATE", help="Run the scheduler of this host")
+    args = parser.parse_args(argv)
+
+    if args.daemon:
+        Scheduler(args.daemon).run()
+        return
+    try:
+        print_queue(SchedulerClient(None).get_queue())
+    except ComfyUIServerError as e:
+        print(f'No scheduler running: {e}')
+
+if __name__ == "__main__":
+    _main(sys.argv[1:])
@@ -0,0 +1,375 @@
+##########################################################################
+#
+# Filename: zdepth_server.py
+#
+# Author: Julien Martin
+# Created: 2024-03
+#
+###########################################################################
+from __future__ import print_function
+
+import os
+import json
+import time
+import threading
+import http.client
+from pathlib import Path
+
+from zdepth_events import COMFYUI_ZDEPTH_CLIENT_ID
+from zdepth_events import FINISHED_STATUSES
+from zdepth_events import ServerEvents
+
+
+DEFAULT_COMFYUI_PORT = 8188
+DEFAULT_TIMEOUT = 30
+
+DEFAULT_LATENCY = 1.0
+LATENCY_SMOOTHING = 0.2
+AFFINITY_LOAD_FACTOR = 2.0
+DEAD_SERVER_RETRY_DELAY = 30
+
+DEFAULT_COMFYUI_ADDRESS = f"127.0.0.1:{DEFAULT_COMFYUI_PORT}"
+
+
+def server_address(address):
+    # host or host:port, as host:port
+    address = str(address).strip()
+    if address.startswith("http://"):
+        address = address[len("http://"):]
+    address = address.rstrip("/")
+    return address if ":" in address else f"{address}:{DEFAULT_COMFYUI_PORT}"
+
+
+# Servers added to the one set in the handler UI
+COMFYUI_ZDEPTH_SERVERS = [
+    server_address(address)
+    for address in os.environ.get("COMFYUI_ZDEPTH_SERVERS", "").split(",")
+    if address.strip()
+    ]
+
+
+class ComfyUIServerError(Exception):
+    pass
+
+
+def history_execution_seconds(history):
+    # Execution time of a successful prompt, from the timestamps (ms) of
+    # the execution messages of its history
+    status = history.get("status", {})
+    if status.get("status_str") != "success":
+        return None
+    timestamps = {
+        message: data.get("timestamp")
+        for message, data in status.get("messages", [])
+        if isinstance(data, dict)
+        }
+    start, end = timestamps.get("execution_start"), timestamps.get("execution_success")
+    if start is None or end is None:
+        return None
+    return max(0.0, (end - start) / 1000)
+
+
+# Servers outlive the handlers in the session helper process, and so do
+# their keep-alive connections
+_servers = {}
+
+
+class ComfyUIServer(object):
+
+    def __init__(self, address, timeout=DEFAULT_TIMEOUT):
+        self.address = address
+        host, _, port = address.partition(":")
+        self.host = host
+        self.port = int(port) if port else DEFAULT_COMFYUI_PORT
+        self.timeout = timeout
+        self.client_id = COMFYUI_ZDEPTH_CLIENT_ID
+        self.events = ServerEvents(address)
+        self._local = threading.local()
+
+
+    ###################################
+    # Connection
+
+    def connection(self):
+        # http.client connections are not thread safe: keep one
+        # persistent connection per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            self._local.conn = conn
+        return conn
+
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+    def request(self, method, path, payload=None):
+        body = json.dumps(payload).encode() if payload is not None else None
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        for attempt in range(2):
+            conn = self.connection()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, OSError) as e:
+                # Stale keep-alive connection: reconnect once
+                self.close()
+                if attempt:
+                    raise ComfyUIServerError(f'{self.address}: {e}')
+
+        if response.status >= 400:
+            raise ComfyUIServerError(f'{self.address}: {method} {path} {response.status} {data[:200]!r}')
+        return json.loads(data) if data else None
+
+
+    ###################################
+    # ComfyUI API
+
+    def queue_prompt(self, workflow):
+        response = self.request("POST", "/prompt", {"prompt": workflow, "client_id": self.client_id})
+        return response["prompt_id"]
+
+
+    def get_queue(self):
+        return self.request("GET", "/queue")
+
+
+    def queue_length(self):
+        queue_remaining = self.events.queue_remaining()
+        if queue_remaining is not None:
+            return queue_remaining
+        queue = self.get_queue()
+        return len(queue.get("queue_running", [])) + len(queue.get("queue_pending", []))
+
+
+    def get_history(self, prompt_id):
+        return self.request("GET", f"/history/{prompt_id}").get(prompt_id)
+
+
+    def prompt_event(self, prompt_id, submitted=None):
+        return self.events.prompt(prompt_id, submitted)
+
+
+    def is_done(self, prompt_id, submitted=None):
+        # Pushed events first, the history when the relay missed the prompt
+        event = self.prompt_event(prompt_id, submitted)
+        if event is not None:
+            return event["status"] in FINISHED_STATUSES
+        history = self.get_history(prompt_id)
+        return bool(history) and history.get("status", {}).get("completed", True)
+
+
+    def execution_seconds(self, prompt_id, submitted=None):
+        # (finished, seconds) of a prompt: seconds the server spent running
+        # it, None when it did not succeed or was not timed
+        event = self.prompt_event(prompt_id, submitted)
+        if event is not None:
+            if event["status"] not in FINISHED_STATUSES:
+                return False, None
+            if event["status"] != "success":
+                return True, None
+            if event.get("started") is not None and event.get("finished") is not None:
+                return True, event["finished"] - event["started"]
+        history = self.get_history(prompt_id)
+        if not history:
+            return event is not None, None
+        return True, history_execution_seconds(history)
+
+
+    def interrupt(self):
+        self.request("POST", "/interrupt")
+
+
+    def delete_from_queue(self, prompt_ids):
+        if prompt_ids:
+            self.request("POST", "/queue", {"delete": list(prompt_ids)})
+
+
+    def cancel_prompt(self, prompt_id):
+        # Interrupt the prompt when it runs, drop it from the queue otherwise
+        queue = self.get_queue()
+        if any(item[1] == prompt_id for item in queue.get("queue_running", [])):
+            self.interrupt()
+        else:
+            self.delete_from_queue([prompt_id])
+
+
+def get_server(address):
+    if address not in _servers:
+        _servers[address] = ComfyUIServer(address)
+    return _servers[address]
+
+
+class ServerPool(object):
+
+    def __init__(self, addresses, state_path, vram_budget=0):
+        self.servers = {address: get_server(address) for address in addresses}
+        self.state_path = Path(state_path)
+        self.state = None
+        self.queue_lengths = {}
+        self.lock = threading.RLock()
+        # Model residency bookkeeping: sizes in bytes of the affinity keys,
+        # keys never evicted, and the VRAM budget per server (0: unbounded)
+        self.vram_budget = vram_budget
+        self.model_sizes = {}
+        self.pinned = set()
+        # Local scheduler the prompts go through when it is reachable
+        self.scheduler = None
+
+
+    def __len__(self):
+        return len(self.servers)
+
+
+    def server(self, address):
+        if self.scheduler is not None and address == self.scheduler.address:
+            return self.scheduler
+        return self.servers.get(address)
+
+
+    ###################################
+    # Server statistics shared by all handlers on the host
+
+    def load_state(self):
+        if self.state is None:
+            try:
+                with open(self.state_path) as f:
+                    self.state = json.load(f)
+            except (OSError, ValueError):
+                self.state = {}
+        return self.state
+
+
+    def save_state(self):
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.state_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f)
+        tmp_path.replace(self.state_path)
+
+
+    def server_state(self, address):
+        server_state = self.load_state().setdefault(address, {"latency": None, "resident": [], "dead_until": 0})
+        if not isinstance(server_state.get("resident"), list):
+            resident = server_state.get("resident")
+            server_state["resident"] = [resident] if resident else []
+        return server_state
+
+
+    def is_resident(self, address, key):
+        return key is not None and key in self.server_state(address)["resident"]
+
+
+    def mark_resident(self, address, key):
+        # Most recently used first, least recently used unpinned keys are
+        # evicted past the VRAM budget
+        resident = [k for k in self.server_state(address)["resident"] if k != key]
+        resident.insert(0, key)
+        if self.vram_budget > 0:
+            total = sum(self.model_sizes.get(k, 0) for k in resident)
+            for k in reversed(resident[1:]):
+                if total <= self.vram_budget:
+                    break
+                if k not in self.pinned:
+                    resident.remove(k)
+                    total -= self.model_sizes.get(k, 0)
+        self.server_state(address)["resident"] = resident
+        self.save_state()
+
+
+    def record_latency(self, address, seconds):
+        if address not in self.servers:
+            return
+        server_state = self.server_state(address)
+        latency = server_state["latency"]
+        server_state["latency"] = seconds if latency is None else (1 - LATENCY_SMOOTHING) * latency + LATENCY_SMOOTHING * seconds
+        self.save_state()
+
+
+    def mark_dead(self, address):
+        print(f'ComfyUI server {address} unreachable')
+        self.server_state(address)["dead_until"] = time.time() + DEAD_SERVER_RETRY_DELAY
+        self.save_state()
+
+
+    ###################################
+    # Dispatch
+
+    def alive(self):
+        now = time.time()
+        return [address for address in self.servers if self.server_state(address)["dead_until"] <= now]
+
+
+    def queue_length(self, address):
+        if address not in self.queue_lengths:
+            try:
+                self.queue_lengths[address] = self.servers[address].queue_length()
+            except ComfyUIServerError:
+                self.mark_dead(address)
+                self.queue_lengths[address] = None
+        return self.queue_lengths[address]
+
+
+    def load(self, address):
+        # Expected time to drain the server queue
+        latency = self.server_state(address)["latency"]
+        return (self.queue_length(address) + 1) * (latency if latency is not None else DEFAULT_LATENCY)
+
+
+    def select(self, affinity=None, exclude=()):
+        candidates = [a for a in self.alive() if a not in exclude and self.queue_length(a) is not None]
+        if not candidates:
+            return None
+
+        # Keep shots on servers which already have the model loaded,
+        # unless they are much busier than the least loaded server
+        least_loaded = min(candidates, key=self.load)
+        resident = [a for a in candidates if self.is_resident(a, affinity)]
+        if resident:
+            best_resident = min(resident, key=self.load)
+            if self.load(best_resident) <= AFFINITY_LOAD_FACTOR * self.load(least_loaded):
+                return best_resident
+        return least_loaded
+
+
+    def scheduled(self, exclude=()):
+        return self.scheduler is not None and self.scheduler.address not in exclude \
+            and self.server_state(self.scheduler.address)["dead_until"] <= time.time()
+
+
+    def queue_prompt(self, workflow, affinity=None, exclude=(), priority=None):
+        exclude = set(exclude)
+        if self.scheduled(exclude):
+            try:
+                return self.scheduler.address, self.scheduler.queue_prompt(workflow, affinity, exclude, priority, self)
+            except ComfyUIServerError as e:
+                # Straight to the servers until the scheduler is back
+                print(f'Unable to schedule prompt: {e}')
+                with self.lock:
+                    self.mark_dead(self.scheduler.address)
+
+        while True:
+            with self.lock:
+                address = self.select(affinity, exclude)
+                if address is None:
+                    raise ComfyUIServerError("No ComfyUI server available")
+                self.queue_lengths[address] += 1
+            try:
+                prompt_id = self.servers[address].queue_prompt(workflow)
+            except ComfyUIServerError as e:
+                print(f'Unable to queue prompt: {e}')
+                with self.lock:
+                    self.mark_dead(address)
+                exclude.add(address)
+                continue
+
+            if affinity is not None:
+                with self.lock:
+                    self.mark_resident(address, affinity)
+            return address, prompt_id
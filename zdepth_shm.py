@@ -0,0 +1,121 @@
+##########################################################################
+#
+# Filename: zdepth_shm.py
+#
+# Author: Julien Martin
+# Created: 2024-03
+#
+###########################################################################
+from __future__ import print_function
+
+import struct
+from multiprocessing import shared_memory
+
+import numpy as np
+
+try:
+    from multiprocessing import resource_tracker
+except ImportError:
+    resource_tracker = None
+
+
+SHARED_FRAME_MAGIC = b"ZDSF"
+SHARED_FRAME_HEADER = struct.Struct("<4sIII")
+SHARED_FRAME_HEADER_SIZE = 64
+
+
+class SharedFrame(object):
+    # Float32 HxWxC pixels in a named shared memory block, behind a small
+    # header. The magic is written last so readers never see a frame
+    # which is still being filled.
+
+    def __init__(self, shm, shape):
+        self.shm = shm
+        self.shape = shape
+
+
+    @property
+    def name(self):
+        return self.shm.name
+
+
+    @property
+    def array(self):
+        return np.ndarray(self.shape, dtype=np.float32, buffer=self.shm.buf, offset=SHARED_FRAME_HEADER_SIZE)
+
+
+    @classmethod
+    def create(cls, name, shape):
+        height, width, channels = shape
+        size = SHARED_FRAME_HEADER_SIZE + height * width * channels * 4
+        try:
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        untrack(shm)
+        return cls(shm, (height, width, channels))
+
+
+    @classmethod
+    def attach(cls, name):
+        # Returns None until the writer has published the frame
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            return None
+        untrack(shm)
+        magic, height, width, channels = SHARED_FRAME_HEADER.unpack_from(shm.buf, 0)
+        if magic != SHARED_FRAME_MAGIC:
+            shm.close()
+            return None
+        return cls(shm, (height, width, channels))
+
+
+    @classmethod
+    def from_pixels(cls, name, pixels):
+        if pixels.ndim == 2:
+            pixels = pixels[..., np.newaxis]
+        frame = cls.create(name, pixels.shape)
+        frame.array[...] = pixels
+        frame.publish()
+        return frame
+
+
+    def publish(self):
+        height, width, channels = self.shape
+        SHARED_FRAME_HEADER.pack_into(self.shm.buf, 0, SHARED_FRAME_MAGIC, height, width, channels)
+
+
+    def close(self):
+        self.shm.close()
+
+
+    def unlink(self):
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def untrack(shm):
+    # Frames outlive the short pybox processes: keep the resource tracker
+    # from unlinking them when the process which created them exits
+    if resource_tracker is not None:
+        try:
+            resource_tracker.unregister(shm._name, "shared_memory")
+        except Exception:
+            pass
+
+
+def unlink_shared_frame(name):
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    untrack(shm)
+    shm.close()
+    shm.unlink()
@@ -0,0 +1,83 @@
+##########################################################################
+#
+# Filename: zdepth_tiles.py
+#
+# Author: Julien Martin
+# Created: 2024-03
+#
+###########################################################################
+from __future__ import print_function
+
+import numpy as np
+
+
+def tile_starts(length, tile, overlap):
+    if length <= tile:
+        return [0]
+    stride = max(1, tile - overlap)
+    count = int(np.ceil((length - tile) / stride)) + 1
+    # Spread the tiles evenly so the last one ends on the plate border
+    return [int(round(i * (length - tile) / (count - 1))) for i in range(count)]
+
+
+def tile_boxes(height, width, tile, overlap):
+    return [
+        (y, x, min(tile, height), min(tile, width))
+        for y in tile_starts(height, tile, overlap)
+        for x in tile_starts(width, tile, overlap)
+        ]
+
+
+def resize(pixels, height, width):
+    # Bilinear resize on the first two axes
+    src_height, src_width = pixels.shape[:2]
+    ys = np.linspace(0, src_height - 1, height)
+    xs = np.linspace(0, src_width - 1, width)
+    y0 = np.floor(ys).astype(np.intp)
+    x0 = np.floor(xs).astype(np.intp)
+    y1 = np.minimum(y0 + 1, src_height - 1)
+    x1 = np.minimum(x0 + 1, src_width - 1)
+    wy = (ys - y0).reshape(-1, 1, *([1] * (pixels.ndim - 2)))
+    wx = (xs - x0).reshape(1, -1, *([1] * (pixels.ndim - 2)))
+    top = pixels[y0][:, x0] * (1 - wx) + pixels[y0][:, x1] * wx
+    bottom = pixels[y1][:, x0] * (1 - wx) + pixels[y1][:, x1] * wx
+    return (top * (1 - wy) + bottom * wy).astype(pixels.dtype, copy=False)
+
+
+def split_tiles(pixels, boxes, tile):
+    # Tiles of a batch share one size: plates smaller than a tile are
+    # stretched, which the blend undoes
+    tiles = []
+    for y, x, h, w in boxes:
+        crop = pixels[y:y + h, x:x + w]
+        tiles.append(crop if (h, w) == (tile, tile) else resize(crop, tile, tile))
+    return tiles
+
+
+def feather(h, w, overlap):
+    # Linear ramp over the overlap on every tile border
+    ramp = max(1, overlap)
+    wy = np.clip((np.minimum(np.arange(h), np.arange(h)[::-1]) + 1) / ramp, 0, 1)
+    wx = np.clip((np.minimum(np.arange(w), np.arange(w)[::-1]) + 1) / ramp, 0, 1)
+    return np.outer(wy, wx).astype(np.float32)
+
+
+def align(depth, reference):
+    # Least squares scale and shift of a tile against the global pass
+    a = np.stack([depth.ravel(), np.ones(depth.size, dtype=depth.dtype)], axis=1)
+    (scale, shift), *_ = np.linalg.lstsq(a, reference.ravel(), rcond=None)
+    return depth * scale + shift
+
+
+def blend_tiles(depths, boxes, global_depth, height, width, overlap):
+    reference = resize(global_depth, height, width)
+    accumulated = np.zeros((height, width), dtype=np.float32)
+    weights = np.zeros((height, width), dtype=np.float32)
+    for depth, (y, x, h, w) in zip(depths, boxes):
+        if depth.shape != (h, w):
+            depth = resize(depth, h, w)
+        aligned = align(depth, reference[y:y + h, x:x + w])
+        weight = feather(h, w, overlap)
+        accumulated[y:y + h, x:x + w] += aligned * weight
+        weights[y:y + h, x:x + w] += weight
+    return np.where(weights > 0, accumulated / np.maximum(weights, 1e-6), reference)
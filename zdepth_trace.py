@@ -0,0 +1,157 @@
+##########################################################################
+#
+# Filename: zdepth_trace.py
+#
+# Author: Julien Martin
+# Created: 2024-03
+#
+###########################################################################
+from __future__ import print_function
+
+import os
+import json
+import time
+import atexit
+import functools
+import threading
+from pathlib import Path
+
+from zdepth_paths import private_dir
+
+
+COMFYUI_ZDEPTH_TRACE = os.environ.get("COMFYUI_ZDEPTH_TRACE", "") not in ("", "0")
+
+TRACE_FILENAME = "zdepth_trace.json"
+SUMMARY_FILENAME = "zdepth_trace_summary.json"
+SUMMARY_SAMPLES = 500
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Tracer(object):
+
+    def __init__(self, enabled=COMFYUI_ZDEPTH_TRACE):
+        self.enabled = enabled
+        # Until a node sets it, the per user directory: it is only
+        # created when spans are written
+        self.output_dir = None
+        self.events = []
+        self.lock = threading.Lock()
+        if enabled:
+            atexit.register(self.flush)
+
+
+    def set_output_dir(self, output_dir):
+        self.output_dir = Path(output_dir)
+
+
+    def add_span(self, name, start, duration, **args):
+        # Chrome trace complete event, timestamps in microseconds
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": int(start * 1e6),
+            "dur": int(duration * 1e6),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+            }
+        with self.lock:
+            self.events.append(event)
+
+
+    def span(self, name, **args):
+        return Span(self, name, args)
+
+
+    def flush(self):
+        with self.lock:
+            events, self.events = self.events, []
+        if not events:
+            return
+        try:
+            if self.output_dir is None:
+                self.output_dir = private_dir("trace")
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            self.write_trace(events)
+            self.write_summary(events)
+        except OSError as e:
+            print(f'Unable to write trace: {e}')
+
+
+    def write_trace(self, events):
+        # Chrome's JSON array format tolerates the missing closing bracket,
+        # so every pybox process can append its events to the same file
+        trace_path = self.output_dir / TRACE_FILENAME
+        with open(trace_path, "a") as f:
+            if f.tell() == 0:
+                f.write("[\n")
+            for event in events:
+                f.write(json.dumps(event) + ",\n")
+
+
+    def write_summary(self, events):
+        summary_path = self.output_dir / SUMMARY_FILENAME
+        try:
+            with open(summary_path) as f:
+                summary = json.load(f)
+        except (OSError, ValueError):
+            summary = {}
+
+        for event in events:
+            stage = summary.setdefault(event["name"], {"count": 0, "samples": []})
+            stage["count"] += 1
+            stage["samples"] = (stage["samples"] + [event["dur"] / 1000.0])[-SUMMARY_SAMPLES:]
+        for stage in summary.values():
+            stage["p50_ms"] = percentile(stage["samples"], 0.5)
+            stage["p95_ms"] = percentile(stage["samples"], 0.95)
+
+        tmp_path = summary_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(summary, f, indent=2)
+        tmp_path.replace(summary_path)
+
+
+class Span(object):
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+
+    def __enter__(self):
+        self.start = time.time()
+        self.perf_start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.perf_start
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer.add_span(self.name, self.start, duration, **self.args)
+        return False
+
+
+TRACER = Tracer()
+
+
+def traced(name):
+    def decorator(function):
+        if not TRACER.enabled:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            try:
+                frame = self.get_frame()
+            except Exception:
+                frame = None
+            with TRACER.span(name, frame=frame):
+                return function(self, *args, **kwargs)
+        return wrapper
+    return decorator
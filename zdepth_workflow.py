@@ -0,0 +1,133 @@
+##########################################################################
+#
+# Filename: zdepth_workflow.py
+#
+# Author: Julien Martin
+# Created: 2024-03
+#
+###########################################################################
+from __future__ import print_function
+
+import re
+import json
+import marshal
+import hashlib
+from pathlib import Path
+
+from zdepth_paths import private_dir
+
+
+TEMPLATE_FORMAT_VERSION = 2
+
+EXR_FRAME_PATTERN = re.compile(r"(\d+)\.exr$", re.IGNORECASE)
+
+_templates = {}
+
+
+def frame_from_path(path):
+    match = EXR_FRAME_PATTERN.search(Path(path).name)
+    return int(match.group(1)) if match else None
+
+
+def sequence_pattern(path):
+    # Names of the frames of the sequence path belongs to: the same name
+    # around the frame number, which is the first group
+    name = Path(path).name
+    match = EXR_FRAME_PATTERN.search(name)
+    if match is None:
+        return None
+    return re.compile(re.escape(name[:match.start(1)]) + r"(\d+)" + re.escape(name[match.end(1):]))
+
+
+def result_path(filename_prefix, frame, frame_pad):
+    return Path(f"{filename_prefix}.{frame:0{frame_pad}d}.exr")
+
+
+class WorkflowTemplate(object):
+
+    def __init__(self, workflow, signature):
+        self.workflow = workflow
+        self.signature = signature
+        self.id_to_class_type = {id: details["class_type"] for id, details in workflow.items()}
+        self.class_type_to_ids = {}
+        for id, class_type in self.id_to_class_type.items():
+            self.class_type_to_ids.setdefault(class_type, []).append(id)
+
+
+    def index(self, class_type):
+        ids = self.class_type_to_ids.get(class_type)
+        return ids[0] if ids else -1
+
+
+    def save_exr_index(self, filename_prefix):
+        for id in self.class_type_to_ids.get("SaveEXR", []):
+            if self.workflow[id]["inputs"]["filename_prefix"] == filename_prefix:
+                return id
+        return -1
+
+
+    def inputs(self, id):
+        return self.workflow[id]["inputs"]
+
+
+    def instantiate(self):
+        return copy_workflow(self.workflow)
+
+
+def copy_workflow(workflow):
+    # Node inputs are the only patched values: copy them one level
+    # deep and share the rest of the node definitions
+    return {
+        id: dict(details, inputs=dict(details["inputs"]))
+        for id, details in workflow.items()
+        }
+
+
+def file_signature(path):
+    stat = Path(path).stat()
+    return (TEMPLATE_FORMAT_VERSION, stat.st_mtime_ns, stat.st_size)
+
+
+def sidecar_path(path):
+    # Per user and plain data only: a sidecar never runs code when loaded
+    key = hashlib.sha1(str(Path(path).resolve()).encode()).hexdigest()[:16]
+    return private_dir("templates") / f"{Path(path).stem}_{key}.marshal"
+
+
+def read_sidecar(path, signature):
+    try:
+        with open(sidecar_path(path), "rb") as f:
+            data = marshal.load(f)
+        if tuple(data["signature"]) != signature:
+            return None
+        return WorkflowTemplate(data["workflow"], signature)
+    except (OSError, EOFError, ValueError, TypeError, KeyError):
+        return None
+
+
+def write_sidecar(path, template):
+    try:
+        sidecar = sidecar_path(path)
+        tmp_sidecar = sidecar.with_suffix(".tmp")
+        with open(tmp_sidecar, "wb") as f:
+            marshal.dump({"signature": template.signature, "workflow": template.workflow}, f)
+        tmp_sidecar.replace(sidecar)
+    except (OSError, ValueError) as e:
+        print(f'Unable to write workflow template of {path}: {e}')
+
+
+def load_workflow_template(path):
+    signature = file_signature(path)
+
+    template = _templates.get(path)
+    if template is not None and template.signature == signature:
+        return template
+
+    template = read_sidecar(path, signature)
+    if template is None:
+        with open(path) as f:
+            template = WorkflowTemplate(json.load(f), signature)
+        write_sidecar(path, template)
+
+    _templates[path] = template
+    return template